@@ -0,0 +1,106 @@
+"""
+Benchmarks of the download, dedup, render and commit stages against the
+local stand-in of `librelaws.standin`. Run with `make bench`.
+"""
+import tempfile
+import shutil
+
+import pygit2
+import pypandoc
+import pytest
+
+from librelaws import cli, fs_operations, git, online_lookups, xml_operations, conversion
+from librelaws.xml_operations import Citation
+from conftest import SIZES, write_corpus
+
+
+def _has_pandoc():
+    try:
+        pypandoc.get_pandoc_version()
+    except OSError:
+        return False
+    return True
+
+
+requires_pandoc = pytest.mark.skipif(not _has_pandoc(), reason='pandoc is not installed')
+
+
+@pytest.fixture
+def tmp_dirs():
+    dirs = []
+
+    def make():
+        dirs.append(tempfile.mkdtemp())
+        return dirs[-1]
+    yield make
+    for d in dirs:
+        shutil.rmtree(d)
+
+
+@pytest.mark.parametrize('n_laws', SIZES)
+def test_download_throughput(benchmark, standins, tmp_dirs, n_laws):
+    server = standins(n_laws)
+
+    def setup():
+        args = cli.create_parser().parse_args([tmp_dirs(), 'download', '--source', 'gii', '--quiet'])
+        return (args, ), {}
+    with server.redirect():
+        benchmark.pedantic(cli.do_download, setup=setup, rounds=3)
+    benchmark.extra_info['laws_per_second'] = n_laws / benchmark.stats['mean']
+
+
+@pytest.mark.parametrize('n_laws', SIZES)
+def test_download_not_modified(benchmark, standins, tmp_dirs, n_laws):
+    """A sync where every law is answered with `304`"""
+    server = standins(n_laws)
+    dl_dir = tmp_dirs()
+    args = cli.create_parser().parse_args([dl_dir, 'download', '--source', 'gii', '--quiet'])
+    with server.redirect():
+        cli.do_download(args)
+        benchmark.pedantic(cli.do_download, args=(args, ), rounds=3)
+    benchmark.extra_info['laws_per_second'] = n_laws / benchmark.stats['mean']
+
+
+@pytest.mark.parametrize('n_laws', SIZES)
+def test_find_duplicates(benchmark, seed, tmp_dirs, n_laws):
+    files = write_corpus(seed, tmp_dirs(), n_laws)
+    dups = benchmark.pedantic(fs_operations.find_duplicates, args=(files, ), rounds=1)
+    assert len(dups) == n_laws
+    benchmark.extra_info['files_per_second'] = len(files) / benchmark.stats['mean']
+
+
+@requires_pandoc
+@pytest.mark.parametrize('n_laws', SIZES)
+def test_render(benchmark, seed, tmp_dirs, n_laws):
+    files = write_corpus(seed, tmp_dirs(), n_laws, days=['2019-01-01'])
+
+    def render():
+        for f in files:
+            conversion.html_to_markdown(xml_operations.transform_gii_xml_to_html(xml_operations.zip_to_xml(f)))
+    benchmark.pedantic(render, rounds=1)
+    benchmark.extra_info['laws_per_second'] = n_laws / benchmark.stats['mean']
+
+
+@pytest.mark.parametrize('n_laws', SIZES)
+def test_augment(benchmark, seed, standins, tmp_dirs, n_laws):
+    files = write_corpus(seed, tmp_dirs(), n_laws, days=['2019-01-01'])
+    with standins(n_laws).redirect():
+        out = benchmark.pedantic(git.augment_and_filter_files, args=(files, ), rounds=1)
+    assert len(out) == n_laws
+    benchmark.extra_info['laws_per_second'] = n_laws / benchmark.stats['mean']
+
+
+@requires_pandoc
+@pytest.mark.parametrize('n_laws', SIZES)
+def test_commit_rate(benchmark, seed, tmp_dirs, n_laws):
+    files = write_corpus(seed, tmp_dirs(), n_laws, days=['2019-01-01'])
+    citations = [Citation.from_xml(xml_operations.zip_to_xml(f)) for f in files]
+
+    def setup():
+        return (pygit2.init_repository(tmp_dirs()), ), {}
+
+    def commit_all(repository):
+        for (f, cit) in zip(files, citations):
+            git.commit_update(f, cit, 'Update', repository)
+    benchmark.pedantic(commit_all, setup=setup, rounds=1)
+    benchmark.extra_info['commits_per_second'] = n_laws / benchmark.stats['mean']
@@ -0,0 +1,74 @@
+import os
+import platform
+import zipfile
+from os import path
+
+import pypandoc
+import pytest
+
+from librelaws.standin import StandIn
+from librelaws.synthetic import SeedLaw
+
+SEED_XML = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'test_files', 'StGB_pretty.xml')
+
+# Corpus sizes (number of laws) to benchmark; override with eg. `LIBRELAWS_BENCH_SIZES=100,1000`
+SIZES = [int(n) for n in os.environ.get('LIBRELAWS_BENCH_SIZES', '100,1000,10000').split(',')]
+
+
+def pytest_benchmark_update_machine_info(config, machine_info):
+    machine_info['cpu_count'] = os.cpu_count()
+    machine_info['host'] = platform.node()
+    machine_info['pandoc'] = pypandoc.get_pandoc_version()
+
+
+def pytest_benchmark_compare_machine_info(config, benchmarksession, machine_info, compared_benchmark):
+    """Refuse to compare against a baseline recorded on other hardware"""
+    saved = compared_benchmark['machine_info']
+    for key in ('cpu_count', 'host'):
+        if saved.get(key) != machine_info.get(key):
+            pytest.exit(
+                "The baseline was recorded with {}={!r}, this machine has {!r}. Record a baseline "
+                "here with `make bench-baseline`.".format(key, saved.get(key), machine_info.get(key)),
+                returncode=4
+            )
+
+
+@pytest.fixture(scope='session')
+def seed():
+    return SeedLaw(SEED_XML)
+
+
+@pytest.fixture(scope='session')
+def standins(seed):
+    """Stand-ins for the remote services by corpus size; started on first use"""
+    started = {}
+
+    def get(n_laws):
+        if n_laws not in started:
+            started[n_laws] = StandIn(seed, n_laws=n_laws, n_versions=3).start()
+        return started[n_laws]
+    yield get
+    for server in started.values():
+        server.stop()
+
+
+def write_corpus(seed, dl_dir, n_laws, days=('2019-01-01', '2019-02-01')):
+    """
+    Store the latest version of `n_laws` synthetic laws once per day in
+    `days`. Only the builddate differs between the copies.
+
+    Return
+    ------
+    list: Paths of the written files
+    """
+    files = []
+    for (i, day) in enumerate(days):
+        for n in range(n_laws):
+            abbrev = 'law{:05d}'.format(n)
+            folder = path.join(dl_dir, day, abbrev)
+            os.makedirs(folder, exist_ok=True)
+            fname = path.join(folder, '{}.zip'.format(i))
+            with zipfile.ZipFile(fname, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr('law.xml', seed.law_xml(abbrev, 2, builddate=day.replace('-', '') + '000000'))
+            files.append(fname)
+    return sorted(files)
@@ -0,0 +1,266 @@
+import concurrent.futures
+import logging
+import os
+import re
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_right
+from datetime import date
+from os import path
+
+from . import fs_operations, index
+from .gazette import BGBL_PARTS, GazetteIndex
+from .lazy import lazy_import
+
+git = lazy_import('librelaws.git')
+online_lookups = lazy_import('librelaws.online_lookups')
+
+
+BGBL_INDEX_FILE = '.librelaws-bgbl.idx'
+
+# The columns are stored little endian
+SWAP = sys.byteorder != 'little'
+
+MAGIC = b'LIBRELAWS-BGBL 1\n'
+
+# The columns of the file in the order they are stored
+COLUMNS = [
+    # Issues, sorted by `issue_keys`
+    ('issue_keys', 'Q'), ('issue_ends', 'I'), ('issue_dates', 'I'),
+    # Proceedings, sorted by `proc_keys`; the html of entry i is
+    # the zlib compressed `proc_html[proc_offsets[i]:proc_offsets[i + 1]]`
+    ('proc_keys', 'Q'), ('proc_ids', 'q'), ('proc_offsets', 'Q'), ('proc_html', 'B'),
+]
+
+
+def key(part, year, page):
+    """Pack a BGBl position into one integer which sorts like the tuple (part, year, page)"""
+    return (part << 48) | (year << 32) | page
+
+
+def _unpack(k):
+    return k >> 48, (k >> 32) & 0xffff, k & 0xffffffff
+
+
+def proceedings_id(html):
+    """The id of the proceedings (`vorgangId`) linked in the html of a BIP search; -1 if there is none"""
+    m = re.search(rb'vorgangId=(\d+)', html or b'')
+    return int(m.group(1)) if m else -1
+
+
+def index_path(dl_dir):
+    return path.join(path.expanduser(dl_dir), BGBL_INDEX_FILE)
+
+
+class BgblIndex:
+    """
+    A compact, sorted table of the BGBl I and II issues with their page
+    ranges and publication dates, and of the proceedings found at the
+    BIP for individual pages. All columns are `array`s, so the index is
+    small on disk and in memory, and lookups are binary searches.
+
+    Parameters
+    ----------
+    issues: iterable
+        Of (part, year, first page, end page (exclusive), date)
+    proceedings: iterable
+        Of (part, year, page, html) as returned by `online_lookups.search_bundestag_dip`
+    """
+    def __init__(self, issues=(), proceedings=()):
+        issues = sorted((key(part, year, first), end, d.toordinal()) for (part, year, first, end, d) in issues)
+        self.issue_keys = array('Q', (i[0] for i in issues))
+        self.issue_ends = array('I', (i[1] for i in issues))
+        self.issue_dates = array('I', (i[2] for i in issues))
+        proceedings = sorted({key(part, year, page): html for (part, year, page, html) in proceedings}.items())
+        self.proc_keys = array('Q', (k for (k, _) in proceedings))
+        self.proc_ids = array('q', (proceedings_id(html) for (_, html) in proceedings))
+        self.proc_offsets = array('Q', [0])
+        self.proc_html = array('B')
+        for (_, html) in proceedings:
+            self.proc_html.frombytes(zlib.compress(html or b''))
+            self.proc_offsets.append(len(self.proc_html))
+        self.years = {_unpack(k)[:2] for k in self.issue_keys}
+
+    @classmethod
+    def load(cls, fname):
+        index = cls()
+        with open(fname, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a BGBl index".format(fname))
+            for (name, typecode) in COLUMNS:
+                (length, ) = struct.unpack('<Q', f.read(8))
+                column = array(typecode)
+                column.fromfile(f, length)
+                if SWAP:
+                    column.byteswap()
+                setattr(index, name, column)
+        index.years = {_unpack(k)[:2] for k in index.issue_keys}
+        return index
+
+    def save(self, fname):
+        """Write the index to `fname` atomically"""
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            for (name, _) in COLUMNS:
+                column = getattr(self, name)
+                if SWAP:
+                    column = array(column.typecode, column)
+                    column.byteswap()
+                f.write(struct.pack('<Q', len(column)))
+                column.tofile(f)
+        # Move into place only once complete
+        os.replace(tmp, fname)
+
+    def covers(self, part, year):
+        """Whether the issues of the BGBl `part` of `year` are in the index"""
+        return (part, year) in self.years
+
+    def date(self, part, year, page):
+        """
+        The publication date of the BGBl `part` of `year` containing `page`
+
+        Raises
+        ------
+        ValueError: If the page is not part of any issue in the index
+        """
+        i = bisect_right(self.issue_keys, key(part, year, page)) - 1
+        if i < 0 or _unpack(self.issue_keys[i])[:2] != (part, year) or not page < self.issue_ends[i]:
+            raise ValueError("Page {} not found in BGBl {} {}".format(page, part, year))
+        return date.fromordinal(self.issue_dates[i])
+
+    def _proc_index(self, part, year, page):
+        k = key(part, year, page)
+        i = bisect_right(self.proc_keys, k) - 1
+        if i < 0 or self.proc_keys[i] != k:
+            return None
+        return i
+
+    def has_proceedings(self, part, year, page):
+        """Whether the BIP was already searched for this page"""
+        return self._proc_index(part, year, page) is not None
+
+    def proceedings(self, part, year, page):
+        """
+        The html of the BIP search for this page as returned by
+        `online_lookups.search_bundestag_dip`
+
+        Raises
+        ------
+        KeyError: If the page was not searched yet
+        """
+        i = self._proc_index(part, year, page)
+        if i is None:
+            raise KeyError((part, year, page))
+        return zlib.decompress(self.proc_html[self.proc_offsets[i]:self.proc_offsets[i + 1]].tobytes())
+
+    def proceedings_id(self, part, year, page):
+        """The id of the proceedings of this page; -1 if none were found, None if not searched yet"""
+        i = self._proc_index(part, year, page)
+        return None if i is None else self.proc_ids[i]
+
+    def iter_issues(self):
+        for (k, end, d) in zip(self.issue_keys, self.issue_ends, self.issue_dates):
+            part, year, first = _unpack(k)
+            yield part, year, first, end, date.fromordinal(d)
+
+    def iter_proceedings(self):
+        for (i, k) in enumerate(self.proc_keys):
+            part, year, page = _unpack(k)
+            yield part, year, page, self.proceedings(part, year, page)
+
+    def __len__(self):
+        return len(self.issue_keys)
+
+
+def load_index(dl_dir):
+    """The BGBl index of `dl_dir`, or None if it has none"""
+    fname = index_path(dl_dir)
+    if not path.exists(fname):
+        return None
+    return BgblIndex.load(fname)
+
+
+def _bgbl_position(f):
+    cit = git.bgbl_citation(f)
+    if cit is None or cit.page is None:
+        return None
+    return BGBL_PARTS[cit.gazette], cit.year, cit.page
+
+
+def local_citations(dl_dir, max_workers=None):
+    """
+    The BGBl citations of all versions in `dl_dir`; read from the
+    version index if there is one, otherwise from the files in worker
+    processes
+
+    Return
+    ------
+    set of tuple: {(part, year, page)}
+    """
+    if index.index_exists(dl_dir):
+        conn = index.open_index(dl_dir)
+        try:
+            rows = conn.execute(
+                'SELECT DISTINCT gazette, year, page FROM versions '
+                'WHERE gazette IN (?, ?) AND page IS NOT NULL', tuple(BGBL_PARTS)
+            ).fetchall()
+        finally:
+            conn.close()
+        return {(BGBL_PARTS[g], year, page) for (g, year, page) in rows}
+    files = fs_operations.all_local_files(dl_dir)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return {c for c in executor.map(_bgbl_position, files, chunksize=16) if c is not None}
+
+
+def build_index(dl_dir, years, parts=(1, 2), citations=(), refresh=False, max_workers=8):
+    """
+    Create or extend the BGBl index of `dl_dir`.
+
+    The issues of each part and year not in the index yet are fetched
+    from api.offenegesetze.de; the current year is always fetched again
+    as it may have new issues. The BIP is searched for the proceedings
+    of all `citations` which were not searched before. Failed searches
+    are skipped, so they are tried again by the next build, and the
+    proceedings which were found are saved all the same.
+
+    Parameters
+    ----------
+    years: iterable
+        Years whose issues should be in the index
+    parts: iterable
+        Parts of the BGBl (1 and/or 2)
+    citations: iterable
+        Of (part, year, page) whose proceedings should be in the index
+    refresh: bool
+        Fetch all years again
+
+    Return
+    ------
+    tuple: (number of fetched years, number of new proceedings)
+    """
+    old = load_index(dl_dir)
+    if old is None:
+        old = BgblIndex()
+    this_year = date.today().year
+    keys = [(p, y) for p in parts for y in years if refresh or y >= this_year or not old.covers(p, y)]
+    gazettes = GazetteIndex(max_workers=max_workers)
+    gazettes.load(keys)
+    fetched = {(part, year) for (part, year, _, _, _) in gazettes.issues()}
+    issues = [i for i in old.iter_issues() if (i[0], i[1]) not in fetched] + list(gazettes.issues())
+
+    names = {part: name for (name, part) in BGBL_PARTS.items()}
+    todo = sorted({c for c in citations if c[0] in names and not old.has_proceedings(*c)})
+    found = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(online_lookups.search_bundestag_dip, names[c[0]], c[1], c[2]): c for c in todo}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                found.append(futures[future] + (future.result(), ))
+            except Exception as exc:
+                # Eg. a failed request or an unexpected response
+                logging.warning("Could not look up the proceedings of %s: %r", futures[future], exc)
+    BgblIndex(issues, list(old.iter_proceedings()) + found).save(index_path(dl_dir))
+    return len(fetched), len(found)
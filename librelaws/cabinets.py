@@ -0,0 +1,131 @@
+import csv
+import functools
+import os
+from bisect import bisect_right
+from datetime import date, datetime
+from os import path
+
+from .lazy import lazy_import
+
+pygit2 = lazy_import('pygit2')
+
+
+CABINETS_FILE = path.join(path.dirname(path.abspath(__file__)), 'assets', 'cabinets.csv')
+
+# Path of a csv file with additional cabinets, eg. of Länder governments
+CABINETS_ENV = 'LIBRELAWS_CABINETS'
+
+
+def _as_date(at_date):
+    if isinstance(at_date, datetime):
+        return at_date.date()
+    return at_date
+
+
+@functools.lru_cache(maxsize=4096)
+def _signature(name, email, at_date):
+    ts = int(datetime(at_date.year, at_date.month, at_date.day).timestamp())
+    if ts < 0:
+        # Github cannot deal with negative timestamps at the moment...
+        ts = 0
+    return pygit2.Signature(name, email, ts)
+
+
+class CabinetTable:
+    """
+    The governments in office over time, used as the authors of the
+    history. The table is compiled into sorted arrays of the start
+    dates of each jurisdiction, so a date is resolved by bisection.
+
+    Parameters
+    ----------
+    rows: list of dict
+        With keys 'jurisdiction', 'name', 'email', 'start', 'end' and
+        'parties' as found in `assets/cabinets.csv`. Dates are ISO
+        strings; an empty `end` means the cabinet is still in office.
+    """
+    def __init__(self, rows):
+        by_jurisdiction = {}
+        for row in rows:
+            by_jurisdiction.setdefault(row['jurisdiction'], []).append(row)
+        self._tables = {}
+        for (jurisdiction, cabinets) in by_jurisdiction.items():
+            cabinets = sorted(cabinets, key=lambda r: r['start'])
+            self._tables[jurisdiction] = (
+                [datetime.strptime(r['start'], '%Y-%m-%d').date() for r in cabinets],
+                [datetime.strptime(r['end'], '%Y-%m-%d').date() if r['end'] else date.max for r in cabinets],
+                [(r['name'], r['email'], r['parties']) for r in cabinets],
+            )
+
+    @classmethod
+    def from_csv(cls, *fnames):
+        """Load the cabinets of all the given csv files"""
+        rows = []
+        for fname in fnames:
+            with open(fname, encoding='utf-8', newline='') as f:
+                rows.extend(csv.DictReader(f))
+        return cls(rows)
+
+    def _table(self, jurisdiction):
+        try:
+            return self._tables[jurisdiction]
+        except KeyError:
+            raise ValueError("Unknown jurisdiction {!r}. Known jurisdictions: {}".format(
+                jurisdiction, ', '.join(sorted(self._tables))
+            )) from None
+
+    def lookup(self, at_date, jurisdiction='bund'):
+        """
+        The cabinet in office at `at_date`
+
+        Return
+        ------
+        tuple: (name, email, parties)
+
+        Raises
+        ------
+        ValueError: If no cabinet was in office or `jurisdiction` is unknown
+        """
+        at_date = _as_date(at_date)
+        starts, ends, cabinets = self._table(jurisdiction)
+        i = bisect_right(starts, at_date) - 1
+        if i < 0 or not at_date < ends[i]:
+            raise ValueError("No cabinet found for date {}".format(at_date))
+        return cabinets[i]
+
+    def signature(self, at_date, jurisdiction='bund'):
+        """The git signature of the cabinet in office at `at_date`"""
+        name, email, _ = self.lookup(at_date, jurisdiction)
+        return _signature(name, email, _as_date(at_date))
+
+    def signatures(self, dates, jurisdiction='bund'):
+        """
+        The signatures for many commit `dates` at once. The dates are
+        resolved in one sorted sweep over the table instead of one
+        bisection per date.
+
+        Return
+        ------
+        list: pygit2.Signature for each date, in the order of `dates`
+        """
+        dates = [_as_date(d) for d in dates]
+        starts, ends, cabinets = self._table(jurisdiction)
+        out = [None] * len(dates)
+        i = -1
+        for j in sorted(range(len(dates)), key=dates.__getitem__):
+            while i + 1 < len(starts) and starts[i + 1] <= dates[j]:
+                i += 1
+            if i < 0 or not dates[j] < ends[i]:
+                raise ValueError("No cabinet found for date {}".format(dates[j]))
+            name, email, _ = cabinets[i]
+            out[j] = _signature(name, email, dates[j])
+        return out
+
+
+@functools.lru_cache(maxsize=None)
+def default_table():
+    """The bundled cabinets plus those of the csv file in `$LIBRELAWS_CABINETS`"""
+    fnames = [CABINETS_FILE]
+    if os.environ.get(CABINETS_ENV):
+        fnames.append(os.environ[CABINETS_ENV])
+    return CabinetTable.from_csv(*fnames)
@@ -0,0 +1,152 @@
+import os
+from collections import defaultdict
+from os import path
+
+from . import fs_operations, index
+
+
+STRATEGIES = ['delete', 'hardlink', 'reflink']
+
+
+def _group_duplicates(fingerprints):
+    """
+    Group the {filepath: fingerprint} `fingerprints` by fingerprint
+
+    Return
+    ------
+    list of tuple: [(original, [duplicates])] where the original is the
+    oldest (first by path) copy of each version
+    """
+    groups = defaultdict(list)
+    for f in sorted(fingerprints):
+        groups[fingerprints[f]].append(f)
+    return [(files[0], files[1:]) for files in groups.values() if len(files) > 1]
+
+
+def plan_from_files(files, max_workers=None):
+    """
+    Find the duplicates among `files` by fingerprinting all of them in
+    worker processes
+
+    Return
+    ------
+    list of tuple: [(duplicate, original)]
+    """
+    fingerprints = fs_operations.fingerprint_files(files, max_workers=max_workers)
+    return [(dup, original) for (original, dups) in _group_duplicates(fingerprints) for dup in dups]
+
+
+def plan_from_index(conn, dl_dir, max_workers=None):
+    """
+    Find the duplicates of the versions indexed since the last clean.
+    Older versions are only considered if they share a fingerprint with
+    a new one, so a clean after a sync only reads the new files.
+    Versions indexed before fingerprints were stored are fingerprinted
+    in worker processes.
+
+    Return
+    ------
+    list of tuple: [(duplicate, original)]
+    """
+    dl_dir = path.expanduser(dl_dir)
+    missing = [rp for (rp, ) in conn.execute('SELECT path FROM versions WHERE fingerprint IS NULL')]
+    if missing:
+        fingerprints = fs_operations.fingerprint_files([path.join(dl_dir, rp) for rp in missing], max_workers)
+        with conn:
+            conn.executemany(
+                'UPDATE versions SET fingerprint = ? WHERE path = ?',
+                [(digest, path.relpath(f, dl_dir)) for (f, digest) in fingerprints.items()]
+            )
+    rows = conn.execute(
+        'SELECT path, fingerprint FROM versions WHERE fingerprint IN '
+        '(SELECT fingerprint FROM versions WHERE cleaned = 0)'
+    )
+    fingerprints = {path.join(dl_dir, rp): digest for (rp, digest) in rows}
+    return [(dup, original) for (original, dups) in _group_duplicates(fingerprints) for dup in dups]
+
+
+def _remove(dup):
+    os.remove(dup)
+    try:
+        # abbrev folder; may not be empty if we combined archive.org and gii
+        os.rmdir(path.dirname(dup))
+        # Date folder
+        os.rmdir(path.dirname(path.dirname(dup)))
+    except OSError:
+        # Folder was not empty
+        pass
+
+
+def _is_linked(dup, original, links, dl_dir):
+    """
+    Whether `dup` already is a hardlink of `original`, or a reflink of
+    it which `clean` recorded in `links` and which was not replaced since
+    """
+    if path.samefile(dup, original):
+        return True
+    return links.get(path.relpath(dup, dl_dir)) == (path.relpath(original, dl_dir), os.stat(dup).st_ino)
+
+
+def clean(dl_dir, strategy='delete', dry_run=False, max_workers=None):
+    """
+    Get rid of the duplicates in `dl_dir`, ie. files which only differ
+    in their `builddate` from an older copy.
+
+    If `dl_dir` has a version index, it is brought up to date and only
+    the versions added since the last clean are considered; otherwise
+    all files are fingerprinted.
+
+    Parameters
+    ----------
+    strategy: str
+        'delete' removes the duplicates. 'hardlink' and 'reflink' replace
+        them by links to the original, so they take no space but can
+        still be read at their paths. Reflinks are recorded in the
+        version index, so without one they are found again by the next
+        clean.
+    dry_run: bool
+        Only find the duplicates
+
+    Return
+    ------
+    tuple: ([(duplicate, original)] that were (or would be) cleaned, bytes freed)
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError("Unknown strategy: {}".format(strategy))
+    dl_dir = path.expanduser(dl_dir)
+    conn = None
+    links = {}
+    if index.index_exists(dl_dir):
+        index.update_index(dl_dir, max_workers=max_workers)
+        conn = index.open_index(dl_dir)
+        plan = plan_from_index(conn, dl_dir, max_workers=max_workers)
+        rows = conn.execute('SELECT path, original, inode FROM links')
+        links = {rp: (original, inode) for (rp, original, inode) in rows}
+    else:
+        plan = plan_from_files(fs_operations.all_local_files(dl_dir), max_workers=max_workers)
+    try:
+        # Duplicates which are already links of their original take no space
+        plan = [(dup, original) for (dup, original) in plan if not _is_linked(dup, original, links, dl_dir)]
+        freed = sum(os.stat(dup).st_size for (dup, _) in plan)
+        if dry_run:
+            return plan, freed
+        for (dup, original) in plan:
+            if strategy == 'delete':
+                _remove(dup)
+            else:
+                fs_operations.replace_with_link(dup, original, strategy)
+        if conn is not None:
+            if strategy == 'delete':
+                index.drop_versions(conn, [path.relpath(dup, dl_dir) for (dup, _) in plan])
+            with conn:
+                if strategy != 'delete':
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO links (path, original, inode) VALUES (?, ?, ?)',
+                        [(path.relpath(dup, dl_dir), path.relpath(original, dl_dir), os.stat(dup).st_ino)
+                         for (dup, original) in plan]
+                    )
+                conn.execute('UPDATE versions SET cleaned = 1 WHERE cleaned = 0')
+    finally:
+        if conn is not None:
+            conn.close()
+    return plan, freed
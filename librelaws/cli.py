@@ -1,17 +1,13 @@
 import argparse
-import concurrent.futures
-import logging
 import os
+from datetime import date, datetime
 from os.path import dirname, basename
 
-import requests
-from requests import get
-from tqdm import tqdm
-
-from librelaws import online_lookups, fs_operations, xml_operations
-from librelaws.online_lookups import (
-    download_gii_if_non_existing, lookup_history, search_bundestag_dip
-)
+# Only light modules are imported here. Each subcommand imports the
+# (heavy) modules it needs when it runs, so that `--help` or small
+# subcommands start quickly.
+from librelaws import metrics
+from librelaws.stages import STAGES
 
 
 def create_parser():
@@ -26,15 +22,66 @@ def create_parser():
     parser = argparse.ArgumentParser(formatter_class=formatter_class)
     parser.add_argument(
         '-v', '--verbose', action='store_true', default=False)
+    parser.add_argument(
+        '--metrics-port', type=int, default=None,
+        help='Expose metrics in the Prometheus text format on this local port while running')
+    parser.add_argument(
+        '--metrics-file', default=None,
+        help='Write a json summary of all metrics to this file at the end of the run')
+    parser.add_argument(
+        '--profile', action='store_true', default=False,
+        help='Profile the subcommand and print a breakdown of the time spent per stage')
+    parser.add_argument(
+        '--profile-dir', default='librelaws-profile',
+        help='Directory for the profiles written by `--profile`')
     parser.add_argument('download-dir', help='Destination directory for the downloaded files')
     subparsers = parser.add_subparsers()
     # Download related actions
     add_dl_subparser(subparsers)
     add_git_subparser(subparsers)
     add_clean_subparser(subparsers)
+    add_index_subparser(subparsers)
+    add_index_bgbl_subparser(subparsers)
+    add_verify_subparser(subparsers)
+    add_feed_subparser(subparsers)
+    add_search_subparser(subparsers)
+    add_show_subparser(subparsers)
+    add_watch_subparser(subparsers)
+    add_generate_subparser(subparsers)
+    add_coordinator_subparser(subparsers)
+    add_worker_subparser(subparsers)
     return parser
 
 
+def run(args):
+    """
+    Run the subcommand selected by the parsed `args` and take care of
+    the options shared by all subcommands
+    """
+    server = None
+    if args.metrics_port is not None:
+        server = metrics.serve(args.metrics_port)
+    try:
+        if args.profile:
+            from librelaws import profiling
+            profiling.run_profiled(args.func, args, args.profile_dir)
+        else:
+            args.func(args)
+    finally:
+        if server is not None:
+            server.shutdown()
+        if args.metrics_file is not None:
+            metrics.write_summary(args.metrics_file)
+
+
+def iso_date(s):
+    """Argument type for dates given as `YYYY-MM-DD`"""
+    try:
+        return datetime.strptime(s, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected a date as YYYY-MM-DD. Found: {}".format(s))
+
+
 def add_git_subparser(subparsers):
     description = 'Build a git history based on the content of `download-dir`.'
     parser_git = subparsers.add_parser('git', description=description)
@@ -42,6 +89,34 @@ def add_git_subparser(subparsers):
         'git-dir',
         help='Directory where the git repository will be created. Must not be `download-dir`.'
     )
+    parser_git.add_argument(
+        '--low-memory', action='store_true', default=False,
+        help=('Sort the versions on disk and stream them one by one through rendering and commit. '
+              'Memory use is bounded by `--chunk-size` and `--window` instead of the corpus size.'))
+    parser_git.add_argument(
+        '--chunk-size', type=int, default=10000,
+        help='With `--low-memory`: number of citations sorted in memory before spilling to disk')
+    parser_git.add_argument(
+        '--window', type=int, default=64,
+        help='With `--low-memory`: maximum number of versions in flight between the stages')
+    parser_git.add_argument(
+        '--shard-by-law', action='store_true', default=False,
+        help=('Build the history of each law in its own repository in parallel and merge them '
+              'into the chronological history afterwards'))
+    parser_git.add_argument(
+        '--shard-dir', default=None,
+        help='With `--shard-by-law`: directory of the per-law repositories. Defaults to `.git/shards`.')
+    parser_git.add_argument(
+        '--no-merge', action='store_true', default=False,
+        help='With `--shard-by-law`: only build the per-law repositories')
+    parser_git.add_argument(
+        '--merge-only', action='store_true', default=False,
+        help=('With `--shard-by-law`: only merge the existing per-law repositories, '
+              'eg. after building them on several machines'))
+    parser_git.add_argument(
+        '--workers', type=int, default=None,
+        help='With `--shard-by-law`: number of worker processes. Defaults to the number of cores.')
+    parser_git.set_defaults(func=do_git)
 
 
 def add_dl_subparser(subparsers):
@@ -56,13 +131,189 @@ def add_dl_subparser(subparsers):
     parser_dl.add_argument(
         '--quiet', default=False, help='Disable progress bar', action='store_true'
     )
+    parser_dl.add_argument(
+        '--feed-dir', default=None,
+        help='Append the new versions to the change feed in this directory (see `feed`)')
     parser_dl.set_defaults(func=do_download)
 
+def add_watch_subparser(subparsers):
+    description = ('Keep `download-dir` in sync with gesetze-im-internet.de. Runs until interrupted '
+                   'and only issues conditional requests.')
+    parser = subparsers.add_parser('watch', description=description)
+    parser.add_argument(
+        '--interval', type=float, default=300,
+        help='Seconds between two polls of the TOC; new laws are downloaded right away')
+    parser.add_argument(
+        '--sweep-interval', type=float, default=3600,
+        help='Seconds between two conditional checks of all known laws for changes')
+    parser.add_argument('--workers', type=int, default=8, help='Number of concurrent connections')
+    parser.add_argument(
+        '--git-dir', default=None,
+        help='Extend the git history in this directory with each new version')
+    parser.add_argument(
+        '--feed-dir', default=None,
+        help='Append each new version to the change feed in this directory (see `feed`)')
+    parser.add_argument('--max-polls', type=int, default=None, help='Stop after this many polls')
+    parser.set_defaults(func=do_watch)
+
+
+def add_generate_subparser(subparsers):
+    description = ('Generate a synthetic corpus in `download-dir` for benchmarking. '
+                   'The laws are derived from the norms of a seed xml file.')
+    parser = subparsers.add_parser('generate', description=description)
+    parser.add_argument('seed-xml', help='Xml file of gesetze-im-internet.de (eg. `test_files/StGB_pretty.xml`)')
+    parser.add_argument('--laws', type=int, default=1000, help='Number of laws')
+    parser.add_argument('--versions', type=int, default=24, help='Average number of versions per law')
+    parser.add_argument('--norms', type=int, default=20, help='Number of norms per law')
+    parser.add_argument(
+        '--change-rate', type=float, default=0.2, help='Probability of a norm to change in a new version')
+    parser.add_argument(
+        '--churn-rate', type=float, default=0.3,
+        help='Probability of a version to be followed by a copy differing only in its builddate')
+    parser.add_argument(
+        '--laws-per-act', type=float, default=4, help='Average number of laws changed by the same amending act')
+    parser.add_argument('--rng-seed', type=int, default=0, help='Seed of the random number generator')
+    parser.set_defaults(func=do_generate)
+
+
+def add_coordinator_subparser(subparsers):
+    description = ('Rebuild the git history with workers on several machines. Queues the download, '
+                   'fingerprint, augment and render tasks in `queue-file` and merges the result into '
+                   '`git-dir`. `download-dir` must be shared with the workers.')
+    parser = subparsers.add_parser('coordinator', description=description)
+    parser.add_argument('queue-file', help='SQLite database of the work queue; must be shared with the workers')
+    parser.add_argument('git-dir', help='Directory of the git repository. Must not be `download-dir`.')
+    parser.add_argument(
+        '--stages', nargs='+', choices=STAGES, default=STAGES,
+        help='Only run these stages')
+    parser.add_argument(
+        '--shard-dir', default=None,
+        help='Shared directory of the per-law repositories. Defaults to `.git/shards` in `git-dir`.')
+    parser.add_argument(
+        '--local-workers', type=int, default=0, help='Number of workers to start on this machine')
+    parser.add_argument(
+        '--lease-seconds', type=float, default=300, help='Time a worker has to finish a task before it is retried')
+    parser.add_argument(
+        '--max-attempts', type=int, default=3, help='Number of attempts before a task is given up')
+    parser.set_defaults(func=do_coordinator)
+
+
+def add_worker_subparser(subparsers):
+    description = 'Run the tasks queued by a `coordinator` until it is done'
+    parser = subparsers.add_parser('worker', description=description)
+    parser.add_argument('queue-file', help='SQLite database of the work queue')
+    parser.add_argument('--name', default=None, help='Name of this worker. Defaults to `host-pid`.')
+    parser.add_argument(
+        '--idle-timeout', type=float, default=None, help='Stop after this many seconds without work')
+    parser.set_defaults(func=do_worker)
+
+
 def add_clean_subparser(subparsers):
-    parser = subparsers.add_parser('clean', description='Delete duplicates from the `download-folder` keeping the oldest versions')
+    description = ('Get rid of duplicates in the `download-folder` keeping the oldest versions. If there is an '
+                   'index, only the versions added since the last clean are checked.')
+    parser = subparsers.add_parser('clean', description=description)
+    parser.add_argument(
+        '--dry-run', action='store_true', default=False, help='Only list the duplicates')
+    parser.add_argument(
+        '--strategy', choices=['delete', 'hardlink', 'reflink'], default='delete',
+        help=('Delete the duplicates, or replace them by hard- or reflinks to the original so they take no '
+              'space but stay readable at their paths'))
+    parser.add_argument(
+        '--workers', type=int, default=None, help='Number of worker processes. Defaults to the number of cores.')
     parser.set_defaults(func=do_clean)
 
+
+def add_verify_subparser(subparsers):
+    description = ('Check the zip CRCs of the files in `download-dir` and validate their xml against the DTD of '
+                   'gesetze-im-internet.de. Bad files are moved to `download-dir/.quarantine`. With an index, '
+                   'files which passed before and did not change are skipped. `download` and `watch` verify '
+                   'new files right away.')
+    parser = subparsers.add_parser('verify', description=description)
+    parser.add_argument(
+        '--report-only', action='store_true', default=False, help='Only list the bad files; do not move them')
+    parser.add_argument(
+        '--workers', type=int, default=None, help='Number of worker processes. Defaults to the number of cores.')
+    parser.set_defaults(func=do_verify)
+
+
+def add_feed_subparser(subparsers):
+    description = ('Append the versions indexed since the last run to the change feed: one json record per '
+                   'version in `changes.jsonl` and an entry in the Atom feed `changes.atom`. Needs the index.')
+    parser = subparsers.add_parser('feed', description=description)
+    parser.add_argument('feed-dir', help='Directory of the feed files')
+    parser.add_argument(
+        '--offline', action='store_true', default=False,
+        help='Only link proceedings found in the BGBl index (see `index-bgbl`); do not search the BIP')
+    parser.add_argument(
+        '--full', action='store_true', default=False,
+        help=('Add all indexed versions on the first run, without searching the BIP for them. Otherwise the feed '
+              'starts with the versions indexed after its first run.'))
+    parser.add_argument(
+        '--max-entries', type=int, default=500, help='Number of the latest versions kept in the Atom feed')
+    parser.set_defaults(func=do_feed)
+
+
+def add_index_subparser(subparsers):
+    description = ('Build or update the full-text index over all versions in `download-dir`. '
+                   'Once the index exists, `download` keeps it up to date.')
+    parser = subparsers.add_parser('index', description=description)
+    parser.set_defaults(func=do_index)
+
+
+def add_index_bgbl_subparser(subparsers):
+    description = ('Build or extend the local index of the BGBl I and II issues (page ranges and publication dates) '
+                   'and of the proceedings of all BGBl citations in `download-dir`. `git` and `watch` use it '
+                   'and only go online for citations newer than the index.')
+    parser = subparsers.add_parser('index-bgbl', description=description)
+    parser.add_argument('--from-year', type=int, default=1949, help='First year of issues to index')
+    parser.add_argument(
+        '--to-year', type=int, default=None, help='Last year of issues to index. Defaults to the current year.')
+    parser.add_argument(
+        '--parts', type=int, nargs='+', choices=[1, 2], default=[1, 2], help='Parts of the BGBl to index')
+    parser.add_argument(
+        '--no-proceedings', action='store_true', default=False,
+        help='Do not look up the proceedings of the citations in `download-dir`')
+    parser.add_argument(
+        '--refresh', action='store_true', default=False, help='Fetch the issues of all years again')
+    parser.add_argument('--workers', type=int, default=8, help='Number of concurrent requests')
+    parser.set_defaults(func=do_index_bgbl)
+
+
+def add_search_subparser(subparsers):
+    parser = subparsers.add_parser('search', description='Search the norms of the laws in force at a given date')
+    parser.add_argument('phrase', help='Phrase to search for')
+    parser.add_argument(
+        '--as-of', type=iso_date, default=None,
+        help='Date (YYYY-MM-DD) at which the laws should have been in force. Defaults to today.')
+    parser.add_argument('--limit', type=int, default=100, help='Maximum number of results')
+    parser.set_defaults(func=do_search)
+
+
+def add_show_subparser(subparsers):
+    parser = subparsers.add_parser('show', description='Show a law or one of its norms as it was in force at a given date')
+    parser.add_argument('abbrev', help='Abbreviation of the law as used in `download-dir` (eg. `stgb`)')
+    parser.add_argument(
+        '--as-of', type=iso_date, default=None,
+        help='Date (YYYY-MM-DD) at which the law should have been in force. Defaults to today.')
+    # The text of a single norm is plain text, so it has no format
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('--norm', default=None, help='Only show the plain text of this norm (eg. `§ 1`)')
+    output.add_argument(
+        '--format', choices=['markdown', 'html', 'xml'], default='markdown',
+        help='Output format when showing the full law')
+    parser.set_defaults(func=do_show)
+
 def do_download(args):
+    import concurrent.futures
+    import functools
+    import logging
+
+    import requests
+    from tqdm import tqdm
+
+    from librelaws import online_lookups
+    from librelaws.online_lookups import download_gii_if_non_existing, lookup_history
+
     source = args.source
     dl_dir = args.__getattribute__('download-dir')
     quiet = args.quiet
@@ -79,52 +330,278 @@ def do_download(args):
         with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
             # We cannot rely on any etags in this case so we just download it all
             futures = [
-                executor.submit(download_gii_if_non_existing, dl_dir, url, etag=etag_for_url(url)) for url in links
+                executor.submit(
+                    metrics.collecting, download_gii_if_non_existing, dl_dir, url, etag=etag_for_url(url)
+                ) for url in links
             ]
-            for future in tqdm(futures, disable=quiet):  # concurrent.futures.as_completed(futures, timeout=2):
+            for (i, future) in enumerate(tqdm(futures, disable=quiet)):  # concurrent.futures.as_completed(futures, timeout=2):
+                metrics.set_gauge('librelaws_queue_depth', len(futures) - i, queue='download')
+                path = None
                 try:
-                    path = future.result()
+                    path, snapshot = future.result()
+                    metrics.merge(snapshot)
                 except requests.exceptions.RequestException as e:
+                    metrics.merge_failed(e)
                     request_excs.append(e.request.url)
                 except Exception as exc:
+                    metrics.merge_failed(exc)
                     other_excs.append(exc)
                 if path is not None:
                     updates.append(path)
+            metrics.set_gauge('librelaws_queue_depth', 0, queue='download')
         print("{} new files were downloaded".format(len(updates)))
         print("Timed out urls: \n {}".format(request_excs))
         print("Exceptions: ", other_excs)
+        updates = verify_downloads(dl_dir, updates)
+        update_existing_index(dl_dir, updates)
+        if args.feed_dir is not None:
+            update_feed(dl_dir, args.feed_dir)
 
     # TODO: This part is out of date!
     if source == 'archive.org':
+        updates = []
         with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-            hist_links = executor.map(lookup_history, links)
+            hist_links = executor.map(functools.partial(metrics.collecting, lookup_history), links)
             hist_links = tqdm(hist_links, desc='Collecting links...', total=len(links))
-            flat_links = [item for sublist in hist_links for item in sublist]
+            flat_links = []
+            for (sublist, snapshot) in hist_links:
+                metrics.merge(snapshot)
+                flat_links.extend(sublist)
         with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
             # We cannot rely on any etags in this case so we just download it all
             futures = [
-                executor.submit(get, url) for url in flat_links
+                executor.submit(metrics.collecting, requests.get, url, hooks=metrics.HTTP_HOOKS) for url in flat_links
             ]
             for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc='Downloading...'):
                 try:
-                    resp = future.result()
+                    resp, snapshot = future.result()
+                    metrics.merge(snapshot)
                 except online_lookups.VersionExistsError as exc:
+                    metrics.merge_failed(exc)
                     logging.info('%r exists locally. Skipping it.' % (exc))
                     continue
-                online_lookups.save_response(resp, dl_dir)
+                updates.append(online_lookups.save_response(resp, dl_dir))
+        updates = verify_downloads(dl_dir, updates)
+        update_existing_index(dl_dir, updates)
+        if args.feed_dir is not None:
+            update_feed(dl_dir, args.feed_dir)
+
+
+def verify_downloads(dl_dir, files):
+    """Quarantine the bad ones of the downloaded `files` and return the others"""
+    from librelaws import verify
+
+    if not files:
+        return files
+    bad, _ = verify.verify(dl_dir, files)
+    if bad:
+        print("Quarantined {} bad files".format(len(bad)))
+    return [f for f in files if f not in bad]
+
+
+def update_feed(dl_dir, feed_dir, lookup=True, max_entries=500, full=False):
+    """Append the versions indexed since the last run to the change feed in `feed_dir`"""
+    from librelaws import bgbl, feed
+
+    n = feed.update_feed(
+        dl_dir, feed_dir, bgbl_index=bgbl.load_index(dl_dir), lookup=lookup, max_entries=max_entries, full=full
+    )
+    print("Added {} versions to the change feed".format(n))
+
+
+def update_existing_index(dl_dir, files):
+    """Add `files` to the version index if the user created one"""
+    from librelaws import index
+
+    if not files or not index.index_exists(dl_dir):
+        return
+    conn = index.open_index(dl_dir)
+    try:
+        n = index.add_versions(conn, dl_dir, files)
+    finally:
+        conn.close()
+    print("Indexed {} new versions".format(n))
+
+def do_git(args):
+    from librelaws import bgbl, fs_operations, git
+
+    dl_dir = args.__getattribute__('download-dir')
+    git_dir = args.__getattribute__('git-dir')
+    if os.path.abspath(os.path.expanduser(dl_dir)) == os.path.abspath(os.path.expanduser(git_dir)):
+        raise ValueError("`git-dir` must not be `download-dir`")
+    bgbl_index = bgbl.load_index(dl_dir)
+    if args.shard_by_law:
+        if args.merge_only:
+            n = git.merge_shards(args.shard_dir or git.default_shard_dir(git_dir), git_dir)
+        else:
+            n = git.build_history_sharded(
+                fs_operations.iter_local_files(dl_dir), git_dir, shard_dir=args.shard_dir,
+                merge=not args.no_merge, max_workers=args.workers, bgbl_index=bgbl_index
+            )
+        print("Created {} commits.".format(n))
+        return
+    if args.low_memory:
+        files = fs_operations.iter_local_files(dl_dir)
+        n = git.build_history_streaming(
+            files, git_dir, chunk_size=args.chunk_size, window=args.window, bgbl_index=bgbl_index
+        )
+        print("Created {} commits.".format(n))
+        return
+    files = fs_operations.all_local_files(dl_dir)
+    n = git.build_history(files, git_dir, bgbl_index=bgbl_index)
+    print("Created {} commits from {} files.".format(n, len(files)))
+
 
 def do_clean(args):
+    from librelaws import clean
+
+    dl_dir = args.__getattribute__('download-dir')
+    plan, freed = clean.clean(dl_dir, strategy=args.strategy, dry_run=args.dry_run, max_workers=args.workers)
+    if args.dry_run:
+        for (dup, original) in plan:
+            print("{} duplicates {}".format(dup, original))
+        print("Would {} {} duplicates freeing {} bytes.".format(args.strategy, len(plan), freed))
+    else:
+        print("Cleaned {} duplicates ({}) freeing {} bytes.".format(len(plan), args.strategy, freed))
+
+
+def do_verify(args):
+    from librelaws import verify
+
+    dl_dir = args.__getattribute__('download-dir')
+    bad, n = verify.verify(dl_dir, move=not args.report_only, max_workers=args.workers)
+    for (f, problem) in sorted(bad.items()):
+        print("{}: {}".format(f, problem))
+    action = 'found' if args.report_only else 'quarantined'
+    print("Verified {} files; {} {} bad files.".format(n, action, len(bad)))
+
+
+def do_feed(args):
+    dl_dir = args.__getattribute__('download-dir')
+    update_feed(
+        dl_dir, args.__getattribute__('feed-dir'), lookup=not args.offline, max_entries=args.max_entries,
+        full=args.full
+    )
+
+
+def do_index(args):
+    from librelaws import index
+
+    dl_dir = args.__getattribute__('download-dir')
+    added, removed = index.update_index(dl_dir)
+    print("Indexed {} new versions; dropped {} versions no longer on disk.".format(added, removed))
+
+
+def do_index_bgbl(args):
+    from librelaws import bgbl
+
     dl_dir = args.__getattribute__('download-dir')
-    files = sorted(fs_operations.all_local_files(dl_dir))
-    dups = fs_operations.find_duplicates(files)
-    for dup in dups:
-        os.remove(dup)
-        try:
-            # abbrev folder; may not be empty if we combined archive.org and gii
-            os.rmdir(dirname(dup))
-            # Date folder
-            os.rmdir(dirname(dirname(dup)))
-        except OSError:
-            # Folder was not empty
-            pass
-    print("Removed {} duplicates leaving {} unique files.".format(len(dups), len(files) - len(dups)))
+    citations = () if args.no_proceedings else bgbl.local_citations(dl_dir)
+    years = range(args.from_year, (args.to_year or date.today().year) + 1)
+    n_years, n_proceedings = bgbl.build_index(
+        dl_dir, years, parts=args.parts, citations=citations, refresh=args.refresh, max_workers=args.workers
+    )
+    print("Fetched the issues of {} years and the proceedings of {} new citations.".format(n_years, n_proceedings))
+
+
+def do_search(args):
+    from librelaws import index
+
+    dl_dir = args.__getattribute__('download-dir')
+    if not index.index_exists(dl_dir):
+        raise ValueError("No index found in {}. Run the `index` subcommand first.".format(dl_dir))
+    conn = index.open_index(dl_dir)
+    try:
+        hits = index.search(conn, args.phrase, as_of=args.as_of, limit=args.limit)
+    finally:
+        conn.close()
+    for (abbrev, label, _, valid_from, valid_to, snippet) in hits:
+        print("{} {} [{} - {}]: {}".format(abbrev, label, valid_from, valid_to or '', snippet))
+
+
+def do_show(args):
+    from lxml import etree
+
+    from librelaws import conversion, index, xml_operations
+
+    dl_dir = args.__getattribute__('download-dir')
+    if not index.index_exists(dl_dir):
+        raise ValueError("No index found in {}. Run the `index` subcommand first.".format(dl_dir))
+    as_of = args.as_of or date.today()
+    lookup = index.VersionLookup(dl_dir)
+    try:
+        if args.norm is not None:
+            print(lookup.norm_at(args.abbrev, as_of, args.norm))
+            return
+        xml = lookup.xml_at(args.abbrev, as_of)
+    finally:
+        lookup.close()
+    if args.format == 'xml':
+        print(etree.tostring(xml, encoding='unicode'))
+        return
+    html = xml_operations.transform_gii_xml_to_html(xml)
+    if args.format == 'html':
+        print(etree.tostring(html, encoding='unicode'))
+    else:
+        print(conversion.html_to_markdown(html))
+
+
+def do_watch(args):
+    from librelaws import bgbl, git, sync
+
+    dl_dir = args.__getattribute__('download-dir')
+    bgbl_index = bgbl.load_index(dl_dir)
+
+    def on_update(files):
+        print("{}: {} new files were downloaded".format(datetime.now().isoformat(), len(files)))
+        files = verify_downloads(dl_dir, files)
+        update_existing_index(dl_dir, files)
+        if args.feed_dir is not None:
+            update_feed(dl_dir, args.feed_dir)
+        if args.git_dir is not None:
+            n = git.build_history(files, args.git_dir, bgbl_index=bgbl_index)
+            print("Created {} commits".format(n))
+
+    watcher = sync.GiiWatcher(
+        dl_dir, sweep_interval=args.sweep_interval, max_workers=args.workers, on_update=on_update
+    )
+    watcher.run(interval=args.interval, max_polls=args.max_polls)
+
+
+def do_coordinator(args):
+    from librelaws import distributed
+
+    dl_dir = args.__getattribute__('download-dir')
+    git_dir = args.__getattribute__('git-dir')
+    if os.path.abspath(os.path.expanduser(dl_dir)) == os.path.abspath(os.path.expanduser(git_dir)):
+        raise ValueError("`git-dir` must not be `download-dir`")
+    summary = distributed.coordinate(
+        args.__getattribute__('queue-file'), dl_dir, git_dir, stages=args.stages, shard_dir=args.shard_dir,
+        local_workers=args.local_workers, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts
+    )
+    for stage in args.stages:
+        print("{}: {} failed tasks".format(stage, summary.get(stage, 0)))
+    if 'commits' in summary:
+        print("Created {} commits.".format(summary['commits']))
+
+
+def do_worker(args):
+    from librelaws import distributed
+
+    n = distributed.run_worker(
+        args.__getattribute__('queue-file'), os.path.abspath(os.path.expanduser(args.__getattribute__('download-dir'))),
+        name=args.name, idle_timeout=args.idle_timeout
+    )
+    print("Completed {} tasks.".format(n))
+
+
+def do_generate(args):
+    from librelaws import synthetic
+
+    dl_dir = args.__getattribute__('download-dir')
+    stats = synthetic.generate_corpus(
+        dl_dir, args.__getattribute__('seed-xml'), n_laws=args.laws, versions=args.versions,
+        n_norms=args.norms, change_rate=args.change_rate, churn_rate=args.churn_rate,
+        laws_per_act=args.laws_per_act, rng_seed=args.rng_seed,
+    )
+    print("Generated {laws} laws with {versions} versions and {duplicates} builddate-only duplicates.".format(**stats))
@@ -1,7 +1,10 @@
 import pypandoc
 from lxml import etree
 
+from librelaws import metrics
 
+
+@metrics.timed('html_to_markdown')
 def html_to_markdown(html):
     html = etree.tostring(html, encoding='unicode')
     return pypandoc.convert_text(html, to='markdown_github', format='html')
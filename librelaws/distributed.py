@@ -0,0 +1,415 @@
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+from collections import defaultdict, namedtuple
+from os import path
+
+from . import bgbl, fs_operations, gazette, git, metrics, online_lookups
+from .stages import STAGES
+from .xml_operations import zip_to_xml
+
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    -- One of 'queued', 'leased', 'done' or 'failed'
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    -- Unix time at which the lease of `worker` expires
+    lease_until REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, kind);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+Task = namedtuple('Task', ['id', 'kind', 'payload', 'attempts'])
+
+# Settings of a queue which are stored in its `meta` table, with their defaults
+SETTINGS = {'lease_seconds': 300, 'max_attempts': 3}
+
+
+class WorkQueue:
+    """
+    A task queue in a SQLite database which may be shared by processes
+    on several machines (eg. on a network file system which supports
+    file locks).
+
+    Workers `lease` tasks for `lease_seconds`. A task is `ack`ed with its
+    result or `fail`ed with an error, in which case it is queued again
+    until it failed `max_attempts` times. Tasks whose lease expired, eg.
+    because their worker died, can be leased by other workers until
+    they used up their attempts as well.
+
+    The settings are stored in the queue, so the workers use those the
+    coordinator opened the queue with.
+
+    Parameters
+    ----------
+    fname: str
+        Path of the database; created if it does not exist
+    lease_seconds: float
+        Time a worker has to finish a leased task; None keeps the stored setting
+    max_attempts: int
+        Number of attempts after which a task is marked as failed; None keeps the stored setting
+    """
+    def __init__(self, fname, lease_seconds=None, max_attempts=None):
+        self.fname = fname
+        # Transactions are managed explicitly
+        self.conn = sqlite3.connect(fname, timeout=60, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.executescript(QUEUE_SCHEMA)
+        settings = {'lease_seconds': lease_seconds, 'max_attempts': max_attempts}
+        settings = [(k, json.dumps(v)) for (k, v) in settings.items() if v is not None]
+        if settings:
+            with self.conn:
+                self.conn.execute('BEGIN IMMEDIATE')
+                self.conn.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', settings)
+        self._load_settings()
+
+    def _load_settings(self):
+        stored = dict(self.conn.execute(
+            'SELECT key, value FROM meta WHERE key IN ({})'.format(', '.join('?' * len(SETTINGS))), list(SETTINGS)
+        ))
+        for (key, default) in SETTINGS.items():
+            setattr(self, key, json.loads(stored[key]) if key in stored else default)
+
+    def close(self):
+        self.conn.close()
+
+    def reset(self):
+        """Drop all tasks and reopen the queue; the settings are kept"""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute('DELETE FROM tasks')
+            self.conn.execute("DELETE FROM meta WHERE key = 'closed'")
+
+    def put(self, kind, payloads):
+        """Queue a task of `kind` for each of the json serializable `payloads`"""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            n = self.conn.executemany(
+                'INSERT INTO tasks (kind, payload) VALUES (?, ?)', ((kind, json.dumps(p)) for p in payloads)
+            ).rowcount
+        metrics.inc('librelaws_tasks_total', n, kind=kind, event='queued')
+        return n
+
+    def lease(self, worker, kinds=None):
+        """
+        Lease the oldest queued task, or one whose lease expired. Tasks
+        whose lease expired in their last attempt (eg. because they kill
+        their worker) are marked as failed instead.
+
+        Parameters
+        ----------
+        worker: str
+            Name of the leasing worker
+        kinds: list
+            Only lease tasks of these kinds
+
+        Return
+        ------
+        Task or None: None if there is nothing to do right now
+        """
+        now = time.time()
+        query = ("SELECT id, kind, payload, attempts FROM tasks "
+                 "WHERE (status = 'queued' OR (status = 'leased' AND lease_until < ?))")
+        params = [now]
+        if kinds:
+            query += ' AND kind IN ({})'.format(', '.join('?' * len(kinds)))
+            params.extend(kinds)
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self._load_settings()
+            expired = self.conn.execute(
+                "SELECT id, kind, worker FROM tasks WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts)
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE tasks SET status = 'failed', error = ?, lease_until = NULL WHERE id = ?",
+                [('Lease of {} expired in the last attempt'.format(w), task_id) for (task_id, _, w) in expired]
+            )
+            row = self.conn.execute(query + ' ORDER BY id LIMIT 1', params).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                    "WHERE id = ?", (worker, now + self.lease_seconds, row[0])
+                )
+        for (_, kind, _) in expired:
+            metrics.inc('librelaws_tasks_total', kind=kind, event='failed')
+        if row is None:
+            return None
+        metrics.inc('librelaws_tasks_total', kind=row[1], event='leased')
+        return Task(row[0], row[1], json.loads(row[2]), row[3] + 1)
+
+    def ack(self, task, worker, result=None):
+        """
+        Store the `result` of a leased task and mark it as done
+
+        Return
+        ------
+        bool: False if the lease was lost to another worker in the meantime
+        """
+        with self.conn:
+            n = self.conn.execute(
+                "UPDATE tasks SET status = 'done', result = ?, lease_until = NULL "
+                "WHERE id = ? AND status = 'leased' AND worker = ?", (json.dumps(result), task.id, worker)
+            ).rowcount
+        metrics.inc('librelaws_tasks_total', kind=task.kind, event='done' if n else 'lost')
+        return bool(n)
+
+    def fail(self, task, worker, error):
+        """Release a leased task after an `error`; it is retried unless it ran out of attempts"""
+        status = 'failed' if task.attempts >= self.max_attempts else 'queued'
+        with self.conn:
+            self.conn.execute(
+                "UPDATE tasks SET status = ?, error = ?, lease_until = NULL "
+                "WHERE id = ? AND status = 'leased' AND worker = ?", (status, error, task.id, worker)
+            )
+        metrics.inc('librelaws_tasks_total', kind=task.kind, event='failed' if status == 'failed' else 'retried')
+
+    def counts(self, kind=None):
+        """
+        Return
+        ------
+        dict: {status: number of tasks}
+        """
+        query = 'SELECT status, count(*) FROM tasks'
+        params = ()
+        if kind is not None:
+            query += ' WHERE kind = ?'
+            params = (kind, )
+        return dict(self.conn.execute(query + ' GROUP BY status', params).fetchall())
+
+    def results(self, kind):
+        """
+        Return
+        ------
+        list of tuple: [(payload, result)] of all done tasks of `kind`
+        """
+        rows = self.conn.execute(
+            "SELECT payload, result FROM tasks WHERE kind = ? AND status = 'done' ORDER BY id", (kind, )
+        )
+        return [(json.loads(p), json.loads(r)) for (p, r) in rows]
+
+    def errors(self, kind=None):
+        """
+        Return
+        ------
+        list of tuple: [(payload, error)] of the failed tasks
+        """
+        query = "SELECT payload, error FROM tasks WHERE status = 'failed'"
+        params = ()
+        if kind is not None:
+            query += ' AND kind = ?'
+            params = (kind, )
+        return [(json.loads(p), e) for (p, e) in self.conn.execute(query, params)]
+
+    def wait(self, kind, poll_interval=1):
+        """Block until no task of `kind` is queued or leased any more"""
+        while True:
+            counts = self.counts(kind)
+            metrics.set_gauge('librelaws_queue_depth', counts.get('queued', 0), queue=kind)
+            if not counts.get('queued') and not counts.get('leased'):
+                return
+            time.sleep(poll_interval)
+
+    def close_queue(self):
+        """Tell the workers that no more tasks will be queued"""
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('closed', '1')")
+
+    def is_closed(self):
+        return self.conn.execute("SELECT value FROM meta WHERE key = 'closed'").fetchone() is not None
+
+
+def _download(dl_dir, payload):
+    f = online_lookups.download_gii_if_non_existing(dl_dir, payload['url'], etag=payload.get('etag'))
+    return path.relpath(f, dl_dir) if f is not None else None
+
+
+def _fingerprint(dl_dir, payload):
+    return fs_operations.hash_without_builddate(zip_to_xml(path.join(dl_dir, payload['path'])))
+
+
+@functools.lru_cache(maxsize=None)
+def _bgbl_index(dl_dir):
+    """The BGBl index of `dl_dir`, loaded once per worker process"""
+    return bgbl.load_index(dl_dir)
+
+
+@functools.lru_cache(maxsize=None)
+def _gazettes(dl_dir):
+    """The gazette index of this worker, so the issue index of each year is fetched once per process"""
+    return gazette.GazetteIndex(local=_bgbl_index(dl_dir))
+
+
+def _augment(dl_dir, payload):
+    cit = git.file_citation(path.join(dl_dir, payload['path']), _gazettes(dl_dir))
+    if cit is None:
+        return None
+    html = git.known_proceedings(_bgbl_index(dl_dir), cit)
+    if html is None:
+        html = online_lookups.search_bundestag_dip(cit.gazette, cit.year, cit.page)
+    return html.decode('utf-8') if html is not None else None
+
+
+def _render(dl_dir, payload):
+    lookups = {path.join(dl_dir, f): html for (f, html) in payload['lookups'].items()}
+    return git._build_shard(
+        payload['abbrev'], list(lookups), payload['shard_dir'], lookups=lookups, gazettes=_gazettes(dl_dir)
+    )
+
+
+# Task handlers by kind. Each is called with the `download-dir` and the
+# task's payload and returns the json serializable result. Paths in
+# payloads and results are relative to `download-dir`, so the machines
+# may mount the shared directory at different places.
+HANDLERS = {
+    'download': _download,
+    'fingerprint': _fingerprint,
+    'augment': _augment,
+    'render': _render,
+}
+
+
+def run_worker(queue_file, dl_dir, name=None, idle_timeout=None, poll_interval=1):
+    """
+    Lease and run tasks until the coordinator closed the queue and no
+    work is left, or nothing was leased for `idle_timeout` seconds.
+
+    Return
+    ------
+    int: Number of completed tasks
+    """
+    name = name or '{}-{}'.format(socket.gethostname(), os.getpid())
+    queue = WorkQueue(queue_file)
+    done = 0
+    idle_since = time.time()
+    try:
+        while True:
+            task = queue.lease(name)
+            if task is None:
+                if queue.is_closed() and not queue.counts().get('queued') and not queue.counts().get('leased'):
+                    break
+                if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                    break
+                time.sleep(poll_interval)
+                continue
+            try:
+                with metrics.timer('task_{}'.format(task.kind)):
+                    result = HANDLERS[task.kind](dl_dir, task.payload)
+            except Exception as exc:
+                logging.warning("Task %s (%s) failed: %r", task.id, task.kind, exc)
+                queue.fail(task, name, repr(exc))
+            else:
+                done += queue.ack(task, name, result)
+            idle_since = time.time()
+    finally:
+        queue.close()
+    return done
+
+
+def _local_worker(queue_file, dl_dir, poll_interval):
+    run_worker(queue_file, dl_dir, poll_interval=poll_interval)
+
+
+def coordinate(queue_file, dl_dir, git_dir, stages=STAGES, shard_dir=None, local_workers=0, poll_interval=1,
+               **queue_args):
+    """
+    Run a full rebuild as tasks of a `WorkQueue`. The coordinator queues
+    the tasks of one stage after the other and waits for the workers
+    (see `run_worker`) to finish each stage before queueing the next:
+
+    * `download`: the latest version of each law from gii
+    * `fingerprint`: hash of each local file without its builddate
+    * `augment`: BIP lookup for each distinct version
+    * `render`: history of each law in its own shard (see `git.build_shards`)
+
+    Finally the shards are merged into the history of `git_dir`. The
+    queue is reset when the coordinator starts.
+
+    Parameters
+    ----------
+    stages: list
+        Stages to run; the others are skipped
+    shard_dir: str
+        Shared directory for the shards; defaults to `.git/shards` in `git_dir`
+    local_workers: int
+        Number of worker processes to start on this machine
+    queue_args:
+        Passed on to `WorkQueue`
+
+    Return
+    ------
+    dict: {stage: number of failed tasks}, and the number of created commits under 'commits'
+    """
+    dl_dir = path.abspath(path.expanduser(dl_dir))
+    queue = WorkQueue(queue_file, **queue_args)
+    queue.reset()
+    workers = [
+        multiprocessing.Process(target=_local_worker, args=(queue_file, dl_dir, poll_interval))
+        for _ in range(local_workers)
+    ]
+    for w in workers:
+        w.start()
+    summary = {}
+
+    def run_stage(kind, payloads):
+        queue.put(kind, payloads)
+        queue.wait(kind, poll_interval)
+        summary[kind] = len(queue.errors(kind))
+
+    try:
+        if 'download' in stages:
+            etags = online_lookups.get_dict_folder_etag(dl_dir)
+            run_stage('download', (
+                {'url': url, 'etag': etags.get(path.basename(path.dirname(url)))}
+                for url in online_lookups.get_links_gii()
+            ))
+        files = sorted(path.relpath(f, dl_dir) for f in fs_operations.iter_local_files(dl_dir))
+        if 'fingerprint' in stages:
+            run_stage('fingerprint', ({'path': f} for f in files))
+            # Only the oldest of several copies of the same version is kept
+            seen = set()
+            unique = []
+            for (payload, digest) in sorted(queue.results('fingerprint'), key=lambda r: r[0]['path']):
+                if digest not in seen:
+                    seen.add(digest)
+                    unique.append(payload['path'])
+            files = unique
+        lookups = {f: None for f in files}
+        if 'augment' in stages:
+            run_stage('augment', ({'path': f} for f in files))
+            lookups.update(
+                (payload['path'], html) for (payload, html) in queue.results('augment') if payload['path'] in lookups
+            )
+        if 'render' in stages:
+            shard_dir = path.abspath(shard_dir or git.default_shard_dir(git_dir))
+            os.makedirs(shard_dir, exist_ok=True)
+            by_law = defaultdict(dict)
+            for (f, html) in lookups.items():
+                by_law[path.basename(path.dirname(f))][f] = html
+            run_stage('render', (
+                {'abbrev': abbrev, 'lookups': law_lookups, 'shard_dir': shard_dir}
+                for (abbrev, law_lookups) in sorted(by_law.items())
+            ))
+            summary['commits'] = git.merge_shards(shard_dir, git_dir)
+    finally:
+        queue.close_queue()
+        queue.close()
+        for w in workers:
+            w.join()
+    return summary
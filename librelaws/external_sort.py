@@ -0,0 +1,112 @@
+import heapq
+import json
+import os
+import shutil
+import tempfile
+
+
+def _read_run(fname):
+    with open(fname) as f:
+        for line in f:
+            yield json.loads(line)
+    os.remove(fname)
+
+
+class ExternalSorter:
+    """
+    Sort records while keeping at most `chunk_size` of them in memory.
+
+    Records are `add`ed one by one. Sorted runs of `chunk_size` records
+    are spilled to temporary files. As soon as `fan_in` runs of the same
+    length have piled up, they are merged into one longer run, so there
+    are never more than `fan_in` runs per order of magnitude of the
+    input. The remaining runs are lazily merged when iterating over the
+    sorter. Records must be json
+    serializable and come back as they are returned from json (ie.
+    tuples become lists).
+
+    Parameters
+    ----------
+    key: callable
+        Sort key, as for `sorted`
+    chunk_size: int
+        Maximum number of records held in memory while spilling
+    fan_in: int
+        Maximum number of runs merged at once
+    tmp_dir: str
+        Where to put the runs; defaults to the system's temp directory
+    """
+    def __init__(self, key, chunk_size=10000, fan_in=256, tmp_dir=None):
+        self.key = key
+        self.chunk_size = chunk_size
+        self.fan_in = fan_in
+        self.run_dir = tempfile.mkdtemp(dir=tmp_dir, prefix='librelaws-sort-')
+        # [(level, fname)] where runs of level `l` hold `chunk_size * fan_in**l` records
+        self.runs = []
+        self.chunk = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Delete all spilled runs"""
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def _write_run(self, records):
+        fd, fname = tempfile.mkstemp(suffix='.jsonl', dir=self.run_dir)
+        with os.fdopen(fd, 'w') as f:
+            for r in records:
+                f.write(json.dumps(r))
+                f.write('\n')
+        return fname
+
+    def _merge_runs(self, fnames):
+        return self._write_run(heapq.merge(*[_read_run(fn) for fn in fnames], key=self.key))
+
+    def _spill(self):
+        self.runs.append((0, self._write_run(sorted(self.chunk, key=self.key))))
+        self.chunk = []
+        # Cascade: merge `fan_in` runs of the same level into one of the next level
+        while len(self.runs) >= self.fan_in and len({lvl for (lvl, _) in self.runs[-self.fan_in:]}) == 1:
+            level = self.runs[-1][0]
+            merged = self._merge_runs([fn for (_, fn) in self.runs[-self.fan_in:]])
+            del self.runs[-self.fan_in:]
+            self.runs.append((level + 1, merged))
+
+    def add(self, record):
+        self.chunk.append(record)
+        if len(self.chunk) >= self.chunk_size:
+            self._spill()
+
+    def __iter__(self):
+        if not self.runs:
+            # Everything fit into memory
+            chunk, self.chunk = self.chunk, []
+            for r in sorted(json.loads(json.dumps(chunk)), key=self.key):
+                yield r
+            return
+        if self.chunk:
+            self._spill()
+        runs, self.runs = [fn for (_, fn) in self.runs], []
+        while len(runs) > self.fan_in:
+            runs = [self._merge_runs(runs[i:i + self.fan_in]) for i in range(0, len(runs), self.fan_in)]
+        for r in heapq.merge(*[_read_run(fn) for fn in runs], key=self.key):
+            yield r
+
+
+def sorted_records(records, key, chunk_size=10000, fan_in=256, tmp_dir=None):
+    """
+    Lazily sort the iterable `records` with bounded memory; see `ExternalSorter`
+
+    Yield
+    -----
+    The records in sorted order
+    """
+    with ExternalSorter(key, chunk_size=chunk_size, fan_in=fan_in, tmp_dir=tmp_dir) as sorter:
+        for r in records:
+            sorter.add(r)
+        for r in sorter:
+            yield r
@@ -0,0 +1,255 @@
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+from os import path
+
+from lxml import etree
+
+from . import index, metrics
+from .gazette import BGBL_PARTS
+from .lazy import lazy_import
+from .xml_operations import zip_to_xml, extract_long_name
+
+bgbl = lazy_import('librelaws.bgbl')
+online_lookups = lazy_import('librelaws.online_lookups')
+requests = lazy_import('requests')
+
+
+JSONL_FILE = 'changes.jsonl'
+ATOM_FILE = 'changes.atom'
+
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+
+# Name of the feed's cursor in the version index
+CURSOR = 'feed'
+
+
+def read_cursor(conn, name=CURSOR):
+    """The id of the last version the feed `name` has seen; None if it has not run yet"""
+    row = conn.execute('SELECT version_id FROM cursors WHERE name = ?', (name, )).fetchone()
+    return None if row is None else row[0]
+
+
+def write_cursor(conn, version_id, name=CURSOR):
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO cursors (name, version_id) VALUES (?, ?)', (name, version_id))
+
+
+def changed_norms(conn, version_id, abbrev, valid_from, downloaded, rel_path):
+    """
+    Labels of the norms which were added, removed or whose text changed
+    compared to the preceding version of the same law. The texts are
+    compared by their ids in the index, so no text is read.
+
+    Return
+    ------
+    list of str: Sorted labels
+    """
+    previous = conn.execute(
+        'SELECT id FROM versions WHERE abbrev = ? AND (valid_from, downloaded, path) < (?, ?, ?) '
+        'ORDER BY valid_from DESC, downloaded DESC, path DESC LIMIT 1',
+        (abbrev, valid_from, downloaded, rel_path)
+    ).fetchone()
+    query = 'SELECT label, text_id FROM norms WHERE version_id = ?'
+    new = set(conn.execute(query, (version_id, )))
+    old = set(conn.execute(query, (previous[0], ))) if previous is not None else set()
+    return sorted({label for (label, _) in new ^ old})
+
+
+def proceedings_url(html):
+    """Link to the proceedings at the BIP found in the `html` of `online_lookups.search_bundestag_dip`"""
+    vorgang = bgbl.proceedings_id(html)
+    if vorgang < 0:
+        return None
+    return '{}dip21.web/searchProcedures/simple_search_detail_vp.do?vorgangId={}'.format(
+        online_lookups.service_root('dip'), vorgang
+    )
+
+
+def _proceedings(record, bgbl_index=None, lookup=True):
+    part = BGBL_PARTS.get(record['gazette'])
+    if part is None or record['page'] is None:
+        return None
+    key = (part, record['year'], record['page'])
+    if bgbl_index is not None and bgbl_index.has_proceedings(*key):
+        metrics.inc('librelaws_cache_requests_total', cache='bgbl_index', result='hit')
+        return proceedings_url(bgbl_index.proceedings(*key))
+    if not lookup:
+        return None
+    metrics.inc('librelaws_cache_requests_total', cache='bgbl_index', result='miss')
+    try:
+        html = online_lookups.search_bundestag_dip(record['gazette'], record['year'], record['page'])
+    except requests.exceptions.RequestException as exc:
+        logging.warning("Could not look up the proceedings of %s: %r", key, exc)
+        return None
+    return proceedings_url(html)
+
+
+def _long_name(f):
+    return extract_long_name(zip_to_xml(f))
+
+
+def new_records(conn, dl_dir, after, bgbl_index=None, lookup=True, max_workers=None):
+    """
+    The feed records of all versions indexed after the version id
+    `after`, in the order they were indexed
+
+    Parameters
+    ----------
+    bgbl_index: bgbl.BgblIndex
+        Proceedings found in the index are not looked up again
+    lookup: bool
+        Search the BIP for proceedings which are not in `bgbl_index`
+
+    Return
+    ------
+    list of dict: With keys 'id', 'path', 'abbrev', 'long_name', 'downloaded',
+    'valid_from', 'citation', 'changed_norms' and 'proceedings'
+    """
+    rows = conn.execute(
+        'SELECT id, path, abbrev, downloaded, valid_from, gazette, year, page, cited '
+        'FROM versions WHERE id > ? ORDER BY id', (after, )
+    ).fetchall()
+    if not rows:
+        return []
+    records = []
+    for (version_id, rp, abbrev, downloaded, valid_from, gazette_name, year, page, cited) in rows:
+        records.append({
+            'id': version_id, 'path': rp, 'abbrev': abbrev, 'downloaded': downloaded, 'valid_from': valid_from,
+            'citation': None if gazette_name is None else {
+                'gazette': gazette_name, 'year': year, 'page': page, 'date': cited
+            },
+            'changed_norms': changed_norms(conn, version_id, abbrev, valid_from, downloaded, rp),
+        })
+    files = [path.join(dl_dir, r['path']) for r in records]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        names = executor.map(functools.partial(metrics.collecting, _long_name), files, chunksize=8)
+        for (r, (name, snapshot)) in zip(records, names):
+            metrics.merge(snapshot)
+            r['long_name'] = name
+    cits = [r['citation'] or {'gazette': None, 'year': None, 'page': None} for r in records]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        func = functools.partial(_proceedings, bgbl_index=bgbl_index, lookup=lookup)
+        for (r, url) in zip(records, executor.map(func, cits)):
+            r['proceedings'] = url
+    return records
+
+
+def _atom(tag):
+    return '{{{}}}{}'.format(ATOM_NS, tag)
+
+
+def _atom_entry(record):
+    entry = etree.Element(_atom('entry'))
+    etree.SubElement(entry, _atom('id')).text = 'urn:librelaws:version:{}'.format(record['path'])
+    etree.SubElement(entry, _atom('title')).text = '{}: {}'.format(record['abbrev'], record['long_name'])
+    etree.SubElement(entry, _atom('updated')).text = '{}T00:00:00Z'.format(record['valid_from'])
+    etree.SubElement(
+        entry, _atom('link'), rel='alternate', href='{}{}/'.format(online_lookups.service_root('gii'), record['abbrev'])
+    )
+    if record['proceedings'] is not None:
+        etree.SubElement(entry, _atom('link'), rel='related', href=record['proceedings'])
+    cit = record['citation']
+    summary = 'Geänderte Normen: {}'.format(', '.join(record['changed_norms']) or '-')
+    if cit is not None:
+        summary = '{} {}, {}. {}'.format(cit['gazette'], cit['year'], cit['page'], summary)
+    etree.SubElement(entry, _atom('summary')).text = summary
+    # Atom only allows text, html or xhtml inline; other media types would have to be Base64 encoded
+    etree.SubElement(entry, _atom('content'), type='text').text = json.dumps(record, ensure_ascii=False)
+    return entry
+
+
+def atom_feed(fname, records, max_entries=500):
+    """
+    The Atom feed `fname` (empty if it does not exist) with the
+    `records` prepended, keeping only the latest `max_entries` entries
+
+    Return
+    ------
+    lxml.etree._ElementTree
+    """
+    feed = etree.Element(_atom('feed'), nsmap={None: ATOM_NS})
+    etree.SubElement(feed, _atom('id')).text = 'urn:librelaws:changes'
+    etree.SubElement(feed, _atom('title')).text = 'librelaws: Neue Gesetzesfassungen'
+    etree.SubElement(feed, _atom('updated')).text = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    etree.SubElement(etree.SubElement(feed, _atom('author')), _atom('name')).text = 'librelaws'
+    etree.SubElement(feed, _atom('link'), rel='alternate', href=online_lookups.service_root('gii'))
+    # Newest first
+    for record in reversed(records):
+        feed.append(_atom_entry(record))
+    if path.exists(fname):
+        old = etree.parse(fname, etree.XMLParser(remove_blank_text=True)).getroot()
+        for entry in old.findall(_atom('entry')):
+            # Entries of older releases had json content
+            for content in entry.findall(_atom('content')):
+                content.set('type', 'text')
+            feed.append(entry)
+    for entry in feed.findall(_atom('entry'))[max_entries:]:
+        feed.remove(entry)
+    return etree.ElementTree(feed)
+
+
+def update_feed(dl_dir, feed_dir, bgbl_index=None, lookup=True, max_entries=500, max_workers=None, full=False):
+    """
+    Append the versions indexed since the last run to the change feed
+    in `feed_dir`: one json record per line to `changes.jsonl` and an
+    entry to the Atom feed `changes.atom`. The position is kept in a
+    cursor in the version index, so only the new versions are read.
+
+    Both files are written in full next to the old ones and only then
+    moved into place, and the cursor moves after that. A run which
+    fails leaves the feed as it was; the next run picks up the same
+    versions.
+
+    Parameters
+    ----------
+    full: bool
+        On the first run, add all indexed versions, without searching
+        the BIP for them. Otherwise the first run only places the
+        cursor after the latest version, so the feed starts with the
+        versions indexed after it.
+
+    Raises
+    ------
+    ValueError: If `dl_dir` has no version index
+
+    Return
+    ------
+    int: Number of new records
+    """
+    dl_dir = path.expanduser(dl_dir)
+    if not index.index_exists(dl_dir):
+        raise ValueError("No index found in {}. Run the `index` subcommand first.".format(dl_dir))
+    os.makedirs(feed_dir, exist_ok=True)
+    conn = index.open_index(dl_dir)
+    try:
+        after = read_cursor(conn)
+        if after is None:
+            if not full:
+                write_cursor(conn, conn.execute('SELECT coalesce(max(id), 0) FROM versions').fetchone()[0])
+                return 0
+            # A search per version of the whole corpus would take hours
+            after, lookup = 0, False
+        records = new_records(conn, dl_dir, after, bgbl_index=bgbl_index, lookup=lookup, max_workers=max_workers)
+        if not records:
+            return 0
+        jsonl, atom = path.join(feed_dir, JSONL_FILE), path.join(feed_dir, ATOM_FILE)
+        with open(jsonl + '.tmp', 'w', encoding='utf-8') as f:
+            if path.exists(jsonl):
+                with open(jsonl, encoding='utf-8') as old:
+                    shutil.copyfileobj(old, f)
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        atom_feed(atom, records, max_entries=max_entries).write(
+            atom + '.tmp', xml_declaration=True, encoding='utf-8', pretty_print=True
+        )
+        os.replace(jsonl + '.tmp', jsonl)
+        os.replace(atom + '.tmp', atom)
+        write_cursor(conn, records[-1]['id'])
+    finally:
+        conn.close()
+    return len(records)
@@ -1,8 +1,13 @@
+import concurrent.futures
+import functools
+import hashlib
+import os
 from os import path
 from glob import glob
 
 from lxml import etree
 
+from . import metrics
 from .xml_operations import zip_to_xml
 
 
@@ -23,6 +28,23 @@ def all_local_files(dl_dir):
     return sorted(all_files)
 
 
+def iter_local_files(dl_dir):
+    """
+    Lazily iterate over the paths of all locally cached files in no
+    particular order. Unlike `all_local_files`, the memory needed does not
+    grow with the number of files. Hidden folders are skipped.
+    """
+    def walk(folder):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.'):
+                        yield from walk(entry.path)
+                elif entry.name.endswith('.zip'):
+                    yield entry.path
+    return walk(path.expanduser(dl_dir))
+
+
 def local_versions(dl_dir, uri):
     """
     Find the local zip-files related to the given a Uri (Url or local path)
@@ -64,9 +86,15 @@ def version_exists_locally(dl_dir, response):
     return False
 
 
+@metrics.timed('hash_without_builddate')
 def hash_without_builddate(xml):
     """
-    Compute a hash for the given xml excluding the builddate attribute
+    Compute a hash for the given xml excluding the builddate attribute.
+    The hash is stable across processes and machines.
+
+    Return
+    ------
+    str: Hex digest
     """
     xsl = etree.XML(b"""<?xml version="1.0" encoding="UTF-8"?>
 <xsl:stylesheet xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0">
@@ -83,7 +111,65 @@ def hash_without_builddate(xml):
 </xsl:stylesheet>
 """)
     transform = etree.XSLT(xsl)
-    return hash(etree.tostring(transform(xml)))
+    return hashlib.sha256(etree.tostring(transform(xml))).hexdigest()
+
+def fingerprint(f):
+    """The `hash_without_builddate` of the zipped xml file `f`"""
+    return hash_without_builddate(zip_to_xml(f))
+
+
+def fingerprint_files(files, max_workers=None):
+    """
+    Compute the `fingerprint` of each of the `files` in worker processes
+
+    Return
+    ------
+    dict: {filepath: fingerprint}
+    """
+    files = list(files)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(functools.partial(metrics.collecting, fingerprint), files, chunksize=16)
+        fingerprints = {}
+        for (f, (digest, snapshot)) in zip(files, results):
+            metrics.merge(snapshot)
+            fingerprints[f] = digest
+    return fingerprints
+
+
+# ioctl request to share the extents of a file (Linux `FICLONE`)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def replace_with_link(dup, original, strategy='hardlink'):
+    """
+    Replace the file `dup` by a hardlink or a reflink (copy-on-write
+    clone) of `original`, so that it takes no space of its own but can
+    still be read at its path. The replacement is atomic.
+
+    Raises
+    ------
+    OSError: If the file system does not support the link, eg. reflinks
+        outside of btrfs or xfs, or hardlinks across devices
+    """
+    tmp = dup + '.librelaws-tmp'
+    try:
+        if strategy == 'hardlink':
+            os.link(original, tmp)
+        elif strategy == 'reflink':
+            _reflink(original, tmp)
+        else:
+            raise ValueError("Unknown link strategy: {}".format(strategy))
+        os.replace(tmp, dup)
+    finally:
+        if path.exists(tmp):
+            os.remove(tmp)
+
 
 def find_duplicates(files):
     """
@@ -0,0 +1,127 @@
+import concurrent.futures
+import logging
+from bisect import bisect_right
+from datetime import datetime
+
+from .lazy import lazy_import
+
+online_lookups = lazy_import('librelaws.online_lookups')
+requests = lazy_import('requests')
+
+
+# Part of the BGBl for the gazettes of `Citation`
+BGBL_PARTS = {'BGBl I': 1, 'BGBl II': 2}
+
+
+def _has_date(citation):
+    return citation.month is not None and citation.day is not None
+
+
+class GazetteIndex:
+    """
+    Publication dates of the BGBl by page. The issue index of each part
+    and year is fetched from api.offenegesetze.de once and compiled
+    into a page -> date interval table, so any number of citations of
+    that year are resolved locally by bisection.
+
+    Parameters
+    ----------
+    session: requests.Session
+        Session used for all requests; a new one is created when needed
+    max_workers: int
+        Number of years fetched concurrently
+    local: bgbl.BgblIndex
+        Persisted index; only years it does not cover are fetched
+    """
+    def __init__(self, session=None, max_workers=8, local=None):
+        self.session = session
+        self.max_workers = max_workers
+        self.local = local
+        # {(part, year): (first pages, end pages, dates)}; None if the year could not be fetched
+        self._tables = {}
+
+    def add_issues(self, part, year, issues):
+        """Compile the `issues` as returned by `online_lookups.fetch_bgbl_issues`"""
+        issues = sorted(issues, key=lambda i: i['page'])
+        self._tables[(part, year)] = (
+            [i['page'] for i in issues],
+            [i['page'] + i['num_pages'] for i in issues],
+            [datetime.strptime(i['date'], "%Y-%m-%dT%H:%M:%SZ").date() for i in issues],
+        )
+
+    def issues(self):
+        """
+        Yield
+        -----
+        tuple: (part, year, first page, end page, date) of all fetched issues
+        """
+        for ((part, year), table) in sorted(self._tables.items()):
+            if table is not None:
+                for (first, end, d) in zip(*table):
+                    yield part, year, first, end, d
+
+    def load(self, keys):
+        """Fetch the issue index of all (part, year) `keys` which are not known yet"""
+        missing = sorted(
+            k for k in set(keys) - set(self._tables) if self.local is None or not self.local.covers(*k)
+        )
+        if not missing:
+            return
+        if self.session is None:
+            self.session = requests.Session()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                key: executor.submit(online_lookups.fetch_bgbl_issues, key[0], key[1], session=self.session)
+                for key in missing
+            }
+            for (key, future) in futures.items():
+                try:
+                    self.add_issues(key[0], key[1], future.result())
+                except requests.exceptions.RequestException as exc:
+                    logging.warning("Could not fetch the BGBl index of %s: %r", key, exc)
+                    self._tables[key] = None
+
+    def date(self, part, year, page):
+        """
+        The publication date of the BGBl `part` of `year` containing `page`
+
+        Raises
+        ------
+        ValueError: If the page is not part of any known issue
+        """
+        if self.local is not None and self.local.covers(part, year):
+            return self.local.date(part, year, page)
+        self.load([(part, year)])
+        table = self._tables[(part, year)]
+        if table is None:
+            raise ValueError("No index of BGBl {} {}".format(part, year))
+        starts, ends, dates = table
+        i = bisect_right(starts, page) - 1
+        if i < 0 or not page < ends[i]:
+            raise ValueError("Page {} not found in BGBl {} {}".format(page, part, year))
+        return dates[i]
+
+    def resolve(self, citations):
+        """
+        Complete the month and day of all BGBl `citations` which only
+        have a year and page (eg. those from the `fundstelle` node). The
+        indexes of all years involved are fetched in one go.
+
+        Return
+        ------
+        int: Number of resolved citations
+        """
+        todo = [
+            c for c in citations
+            if c.gazette in BGBL_PARTS and c.page is not None and not _has_date(c)
+        ]
+        self.load({(BGBL_PARTS[c.gazette], c.year) for c in todo})
+        n = 0
+        for c in todo:
+            try:
+                d = self.date(BGBL_PARTS[c.gazette], c.year, c.page)
+            except ValueError:
+                continue
+            c.month, c.day = d.month, d.day
+            n += 1
+        return n
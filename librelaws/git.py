@@ -1,11 +1,21 @@
+from collections import deque, defaultdict
 from os import path
-from datetime import datetime, date
+import concurrent.futures
+import functools
+import heapq
+import os
+import shutil
 
-import pygit2
-import pypandoc
+from . import cabinets, gazette, metrics
+from .external_sort import ExternalSorter
+from .lazy import lazy_import
+from .xml_operations import zip_to_xml, transform_gii_xml_to_html, extract_long_name, Citation
 
-from .xml_operations import zip_to_xml, transform_gii_xml_to_html, extract_long_name
-from .conversion import html_to_markdown
+# Only loaded once a history is built
+pygit2 = lazy_import('pygit2')
+pypandoc = lazy_import('pypandoc')
+conversion = lazy_import('librelaws.conversion')
+online_lookups = lazy_import('librelaws.online_lookups')
 
 
 def cabinet_sig(at_date):
@@ -14,64 +24,34 @@ def cabinet_sig(at_date):
 
     Parameter
     ---------
-    at_date: datetime
-        Date used to look up the cabinet
-    """
-    # make sure we have a datetime
-    if isinstance(at_date, type(date.today())):
-        at_date = datetime(at_date.year, at_date.month, at_date.day)
-    dt = datetime
-    cabinets = [
-        ('Adenauer cabinet I', dt(day=20, month=9, year=1949), dt(day=20, month=10, year=1953), 'CDU/CSU, FDP, DP'),
-        ('Adenauer cabinet II', dt(day=20, month=10, year=1953), dt(day=29, month=10, year=1957), 'CDU/CSU, FDP, GB/BHE, DP'),
-        ('Adenauer cabinet III', dt(day=29, month=10, year=1957), dt(day=14, month=11, year=1961), 'CDU/CSU, DP'),
-        ('Adenauer cabinet IV', dt(day=14, month=11, year=1961), dt(day=14, month=12, year=1962), 'CDU/CSU, FDP'),
-        ('Adenauer cabinet V', dt(day=14, month=12, year=1962), dt(day=17, month=10, year=1963), 'CDU/CSU, FDP'),
-        ('Erhard cabinet I', dt(day=17, month=10, year=1963), dt(day=26, month=10, year=1965), 'CDU/CSU, FDP'),
-        ('Erhard cabinet II', dt(day=26, month=10, year=1965), dt(day=1, month=12, year=1966), 'CDU/CSU, FDP'),
-        ('Kiesinger cabinet', dt(day=1, month=12, year=1966), dt(day=22, month=10, year=1969), 'CDU/CSU, SPD'),
-        ('Brandt cabinet I', dt(day=22, month=10, year=1969), dt(day=15, month=12, year=1972), 'SPD, FDP'),
-        ('Brandt cabinet II', dt(day=15, month=12, year=1972), dt(day=17, month=5, year=1974), 'SPD, FDP'),
-        ('Schmidt cabinet I', dt(day=17, month=5, year=1974), dt(day=16, month=12, year=1976), 'SPD, FDP'),
-        ('Schmidt cabinet II', dt(day=16, month=12, year=1976), dt(day=5, month=11, year=1980), 'SPD, FDP'),
-        ('Schmidt cabinet III', dt(day=5, month=11, year=1980), dt(day=4, month=10, year=1982), 'SPD, FDP'),
-        ('Kohl cabinet I', dt(day=4, month=10, year=1982), dt(day=30, month=3, year=1983), 'CDU/CSU, FDP'),
-        ('Kohl cabinet II', dt(day=30, month=3, year=1983), dt(day=12, month=3, year=1987), 'CDU/CSU, FDP'),
-        ('Kohl cabinet III', dt(day=12, month=3, year=1987), dt(day=18, month=1, year=1991), 'CDU/CSU, FDP'),
-        ('Kohl cabinet IV', dt(day=18, month=1, year=1991), dt(day=17, month=11, year=1994), 'CDU/CSU, FDP'),
-        ('Kohl cabinet V', dt(day=17, month=11, year=1994), dt(day=27, month=10, year=1998), 'CDU/CSU, FDP'),
-        ('Schröder cabinet I', dt(day=27, month=10, year=1998), dt(day=22, month=10, year=2002), 'SPD, Bündnis 90/Die Grünen'),
-        ('Schröder cabinet II', dt(day=22, month=10, year=2002), dt(day=22, month=11, year=2005), 'SPD, Bündnis 90/Die Grünen'),
-        ('Merkel cabinet I', dt(day=22, month=11, year=2005), dt(day=28, month=10, year=2009), 'CDU/CSU, SPD'),
-        ('Merkel cabinet II', dt(day=28, month=10, year=2009), dt(day=17, month=12, year=2013), 'CDU/CSU, FDP'),
-        ('Merkel cabinet III', dt(day=17, month=12, year=2013), dt(day=14, month=3, year=2018), 'CDU/CSU, SPD'),
-        ('Merkel cabinet IV', dt(day=14, month=3, year=2018), dt.today(), 'CDU/CSU, SPD'),
-    ]
-    for c in cabinets:
-        if c[1] <= at_date < c[2]:
-            email = c[0].split(" ")[0] + '@bundesregierung.de'
-            # make sure we have a datetime
-            dt = datetime(at_date.year, at_date.month, at_date.day)
-            ts = int(dt.timestamp())
-            if ts < 0:
-                # Github cannot deal with negative timestamps at the moment...
-                ts = 0
-            return pygit2.Signature(c[0], email, ts)
-    else:
-        raise ValueError("No cabinate found for date {}", at_date)
+    at_date: date or datetime
+        Date used to look up the cabinet; see `cabinets.default_table`
+    """
+    return cabinets.default_table().signature(at_date)
 
 
 def prepare_commit_message(f, augmented_data):
     """Prepare a commit message base on information in the xml file and the augmented data"""
     xml = zip_to_xml(f)
-    msg = (
-        extract_long_name(xml)
-        + '\n\n'
-        + pypandoc.convert_text(augmented_data, to='markdown_github', format='html')
-    )
+    msg = extract_long_name(xml)
+    if augmented_data is not None:
+        msg += '\n\n' + pypandoc.convert_text(augmented_data, to='markdown_github', format='html')
     return msg
 
 
+def markdown_filename(f):
+    """The path of the markdown file of the law in `f` relative to the repository"""
+    # The folder of each downloaded file is named after the abbreviation of the law
+    return path.basename(path.dirname(f)).replace('/', '_') + '.md'
+
+
+def render_markdown(f):
+    """Render the zipped xml file `f` as markdown"""
+    xml = zip_to_xml(f)
+    return conversion.html_to_markdown(transform_gii_xml_to_html(xml))
+
+
+@metrics.timed('commit_update')
 def commit_update(f, citation, message, repository):
     """
     Apply and commit the changes described in filename `f` to the given `repository`
@@ -90,15 +70,10 @@ def commit_update(f, citation, message, repository):
     index = repository.index
     # The initial commit
     author = cabinet_sig(citation.date())
-    # The path to the new / updated file rel. to the repo
-    fname_md = path.basename(path.dirname(f)) + '.md'
-    # Replace some chars
-    fname_md = fname_md.replace('/', '_')
+    fname_md = markdown_filename(f)
     md_path = path.join(repo_path, fname_md)
     with open(md_path, 'w') as f_md:
-        xml = zip_to_xml(f)
-        md = html_to_markdown(transform_gii_xml_to_html(xml))
-        f_md.write(md)
+        f_md.write(render_markdown(f))
     index.add(fname_md)
     index.write()
     try:
@@ -111,52 +86,500 @@ def commit_update(f, citation, message, repository):
         # binary string representing the tree object ID
         index.write_tree(),
         # list of binary strings representing parents of the new commit
-        [head.get_object().hex] if head is not None else []
+        [head.target] if head is not None else []
     )
 
 
-def augment_and_filter_files(files):
+def bgbl_citation(f):
+    """
+    The citation of the zipped xml file `f` if it was published in the
+    BGBl I or II. Its date may be incomplete; see `gazette.GazetteIndex`.
+
+    Return
+    ------
+    Citation or None
+    """
+    xml = zip_to_xml(f)
+    try:
+        cit = Citation.from_xml(xml)
+    except ValueError:
+        # Skip files with no citation
+        return None
+    if cit.gazette not in ['BGBl I', 'BGBl II']:
+        # Skip all the other gazettes for now
+        return None
+    return cit
+
+
+def file_citation(f, gazettes=None):
+    """
+    The citation of the zipped xml file `f` if it can be placed in the
+    history, ie. if it was published in the BGBl I or II and its full
+    date is known.
+
+    Parameters
+    ----------
+    gazettes: gazette.GazetteIndex
+        Used to complete citations without month and day
+
+    Return
+    ------
+    Citation or None
+    """
+    cit = bgbl_citation(f)
+    if cit is None:
+        return None
+    if gazettes is not None:
+        gazettes.resolve([cit])
+    try:
+        cit.date()
+    except TypeError:
+        # Some parts of the dates were missing; skip those files
+        return None
+    return cit
+
+
+def known_proceedings(bgbl_index, cit):
+    """
+    The proceedings of the citation `cit` from the `bgbl.BgblIndex`, or
+    None if they have to be looked up online
+    """
+    part = gazette.BGBL_PARTS.get(cit.gazette)
+    if bgbl_index is None or part is None or not bgbl_index.has_proceedings(part, cit.year, cit.page):
+        metrics.inc('librelaws_cache_requests_total', cache='bgbl_index', result='miss')
+        return None
+    metrics.inc('librelaws_cache_requests_total', cache='bgbl_index', result='hit')
+    return bgbl_index.proceedings(part, cit.year, cit.page)
+
+
+def augment_and_filter_files(files, bgbl_index=None):
     """For each file, check if the relevant change was published in
     the BgBl I or II gazette. If so, try to find augmenting
     information about this change online.
 
     The augmenting information is returned as a string of valid and
-    approriately cropped html. Files where the citation could not be
-    established at all are filtered out.
+    approriately cropped html. Citations without month and day are
+    completed from the BGBl index of their years, which is fetched
+    once per year. Files where the citation could not be established
+    at all are filtered out.
 
     Parameter
     ---------
     files: list
         List of paths to zipped xml files
+    bgbl_index: bgbl.BgblIndex
+        Local index of the BGBl; only citations it does not know are
+        looked up online
 
     Return
     ------
     list of tuple: [(filepath, citation, {str, None})]
 
     """
-    from librelaws import xml_operations, online_lookups
-    import concurrent.futures
-
+    citations = [(f, bgbl_citation(f)) for f in files]
+    citations = [(f, cit) for (f, cit) in citations if cit is not None]
+    gazette.GazetteIndex(local=bgbl_index).resolve([cit for (_, cit) in citations])
     out = []
     with concurrent.futures.ProcessPoolExecutor(max_workers=30) as executor:
-        for f in files:
-            xml = xml_operations.zip_to_xml(f)
-            try:
-                cit = xml_operations.Citation.from_xml(xml)
-            except ValueError:
-                # Skip files with no citation
-                continue
-            if cit.gazette not in ['BGBl I', 'BGBl II']:
-                # Skip all the other gazettes for now
-                continue
+        for (f, cit) in citations:
             try:
                 cit.date()
             except TypeError:
                 # Some parts of the dates were missing; skip those files
                 continue
-            out.append(
-                [f, cit, executor.submit(online_lookups.search_bundestag_dip, cit.gazette, cit.year, cit.page)]
-            )
+            html = known_proceedings(bgbl_index, cit)
+            if html is not None:
+                out.append([f, cit, html])
+                continue
+            out.append([f, cit, executor.submit(
+                metrics.collecting, online_lookups.search_bundestag_dip, cit.gazette, cit.year, cit.page
+            )])
+        metrics.set_gauge('librelaws_queue_depth', len(out), queue='bip_lookups')
     # Wait for lookups to finish...
-    out = [(f, cit, fut.result()) for (f, cit, fut) in out]
-    return sorted(out, key=lambda el: el[1].date())
+    results = []
+    for (i, (f, cit, html)) in enumerate(out):
+        if isinstance(html, concurrent.futures.Future):
+            html, snapshot = _result(html)
+            metrics.merge(snapshot)
+        metrics.set_gauge('librelaws_queue_depth', len(out) - i - 1, queue='bip_lookups')
+        results.append((f, cit, html))
+    return sorted(results, key=lambda el: el[1].date())
+
+
+def open_repository(git_dir):
+    """Open the repository in `git_dir`; create it if it does not exist yet"""
+    if path.exists(path.join(git_dir, '.git')):
+        return pygit2.Repository(git_dir)
+    return pygit2.init_repository(git_dir)
+
+
+def build_history(files, git_dir, bgbl_index=None):
+    """
+    Commit the given files to the repository in `git_dir`, creating the
+    repository if necessary. The files are committed on top of the
+    existing history in the order of their citations, so calling this
+    with the files of each new download extends the history
+    incrementally.
+
+    Parameter
+    ---------
+    files: list
+        List of paths to zipped xml files
+    git_dir: str
+        Directory of the repository
+    bgbl_index: bgbl.BgblIndex
+        Local index of the BGBl, see `augment_and_filter_files`
+
+    Return
+    ------
+    int: Number of created commits
+    """
+    repository = open_repository(git_dir)
+    augmented_files = augment_and_filter_files(files, bgbl_index=bgbl_index)
+    for (f, cit, aug) in augmented_files:
+        msg = prepare_commit_message(f, aug)
+        commit_update(f, cit, msg, repository)
+    return len(augmented_files)
+
+
+def _result(future):
+    """The result of `future`; the metrics of a failed `metrics.collecting` call are merged before raising"""
+    try:
+        return future.result()
+    except Exception as exc:
+        metrics.merge_failed(exc)
+        raise
+
+
+def _bounded_map(executor, func, items, window):
+    """
+    Like `executor.map`, but submits the calls lazily so that at most
+    `window` calls are in flight. Items are yielded in their original
+    order together with their results.
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(func, item)))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            yield item, _result(future)
+    while pending:
+        item, future = pending.popleft()
+        yield item, _result(future)
+
+
+def _citation_record(f):
+    """
+    The sortable, json serializable citation of `f` or None; run in
+    worker processes. The date is None if the citation is incomplete.
+    """
+    cit = bgbl_citation(f)
+    if cit is None:
+        return None
+    try:
+        day = cit.date().isoformat()
+    except TypeError:
+        day = None
+    return [day, f, cit.gazette, cit.year, cit.month, cit.day, cit.page]
+
+
+def iter_sorted_versions(files, chunk_size=10000, window=64, max_workers=None, fan_in=64, tmp_dir=None,
+                         bgbl_index=None):
+    """
+    Establish the citations of `files` in worker processes and yield
+    the usable versions in chronological order (ties broken by path).
+    The citations are sorted externally, so no more than `chunk_size`
+    of them and one read buffer for each of at most `fan_in` spilled
+    runs are held in memory. `files` may be a lazy iterable.
+    Incomplete citations are completed from the BGBl index (see
+    `gazette.GazetteIndex`), which is fetched once per year unless the
+    local `bgbl_index` covers it.
+
+    Yield
+    -----
+    tuple: (filepath, Citation)
+    """
+    key = lambda r: (r[0], r[1])  # noqa: E731
+    gazettes = gazette.GazetteIndex(local=bgbl_index)
+    with ExternalSorter(key=key, chunk_size=chunk_size, fan_in=fan_in, tmp_dir=tmp_dir) as sorter:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            func = functools.partial(metrics.collecting, _citation_record)
+            for (_, (record, snapshot)) in _bounded_map(executor, func, files, window):
+                metrics.merge(snapshot)
+                if record is None:
+                    continue
+                if record[0] is None:
+                    cit = Citation(*record[2:])
+                    if not gazettes.resolve([cit]):
+                        continue
+                    record = [cit.date().isoformat(), record[1], cit.gazette, cit.year, cit.month, cit.day, cit.page]
+                sorter.add(record)
+        for (_, f, gazette_name, year, month, day, page) in sorter:
+            yield f, Citation(gazette_name, year, month, day, page)
+
+
+def _search_dip(version):
+    (_, cit, known) = version
+    if known is not None:
+        return metrics.collecting(lambda: known)
+    return metrics.collecting(online_lookups.search_bundestag_dip, cit.gazette, cit.year, cit.page)
+
+
+def iter_augmented(versions, window=64, max_workers=30, bgbl_index=None):
+    """
+    Look up the proceedings of each of the (filepath, Citation)
+    `versions` at the BIP while keeping at most `window` lookups in
+    flight. The order of `versions` is preserved. Proceedings found in
+    the `bgbl_index` are not looked up again.
+
+    Yield
+    -----
+    tuple: (filepath, Citation, html)
+    """
+    versions = ((f, cit, known_proceedings(bgbl_index, cit)) for (f, cit) in versions)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for ((f, cit, _), (html, snapshot)) in _bounded_map(executor, _search_dip, versions, window):
+            metrics.merge(snapshot)
+            yield f, cit, html
+
+
+def build_history_streaming(files, git_dir, chunk_size=10000, window=64, augment=True, tmp_dir=None,
+                            bgbl_index=None):
+    """
+    Memory bounded variant of `build_history` for large corpora.
+
+    Versions are sorted externally by their citations (see
+    `iter_sorted_versions`) and then streamed through the BIP lookup,
+    rendering and commit one at a time. Resident memory is bounded by
+    `chunk_size` citations while sorting and by `window` versions in
+    flight afterwards, independent of the number of `files`.
+
+    Parameter
+    ---------
+    files: iterable
+        Paths to zipped xml files; may be lazy, eg. `fs_operations.iter_local_files`
+    git_dir: str
+        Directory of the repository
+    chunk_size: int
+        Number of citations sorted in memory before spilling to disk
+    window: int
+        Maximum number of versions in flight between the stages
+    augment: bool
+        Look up the proceedings of each change for the commit message
+    bgbl_index: bgbl.BgblIndex
+        Local index of the BGBl, used for dates and proceedings it knows
+
+    Return
+    ------
+    int: Number of created commits
+    """
+    repository = open_repository(git_dir)
+    versions = iter_sorted_versions(files, chunk_size=chunk_size, window=window, tmp_dir=tmp_dir,
+                                    bgbl_index=bgbl_index)
+    if augment:
+        versions = iter_augmented(versions, window=window, bgbl_index=bgbl_index)
+    else:
+        versions = ((f, cit, None) for (f, cit) in versions)
+    n = 0
+    for (f, cit, aug) in versions:
+        commit_update(f, cit, prepare_commit_message(f, aug), repository)
+        n += 1
+    return n
+
+
+def _build_shard(abbrev, files, shard_dir, augment=True, lookups=None, gazettes=None, bgbl_index=None):
+    """
+    Build the history of the single law `abbrev` from `files` in the
+    bare repository `shard_dir/abbrev`, replacing an existing one.
+    Run in worker processes. The proceedings for the commit messages
+    are taken from the {filepath: html} `lookups` if given, otherwise
+    from the `bgbl.BgblIndex` `bgbl_index` or the BIP. Citations
+    without month and day are completed from the `gazette.GazetteIndex`
+    `gazettes`.
+
+    Return
+    ------
+    int: Number of created commits
+    """
+    repo_dir = path.join(shard_dir, abbrev)
+    shutil.rmtree(repo_dir, ignore_errors=True)
+    repository = pygit2.init_repository(repo_dir, bare=True)
+    versions = []
+    for f in files:
+        cit = file_citation(f, gazettes)
+        if cit is not None:
+            versions.append((cit.date(), f, cit))
+    versions.sort(key=lambda v: v[:2])
+    authors = cabinets.default_table().signatures([d for (d, _, _) in versions])
+    parents = []
+    for ((_, f, cit), author) in zip(versions, authors):
+        if lookups is not None:
+            aug = lookups.get(f)
+        elif augment:
+            aug = known_proceedings(bgbl_index, cit)
+            if aug is None:
+                aug = online_lookups.search_bundestag_dip(cit.gazette, cit.year, cit.page)
+        else:
+            aug = None
+        message = prepare_commit_message(f, aug)
+        builder = repository.TreeBuilder()
+        builder.insert(markdown_filename(f), repository.create_blob(render_markdown(f)), pygit2.GIT_FILEMODE_BLOB)
+        with metrics.timer('commit_update'):
+            commit = repository.create_commit(
+                'refs/heads/master', author, author, message, builder.write(), parents
+            )
+        parents = [commit]
+    return len(versions)
+
+
+def build_shards(files, shard_dir, augment=True, max_workers=None, bgbl_index=None):
+    """
+    Build one bare repository per law below `shard_dir`, each holding
+    the history of that law alone. Laws are independent of each other,
+    so the shards are built in parallel worker processes; shards built
+    on different machines can be copied into the same `shard_dir`
+    before `merge_shards`.
+
+    Parameter
+    ---------
+    files: iterable
+        Paths to zipped xml files
+    shard_dir: str
+        Directory of the shard repositories
+    augment: bool
+        Look up the proceedings of each change for the commit message
+    bgbl_index: bgbl.BgblIndex
+        Local index of the BGBl; only citations it does not know are
+        looked up online
+
+    Return
+    ------
+    dict: {abbrev: number of commits}
+    """
+    files = list(files)
+    by_law = defaultdict(list)
+    for f in files:
+        by_law[path.basename(path.dirname(f))].append(f)
+    os.makedirs(shard_dir, exist_ok=True)
+    func = functools.partial(metrics.collecting, _build_shard)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # The issue indexes of all years are fetched here once and handed
+        # to every shard, instead of once per shard that needs them
+        citations = []
+        for (cit, snapshot) in executor.map(functools.partial(metrics.collecting, bgbl_citation), files, chunksize=16):
+            metrics.merge(snapshot)
+            if cit is not None:
+                citations.append(cit)
+        gazettes = gazette.GazetteIndex(local=bgbl_index)
+        gazettes.resolve(citations)
+        futures = {
+            abbrev: executor.submit(
+                func, abbrev, law_files, shard_dir, augment, gazettes=gazettes, bgbl_index=bgbl_index
+            )
+            for (abbrev, law_files) in by_law.items()
+        }
+        metrics.set_gauge('librelaws_queue_depth', len(futures), queue='shards')
+        counts = {}
+        for (abbrev, future) in futures.items():
+            counts[abbrev], snapshot = _result(future)
+            metrics.merge(snapshot)
+            metrics.set_gauge('librelaws_queue_depth', len(futures) - len(counts), queue='shards')
+    return counts
+
+
+def _shard_commits(abbrev, repository):
+    """Yield (commit time, abbrev, commit) of the history of a shard, oldest first"""
+    if repository.head_is_unborn:
+        return
+    for commit in repository.walk(repository.head.target, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE):
+        yield commit.author.time, abbrev, commit
+
+
+# The commit the shards were first merged onto, and the tip of the last merge
+BASE_REF = 'refs/librelaws/base'
+MERGED_REF = 'refs/librelaws/merged'
+
+
+def merge_shards(shard_dir, git_dir):
+    """
+    Merge the histories of all shards in `shard_dir` into one
+    chronological history on top of the repository in `git_dir`.
+
+    The shards always hold the full history of their laws, so merging
+    again (eg. after rebuilding the shards) starts over from the commit
+    the shards were first merged onto (`refs/librelaws/base`) instead of
+    stacking a second copy of the history on the current `HEAD`.
+
+    The rendered files of the shards are reused, so merging only copies
+    blobs and writes trees and commits. Commits are ordered by their
+    timestamps and the order within each law is kept; versions before
+    1970, whose timestamps are clamped to 0 (see `cabinet_sig`), are
+    ordered by law. The working directory is checked out afterwards,
+    so the history can be extended with `build_history`.
+
+    Return
+    ------
+    int: Number of created commits
+    """
+    repository = open_repository(git_dir)
+    if MERGED_REF in repository.references:
+        base = repository.references.get(BASE_REF)
+        head = base.target if base is not None else None
+    else:
+        head = None if repository.head_is_unborn else repository.head.target
+        if head is not None:
+            repository.references.create(BASE_REF, head)
+    tree = repository[head].tree if head is not None else None
+    shards = [
+        _shard_commits(abbrev, pygit2.Repository(path.join(shard_dir, abbrev)))
+        for abbrev in sorted(os.listdir(shard_dir))
+    ]
+    n = 0
+    for (_, _, commit) in heapq.merge(*shards, key=lambda c: c[:2]):
+        builder = repository.TreeBuilder(tree) if tree is not None else repository.TreeBuilder()
+        for entry in commit.tree:
+            blob = repository.create_blob(entry.data)
+            builder.insert(entry.name, blob, entry.filemode)
+        tree = repository[builder.write()]
+        head = repository.create_commit(
+            None, commit.author, commit.committer, commit.message, tree.id, [head] if head is not None else []
+        )
+        n += 1
+    if head is not None:
+        repository.references.create('refs/heads/master', head, force=True)
+        repository.references.create(MERGED_REF, head, force=True)
+        repository.checkout_head(strategy=pygit2.GIT_CHECKOUT_FORCE)
+    return n
+
+
+def default_shard_dir(git_dir):
+    """The shard repositories of `git_dir` live in its `.git/shards`"""
+    return path.join(open_repository(git_dir).path, 'shards')
+
+
+def build_history_sharded(files, git_dir, shard_dir=None, augment=True, merge=True, max_workers=None,
+                          bgbl_index=None):
+    """
+    Variant of `build_history` which scales with the number of cores:
+    the history of each law is built in its own shard repository in
+    parallel (see `build_shards`) and the shards are then merged into
+    the chronological history of `git_dir` (see `merge_shards`).
+
+    Parameter
+    ---------
+    shard_dir: str
+        Directory of the shard repositories; defaults to `.git/shards` in `git_dir`
+    merge: bool
+        Merge the shards into `git_dir`; otherwise only build the shards
+    bgbl_index: bgbl.BgblIndex
+        Local index of the BGBl; see `build_shards`
+
+    Return
+    ------
+    int: Number of commits created in `git_dir`, or in the shards if not merging
+    """
+    shard_dir = shard_dir or default_shard_dir(git_dir)
+    counts = build_shards(files, shard_dir, augment=augment, max_workers=max_workers, bgbl_index=bgbl_index)
+    if not merge:
+        return sum(counts.values())
+    return merge_shards(shard_dir, git_dir)
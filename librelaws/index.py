@@ -0,0 +1,401 @@
+from bisect import bisect_right
+import concurrent.futures
+import functools
+import hashlib
+import sqlite3
+from datetime import date
+from os import path
+
+from . import metrics
+from .fs_operations import all_local_files, hash_without_builddate
+from .xml_operations import zip_to_xml, extract_norms, Citation
+
+
+INDEX_FILE = '.librelaws-index.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    -- Ids of removed versions are never reused, so consumers like the
+    -- change feed can follow the index by id
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    -- Path of the zip file relative to `download-dir`
+    path TEXT UNIQUE NOT NULL,
+    abbrev TEXT NOT NULL,
+    -- ISO date of the `date` folder the file was downloaded into
+    downloaded TEXT NOT NULL,
+    gazette TEXT,
+    year INTEGER,
+    page INTEGER,
+    -- ISO date of the citation; NULL if it could not be established
+    cited TEXT,
+    -- The version is in force in the half-open interval [valid_from, valid_to)
+    valid_from TEXT NOT NULL,
+    valid_to TEXT,
+    -- Hash of the xml without its builddate; see `fs_operations.hash_without_builddate`
+    fingerprint TEXT,
+    -- Whether `clean` already looked for duplicates of this version
+    cleaned INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS versions_abbrev ON versions (abbrev, valid_from);
+-- Norm texts are stored once, no matter in how many versions they appear
+CREATE VIRTUAL TABLE IF NOT EXISTS norm_texts USING fts5(body);
+CREATE TABLE IF NOT EXISTS text_digests (
+    digest BLOB PRIMARY KEY,
+    text_id INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS norms (
+    version_id INTEGER NOT NULL REFERENCES versions (id) ON DELETE CASCADE,
+    label TEXT NOT NULL,
+    text_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS norms_version ON norms (version_id);
+CREATE INDEX IF NOT EXISTS norms_text ON norms (text_id);
+-- Size and mtime (ns) of the files at the time they passed `verify`
+CREATE TABLE IF NOT EXISTS verified (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+) WITHOUT ROWID;
+-- Duplicates which `clean` replaced by a link to their original, with the
+-- inode of the link. Unlike hardlinks, reflinks cannot be told apart from copies.
+CREATE TABLE IF NOT EXISTS links (
+    path TEXT PRIMARY KEY,
+    original TEXT NOT NULL,
+    inode INTEGER NOT NULL
+) WITHOUT ROWID;
+-- Id of the last version seen by incremental consumers like the change feed
+CREATE TABLE IF NOT EXISTS cursors (
+    name TEXT PRIMARY KEY,
+    version_id INTEGER NOT NULL
+);
+"""
+
+# Columns added to `versions` after the first release of the index
+MIGRATIONS = [
+    ('fingerprint', 'ALTER TABLE versions ADD COLUMN fingerprint TEXT'),
+    ('cleaned', 'ALTER TABLE versions ADD COLUMN cleaned INTEGER NOT NULL DEFAULT 0'),
+]
+
+
+def _rebuild_versions(conn):
+    """
+    Rebuild the `versions` table of an index created before its ids
+    were AUTOINCREMENT, which sqlite only allows for new tables. The
+    ids are kept, so the norms still belong to their versions.
+    """
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'versions'").fetchone()
+    if row is None or 'AUTOINCREMENT' in row[0]:
+        return
+    statement = row[0].replace('versions', 'versions_new', 1).replace(
+        'id INTEGER PRIMARY KEY', 'id INTEGER PRIMARY KEY AUTOINCREMENT', 1
+    )
+    # Otherwise dropping the old table would delete the norms
+    conn.execute('PRAGMA foreign_keys = OFF')
+    try:
+        with conn:
+            conn.execute('BEGIN')
+            conn.execute(statement)
+            conn.execute('INSERT INTO versions_new SELECT * FROM versions')
+            conn.execute('DROP TABLE versions')
+            conn.execute('ALTER TABLE versions_new RENAME TO versions')
+    finally:
+        conn.execute('PRAGMA foreign_keys = ON')
+
+
+def index_path(dl_dir):
+    """Path of the index database belonging to `dl_dir`"""
+    return path.join(path.expanduser(dl_dir), INDEX_FILE)
+
+
+def index_exists(dl_dir):
+    return path.exists(index_path(dl_dir))
+
+
+def open_index(dl_dir):
+    """
+    Open (and create if necessary) the version index of `dl_dir`
+
+    Return
+    ------
+    sqlite3.Connection
+    """
+    conn = sqlite3.connect(index_path(dl_dir))
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute('PRAGMA journal_mode = WAL')
+    _rebuild_versions(conn)
+    conn.executescript(SCHEMA)
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(versions)')}
+    with conn:
+        for (column, statement) in MIGRATIONS:
+            if column not in columns:
+                conn.execute(statement)
+        conn.execute('CREATE INDEX IF NOT EXISTS versions_fingerprint ON versions (fingerprint)')
+    return conn
+
+
+def read_version(f):
+    """
+    Parse the zipped xml file `f` into the plain data stored in the
+    index. This function is run in worker processes.
+
+    Return
+    ------
+    dict: With keys 'gazette', 'year', 'page', 'cited', 'fingerprint' and 'norms'
+    """
+    xml = zip_to_xml(f)
+    d = {'gazette': None, 'year': None, 'page': None, 'cited': None, 'fingerprint': hash_without_builddate(xml)}
+    try:
+        cit = Citation.from_xml(xml)
+    except ValueError:
+        pass
+    else:
+        d.update(gazette=cit.gazette, year=cit.year, page=cit.page)
+        try:
+            d['cited'] = cit.date().isoformat()
+        except TypeError:
+            # Citation from the `fundstelle` node without month and day
+            pass
+    d['norms'] = extract_norms(xml)
+    return d
+
+
+def _text_id(conn, text):
+    digest = hashlib.sha1(text.encode('utf-8')).digest()
+    row = conn.execute('SELECT text_id FROM text_digests WHERE digest = ?', (digest, )).fetchone()
+    if row is not None:
+        return row[0]
+    text_id = conn.execute('INSERT INTO norm_texts (body) VALUES (?)', (text, )).lastrowid
+    conn.execute('INSERT INTO text_digests (digest, text_id) VALUES (?, ?)', (digest, text_id))
+    return text_id
+
+
+def update_intervals(conn, abbrevs):
+    """
+    Recompute the validity intervals of all versions of the given
+    abbreviations. Each version is valid until the next version comes
+    into force; the latest version has an open ended interval.
+    """
+    for abbrev in abbrevs:
+        rows = conn.execute(
+            'SELECT id, valid_from FROM versions WHERE abbrev = ? ORDER BY valid_from, downloaded, path',
+            (abbrev, )
+        ).fetchall()
+        valid_to = [nxt[1] for nxt in rows[1:]] + [None]
+        conn.executemany(
+            'UPDATE versions SET valid_to = ? WHERE id = ?',
+            [(to, row[0]) for (row, to) in zip(rows, valid_to)]
+        )
+
+
+def add_versions(conn, dl_dir, files, max_workers=None):
+    """
+    Add the given files to the index. Files which are already indexed
+    are skipped, so it is cheap to call this with every file a
+    download produced.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        Connection returned by `open_index`
+    dl_dir: string
+        Download directory where the local files are stored
+    files: list
+        Paths of zip files inside of `dl_dir`
+
+    Return
+    ------
+    int: Number of newly indexed versions
+    """
+    dl_dir = path.expanduser(dl_dir)
+    known = {row[0] for row in conn.execute('SELECT path FROM versions')}
+    rel_paths = [path.relpath(f, dl_dir) for f in files]
+    new = sorted(set(rp for rp in rel_paths if rp not in known))
+    metrics.inc('librelaws_cache_requests_total', len(rel_paths) - len(new), cache='version_index', result='hit')
+    metrics.inc('librelaws_cache_requests_total', len(new), cache='version_index', result='miss')
+    if not new:
+        return 0
+    abbrevs = set()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        parsed = executor.map(
+            functools.partial(metrics.collecting, read_version), [path.join(dl_dir, rp) for rp in new], chunksize=8
+        )
+        with conn:
+            for (rp, (d, snapshot)) in zip(new, parsed):
+                metrics.merge(snapshot)
+                abbrev = path.basename(path.dirname(rp))
+                downloaded = path.basename(path.dirname(path.dirname(rp)))
+                version_id = conn.execute(
+                    'INSERT INTO versions (path, abbrev, downloaded, gazette, year, page, cited, valid_from, '
+                    'fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (rp, abbrev, downloaded, d['gazette'], d['year'], d['page'], d['cited'],
+                     d['cited'] or downloaded, d['fingerprint'])
+                ).lastrowid
+                conn.executemany(
+                    'INSERT INTO norms (version_id, label, text_id) VALUES (?, ?, ?)',
+                    [(version_id, label, _text_id(conn, text)) for (label, text) in d['norms']]
+                )
+                abbrevs.add(abbrev)
+            update_intervals(conn, abbrevs)
+    return len(new)
+
+
+def drop_versions(conn, rel_paths):
+    """Remove the versions with the given paths (relative to `download-dir`) from the index"""
+    with conn:
+        abbrevs = {
+            row[0] for rp in rel_paths
+            for row in conn.execute('SELECT abbrev FROM versions WHERE path = ?', (rp, ))
+        }
+        conn.executemany('DELETE FROM versions WHERE path = ?', [(rp, ) for rp in rel_paths])
+        conn.executemany('DELETE FROM verified WHERE path = ?', [(rp, ) for rp in rel_paths])
+        conn.executemany('DELETE FROM links WHERE path = ? OR original = ?', [(rp, rp) for rp in rel_paths])
+        update_intervals(conn, abbrevs)
+
+
+def update_index(dl_dir, max_workers=None):
+    """
+    Bring the index of `dl_dir` up to date with the files on disk.
+    Versions which no longer exist are dropped from the index.
+
+    Return
+    ------
+    tuple: (number of added versions, number of removed versions)
+    """
+    dl_dir = path.expanduser(dl_dir)
+    conn = open_index(dl_dir)
+    try:
+        files = all_local_files(dl_dir)
+        on_disk = {path.relpath(f, dl_dir) for f in files}
+        gone = [rp for (rp, ) in conn.execute('SELECT path FROM versions') if rp not in on_disk]
+        drop_versions(conn, gone)
+        added = add_versions(conn, dl_dir, files, max_workers=max_workers)
+    finally:
+        conn.close()
+    return added, len(gone)
+
+
+def _fts_phrase(phrase):
+    """Quote `phrase` such that FTS5 treats it as a single phrase query"""
+    return '"{}"'.format(phrase.replace('"', '""'))
+
+
+def search(conn, phrase, as_of=None, limit=100):
+    """
+    Find the norms containing `phrase` which were in force at `as_of`
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        Connection returned by `open_index`
+    phrase: str
+        Phrase to look for
+    as_of: date
+        Point in time of the query. Defaults to today.
+    limit: int
+        Maximum number of returned matches
+
+    Return
+    ------
+    list of tuple: [(abbrev, label, path, valid_from, valid_to, snippet)]
+    """
+    if as_of is None:
+        as_of = date.today()
+    as_of = as_of.isoformat()
+    query = """
+    SELECT v.abbrev, n.label, v.path, v.valid_from, v.valid_to,
+           snippet(norm_texts, 0, '[', ']', '...', 12)
+    FROM norm_texts
+    JOIN norms AS n ON n.text_id = norm_texts.rowid
+    JOIN versions AS v ON v.id = n.version_id
+    WHERE norm_texts MATCH ?
+      AND v.valid_from <= ? AND (v.valid_to IS NULL OR ? < v.valid_to)
+    ORDER BY v.abbrev, n.rowid
+    LIMIT ?
+    """
+    return conn.execute(query, (_fts_phrase(phrase), as_of, as_of, limit)).fetchall()
+
+
+class VersionLookup:
+    """
+    Point in time lookups of laws backed by the version index.
+
+    The validity intervals of all versions are loaded once into sorted
+    per-law arrays so that finding the version in force at a given date
+    is a binary search instead of a glob over `download-dir`. Norm
+    texts are served from the index without touching the zip files.
+
+    Parameters
+    ----------
+    dl_dir: string
+        Download directory where the local files are stored
+    cache_size: int
+        Number of parsed xml trees which are kept in memory
+    """
+    def __init__(self, dl_dir, cache_size=32):
+        self.dl_dir = path.expanduser(dl_dir)
+        self.conn = open_index(self.dl_dir)
+        self._parse = functools.lru_cache(maxsize=cache_size)(zip_to_xml)
+        self.reload()
+
+    def reload(self):
+        """Rebuild the in-memory intervals after the index was updated"""
+        self.intervals = {}
+        rows = self.conn.execute(
+            'SELECT abbrev, valid_from, id, path FROM versions ORDER BY abbrev, valid_from, downloaded, path'
+        )
+        for (abbrev, valid_from, version_id, rel_path) in rows:
+            starts, versions = self.intervals.setdefault(abbrev, ([], []))
+            starts.append(valid_from)
+            versions.append((version_id, rel_path))
+
+    def close(self):
+        self.conn.close()
+
+    def version_at(self, abbrev, at):
+        """
+        Find the version of `abbrev` in force at date `at`
+
+        Return
+        ------
+        tuple: (version id, path to the zip file)
+
+        Raises
+        ------
+        ValueError: If the law is unknown or not yet in force at `at`
+        """
+        try:
+            starts, versions = self.intervals[abbrev]
+        except KeyError:
+            raise ValueError("No versions of {} in the index".format(abbrev))
+        i = bisect_right(starts, at.isoformat())
+        if i == 0:
+            raise ValueError("No version of {} was in force at {}".format(abbrev, at))
+        (version_id, rel_path) = versions[i - 1]
+        return version_id, path.join(self.dl_dir, rel_path)
+
+    def xml_at(self, abbrev, at):
+        """
+        The parsed xml of the version of `abbrev` in force at `at`. The
+        returned tree may be shared with other callers and must not be
+        modified.
+        """
+        _, f = self.version_at(abbrev, at)
+        return self._parse(f)
+
+    def norm_at(self, abbrev, at, label):
+        """
+        The text of norm `label` (eg. `§ 1`) of `abbrev` in force at `at`
+
+        Raises
+        ------
+        ValueError: If there is no such norm in that version
+        """
+        version_id, _ = self.version_at(abbrev, at)
+        row = self.conn.execute(
+            "SELECT t.body FROM norms AS n JOIN norm_texts AS t ON t.rowid = n.text_id "
+            "WHERE n.version_id = ? AND replace(n.label, ' ', '') = ?",
+            (version_id, label.replace(' ', ''))
+        ).fetchone()
+        if row is None:
+            raise ValueError("{} has no norm {} at {}".format(abbrev, label, at))
+        return row[0]
@@ -0,0 +1,29 @@
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """
+    Import the module `name` when one of its attributes is first
+    accessed. Use it for heavy dependencies which are only needed by
+    some code paths, so that importing the module using them stays
+    cheap.
+
+    Return
+    ------
+    module: The (not yet executed) module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named {!r}".format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
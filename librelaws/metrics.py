@@ -0,0 +1,226 @@
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class Registry:
+    """
+    A minimal, thread safe store of counters, gauges and histograms.
+
+    Metrics are identified by their name and a sorted tuple of
+    `(label, value)` pairs. Workers in other processes record into their
+    own registry and send a `snapshot` back which is `merge`d by the
+    parent.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            # key -> [bucket counts, sum, count]
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self.histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            for (i, le) in enumerate(BUCKETS):
+                if value <= le:
+                    h[0][i] += 1
+                    break
+            h[1] += value
+            h[2] += 1
+
+    def snapshot(self):
+        """A picklable copy of all metrics"""
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {k: [list(v[0]), v[1], v[2]] for (k, v) in self.histograms.items()},
+            }
+
+    def merge(self, snapshot):
+        """Add the metrics recorded by another (worker) registry"""
+        with self._lock:
+            for (k, v) in snapshot['counters'].items():
+                self.counters[k] = self.counters.get(k, 0) + v
+            self.gauges.update(snapshot['gauges'])
+            for (k, (buckets, total, count)) in snapshot['histograms'].items():
+                h = self.histograms.setdefault(k, [[0] * len(BUCKETS), 0.0, 0])
+                h[0] = [a + b for (a, b) in zip(h[0], buckets)]
+                h[1] += total
+                h[2] += count
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for (k, v) in pairs) + '}'
+
+        snap = self.snapshot()
+        lines = []
+        for (kind, metrics) in [('counter', snap['counters']), ('gauge', snap['gauges'])]:
+            for name in sorted({name for (name, _) in metrics}):
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for ((n, labels), v) in sorted(metrics.items()):
+                    if n == name:
+                        lines.append('{}{} {}'.format(name, fmt_labels(labels), v))
+        for name in sorted({name for (name, _) in snap['histograms']}):
+            lines.append('# TYPE {} histogram'.format(name))
+            for ((n, labels), (buckets, total, count)) in sorted(snap['histograms'].items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for (le, c) in zip(BUCKETS, buckets):
+                    cumulative += c
+                    le = '+Inf' if le == float('inf') else repr(le)
+                    lines.append('{}_bucket{} {}'.format(name, fmt_labels(labels, [('le', le)]), cumulative))
+                lines.append('{}_sum{} {}'.format(name, fmt_labels(labels), total))
+                lines.append('{}_count{} {}'.format(name, fmt_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """All metrics as a json serializable dict"""
+        def key_str(name, labels):
+            return name + ''.join('{{{}={}}}'.format(k, v) for (k, v) in labels)
+
+        snap = self.snapshot()
+        return {
+            'counters': {key_str(*k): v for (k, v) in snap['counters'].items()},
+            'gauges': {key_str(*k): v for (k, v) in snap['gauges'].items()},
+            'histograms': {
+                key_str(*k): {'count': count, 'sum': total, 'buckets': dict(zip(map(str, BUCKETS), buckets))}
+                for (k, (buckets, total, count)) in snap['histograms'].items()
+            },
+        }
+
+
+REGISTRY = Registry()
+
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set
+observe = REGISTRY.observe
+merge = REGISTRY.merge
+
+
+@contextmanager
+def timer(stage):
+    """Record the duration of the enclosed block in the `stage` histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('librelaws_stage_duration_seconds', time.perf_counter() - start, stage=stage)
+
+
+def timed(stage):
+    """Decorator recording the duration of each call in the `stage` histogram"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_response(resp, *args, **kwargs):
+    """
+    Response hook for `requests` recording latency, status codes and
+    transferred bytes per host. Use as `hooks=metrics.HTTP_HOOKS`.
+    """
+    host = urlparse(resp.url).netloc
+    status = str(resp.status_code)
+    inc('librelaws_http_requests_total', host=host, status=status)
+    observe('librelaws_http_request_duration_seconds', resp.elapsed.total_seconds(), host=host)
+    inc('librelaws_http_response_bytes_total', len(resp.content), host=host)
+    if 'If-None-Match' in resp.request.headers or 'If-Modified-Since' in resp.request.headers:
+        result = 'hit' if resp.status_code == 304 else 'miss'
+        inc('librelaws_cache_requests_total', cache='http', result=result)
+
+
+HTTP_HOOKS = {'response': record_response}
+
+
+def collecting(func, *args, **kwargs):
+    """
+    Call `func` in a worker process and return its result together with
+    the metrics it recorded; merge those in the parent with `merge`.
+    If `func` raises, the metrics are attached to the exception; merge
+    those with `merge_failed`.
+
+    Return
+    ------
+    tuple: (result, snapshot)
+    """
+    REGISTRY.reset()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as exc:
+        # The failed requests are the ones the error rates are about
+        exc.metrics_snapshot = REGISTRY.snapshot()
+        raise
+    return result, REGISTRY.snapshot()
+
+
+def merge_failed(exc):
+    """Merge the metrics a failed `collecting` call attached to `exc`, if any"""
+    snapshot = getattr(exc, 'metrics_snapshot', None)
+    if snapshot is not None:
+        merge(snapshot)
+
+
+def serve(port, host='127.0.0.1'):
+    """
+    Expose the metrics at `http://host:port/metrics` from a daemon thread
+
+    Return
+    ------
+    HTTPServer: Call `shutdown()` on it to stop serving
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = REGISTRY.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_summary(fname):
+    """Write all metrics as json to `fname`"""
+    with open(fname, 'w') as f:
+        json.dump(REGISTRY.summary(), f, indent=2, sort_keys=True)
@@ -10,9 +10,33 @@ import logging
 import requests
 from lxml import etree
 
+from librelaws import metrics
 from librelaws.xml_operations import transform_bip_html_to_cropped_html
 
 
+# Roots of the remote services. Each can be redirected through an
+# environment variable `LIBRELAWS_<NAME>_ROOT` (eg. to the local
+# stand-in of `librelaws.standin`); worker processes inherit them.
+SERVICE_ROOTS = {
+    'gii': 'http://www.gesetze-im-internet.de/',
+    'archive': 'https://web.archive.org/',
+    'offenegesetze': 'https://api.offenegesetze.de/',
+    'dip': 'http://dipbt.bundestag.de/',
+}
+
+
+def service_root(name):
+    """The root url of the service `name`; always ends with a slash"""
+    root = os.environ.get('LIBRELAWS_{}_ROOT'.format(name.upper()), SERVICE_ROOTS[name])
+    return root.rstrip('/') + '/'
+
+
+def _is_service_url(url, name):
+    root = urlparse(service_root(name))
+    url = urlparse(url)
+    return url.netloc == root.netloc and url.path.startswith(root.path)
+
+
 class VersionExistsError(Exception):
     """Raised if a version is downloaded that already exists. May be
     raised before or after the download finished.
@@ -21,7 +45,7 @@ class VersionExistsError(Exception):
         self.message = message
 
 
-def get_links_gii():
+def get_links_gii(session=None):
     """
     Download and parse the "TOC" of gesetze-im-internet.de.
 
@@ -29,24 +53,55 @@ def get_links_gii():
     ------
     list: Links to all laws found on the site as `zip` files
     """
-    root = "http://www.gesetze-im-internet.de/"
+    links, _, _ = fetch_toc_gii(session=session)
+    return links
+
+
+def fetch_toc_gii(session=None, etag=None, last_modified=None):
+    """
+    Conditionally download the "TOC" of gesetze-im-internet.de.
+
+    Parameters
+    ----------
+    session: requests.Session
+        Session to use for the request; keeps the connection alive between calls
+    etag, last_modified: str
+        Validators of a previously fetched TOC
+
+    Return
+    ------
+    tuple: (links, etag, last_modified) where `links` is None if the
+        TOC did not change since it was last fetched
+    """
+    root = service_root('gii')
     toc = "gii-toc.xml"
-    tree = etree.parse(root + toc)
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+    r = (session or requests).get(root + toc, headers=headers, timeout=30, hooks=metrics.HTTP_HOOKS)
+    r.raise_for_status()
+    etag = r.headers.get('ETag', etag)
+    last_modified = r.headers.get('Last-Modified', last_modified)
+    if r.status_code == 304:
+        return None, etag, last_modified
+    tree = etree.fromstring(r.content)
     links = [el.text for el in tree.xpath('//link')]
-    return links
+    return links, etag, last_modified
 
 
 def lookup_history(url):
     """
     Lookup the history of a given file on the internet archive
     """
-    api_root = "http://web.archive.org/cdx/search/cdx?url="
+    api_root = service_root('archive') + "cdx/search/cdx?url="
     search = api_root + url
-    resp = requests.get(search)
+    resp = requests.get(search, hooks=metrics.HTTP_HOOKS)
     resp.raise_for_status()
     keys = ["urlkey", "timestamp", "original", "mimetype", "statuscode", "digest", "length"]
     links = []
-    retrieve_root = "https://web.archive.org/web/"
+    retrieve_root = service_root('archive') + "web/"
     for l in resp.text.splitlines():
         d = {k: v for (k, v) in zip(keys, l.split())}
         # eg. 20121223155642/https://www.gesetze-im-internet.de/bgb/xml.zip
@@ -66,11 +121,11 @@ def save_response(resp, dl_dir):
     file using the responses `etag`.
     """
     url = resp.url
-    if 'web.archive.org' in url:
+    if _is_service_url(url, 'archive'):
         match = re.findall(r'\d{14}', url)[0]
         rename_to = path.basename(url)
         d = datetime.strptime(match, "%Y%m%d%H%M%S")
-    elif 'www.gesetze-im-internet.de' in url:
+    elif _is_service_url(url, 'gii'):
         rename_to = _file_name_from_etag(resp)
         d = datetime.now()
     else:
@@ -120,7 +175,7 @@ def _get_latest_etag_for_link(dl_folder, link):
     return etag
 
 
-def download_gii_if_non_existing(dl_dir, link, etag=None):
+def download_gii_if_non_existing(dl_dir, link, etag=None, session=None):
     """Download `link` into `dl_dir` if its newer (different etag) than a
     potential local version.
 
@@ -132,7 +187,7 @@ def download_gii_if_non_existing(dl_dir, link, etag=None):
         headers = {'If-None-Match': '"{}"'.format(etag)}
     else:
         headers = None
-    r = requests.get(link, headers=headers, timeout=10)
+    r = (session or requests).get(link, headers=headers, timeout=10, hooks=metrics.HTTP_HOOKS)
     r.raise_for_status()
     # is unchanged?
     if r.status_code == 304:
@@ -162,8 +217,8 @@ def bgbl_citation_date(part, year, page):
         'kind': "bgbl{}".format(part),
         'page': page,
     }
-    root = "https://api.offenegesetze.de/v1/veroeffentlichung/"
-    resp = requests.get(root, params=params)
+    root = service_root('offenegesetze') + "v1/veroeffentlichung/"
+    resp = requests.get(root, params=params, hooks=metrics.HTTP_HOOKS)
     resp.raise_for_status()
     j = resp.json()['results']
     try:
@@ -173,6 +228,29 @@ def bgbl_citation_date(part, year, page):
     return datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
 
 
+def fetch_bgbl_issues(part, year, session=None, limit=100):
+    """
+    Fetch the index of all issues of the BGBl `part` published in
+    `year` from api.offenegesetze.de, following the pagination.
+
+    Return
+    ------
+    list of dict: With (among others) the keys 'date', 'page' and 'num_pages'
+    """
+    url = service_root('offenegesetze') + "v1/veroeffentlichung/"
+    params = {'year': year, 'kind': "bgbl{}".format(part), 'limit': limit}
+    issues = []
+    while url is not None:
+        resp = (session or requests).get(url, params=params, timeout=30, hooks=metrics.HTTP_HOOKS)
+        resp.raise_for_status()
+        j = resp.json()
+        issues.extend(j['results'])
+        # The `next` url already carries all parameters
+        url, params = j.get('next'), None
+    return issues
+
+
+@metrics.timed('search_bundestag_dip')
 def search_bundestag_dip(publication, bgbl_year, bgbl_page):
     """
     Search `dipbt.bundestag.de` for details concerning the proceedings of the given BGBl entry.
@@ -187,10 +265,10 @@ def search_bundestag_dip(publication, bgbl_year, bgbl_page):
     -------
     search_bundestag_dip('BGBl I', 2019, 54)
     """
-    req_url = 'http://dipbt.bundestag.de/dip21.web/searchProcedures/advanced_search_list.do'
+    req_url = service_root('dip') + 'dip21.web/searchProcedures/advanced_search_list.do'
     headers = _create_headers_bip()
     query = _create_request_data_bip(publication, bgbl_year, bgbl_page)
-    r = requests.post(req_url, data=query, headers=headers, )
+    r = requests.post(req_url, data=query, headers=headers, hooks=metrics.HTTP_HOOKS)
     r.raise_for_status()
     html = etree.HTML(r.text)
     cropped_html = transform_bip_html_to_cropped_html(html)
@@ -202,7 +280,7 @@ def _create_headers_bip():
     Somehow, some of the cookies are not properly set by request.
     This function creates a custom header to be used when searching bip21
     """
-    r = requests.get('http://dipbt.bundestag.de/dip21.web/bt')
+    r = requests.get(service_root('dip') + 'dip21.web/bt', hooks=metrics.HTTP_HOOKS)
     cookie_pattern = r'[A-Z]*=\w*\.dip21'
     cookies = re.findall(cookie_pattern, r.headers['Set-Cookie'], )
     headers = {
@@ -0,0 +1,77 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+from datetime import datetime
+from os import path
+
+from librelaws import metrics
+
+
+STAGE_METRIC = 'librelaws_stage_duration_seconds'
+
+
+def stage_breakdown(registry=None):
+    """
+    Aggregate the recorded stage durations
+
+    Return
+    ------
+    list of tuple: [(stage, calls, total seconds)] with the most expensive stage first
+    """
+    registry = registry or metrics.REGISTRY
+    rows = []
+    for ((name, labels), (_, total, count)) in registry.snapshot()['histograms'].items():
+        if name == STAGE_METRIC:
+            rows.append((dict(labels)['stage'], count, total))
+    return sorted(rows, key=lambda r: r[2], reverse=True)
+
+
+def format_stage_table(rows, wall_time):
+    """
+    Format the output of `stage_breakdown` as a text table. Stages run
+    in worker processes are included, so the shares of the wall time
+    may add up to more than 100%.
+    """
+    header = '{:<28} {:>9} {:>11} {:>10} {:>7}'.format('stage', 'calls', 'total [s]', 'mean [ms]', 'wall %')
+    lines = [header, '-' * len(header)]
+    for (stage, calls, total) in rows:
+        lines.append('{:<28} {:>9} {:>11.3f} {:>10.2f} {:>7.1f}'.format(
+            stage, calls, total, 1000 * total / calls, 100 * total / wall_time if wall_time else 0
+        ))
+    lines.append('{:<28} {:>9} {:>11.3f}'.format('wall time', '', wall_time))
+    return '\n'.join(lines)
+
+
+def run_profiled(func, args, out_dir):
+    """
+    Run `func(args)` under cProfile. The raw profile (`.prof`, readable
+    with `pstats` or snakeviz) and a text report sorted by cumulative
+    time are written to `out_dir`; the stage breakdown is printed.
+
+    Only the main process is profiled by cProfile; the stage timings
+    include the worker processes.
+
+    Return
+    ------
+    str: Path of the written `.prof` file
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    name = func.__name__.replace('do_', '', 1)
+    stem = path.join(out_dir, '{}-{}'.format(name, datetime.now().strftime('%Y%m%dT%H%M%S')))
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        profiler.runcall(func, args)
+    finally:
+        wall_time = time.perf_counter() - start
+        profiler.dump_stats(stem + '.prof')
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(50)
+        table = format_stage_table(stage_breakdown(), wall_time)
+        with open(stem + '.txt', 'w') as f:
+            f.write(table + '\n\n' + report.getvalue())
+        print(table)
+        print("Profile written to {}.prof".format(stem))
+    return stem + '.prof'
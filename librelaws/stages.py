@@ -0,0 +1,4 @@
+# Stages of the distributed pipeline, in the order they run. Kept in
+# their own module, so that the command line can offer them without
+# importing `distributed`.
+STAGES = ['download', 'fingerprint', 'augment', 'render']
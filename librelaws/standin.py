@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+from librelaws import online_lookups
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 resets connections when many worker
+    # processes connect at once, eg. the BIP lookups of a large corpus
+    request_queue_size = 128
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves the endpoints of all remote services used by librelaws. Each
+    service lives below its own prefix, eg. `/gii/gii-toc.xml`.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b'', content_type='application/octet-stream', headers=None):
+        self.send_response(status)
+        for (k, v) in (headers or {}).items():
+            self.send_header(k, v)
+        if status != 304:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def _send_conditional(self, body, etag, content_type):
+        """Answer with `304` if the client already has the version with `etag`"""
+        quoted = '"{}"'.format(etag)
+        headers = {'ETag': quoted, 'Last-Modified': self.server.standin.last_modified}
+        if self.headers.get('If-None-Match') == quoted:
+            self._send(304, headers=headers)
+        else:
+            self._send(200, body, content_type, headers)
+
+    def _handle(self):
+        standin = self.server.standin
+        if standin.latency:
+            time.sleep(standin.latency)
+        if standin.should_fail():
+            self._send(503, b'Injected error', 'text/plain')
+            return
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        service, _, rest = url.path.lstrip('/').partition('/')
+        parts = rest.split('/')
+        if service == 'gii' and rest == 'gii-toc.xml':
+            body = standin.toc_xml()
+            self._send_conditional(body, hashlib.sha1(body).hexdigest(), 'application/xml')
+        elif service == 'gii' and len(parts) == 2 and parts[1] == 'xml.zip' and parts[0] in standin.versions:
+            abbrev = parts[0]
+            version = standin.versions[abbrev]
+            self._send_conditional(standin.law_zip(abbrev, version), standin.etag(abbrev, version), 'application/zip')
+        elif service == 'archive' and rest == 'cdx/search/cdx':
+            self._send(200, standin.cdx(query['url'][0]).encode('utf-8'), 'text/plain')
+        elif service == 'archive' and parts[0] == 'web' and len(parts) > 3:
+            abbrev = parts[-2]
+            version = standin.archive_version(abbrev, parts[1])
+            if version is None:
+                self._send(404, b'Not archived', 'text/plain')
+            else:
+                self._send(200, standin.law_zip(abbrev, version), 'application/zip')
+        elif service == 'offenegesetze' and rest == 'v1/veroeffentlichung/':
+            body = json.dumps(standin.veroeffentlichungen(query)).encode('utf-8')
+            self._send(200, body, 'application/json')
+        elif service == 'dip' and rest == 'dip21.web/bt':
+            self._send(200, b'<html/>', 'text/html', {'Set-Cookie': 'JSESSIONID=standin.dip21; Path=/'})
+        elif service == 'dip' and rest == 'dip21.web/searchProcedures/advanced_search_list.do':
+            length = int(self.headers.get('Content-Length', 0))
+            form = parse_qs(self.rfile.read(length).decode('utf-8'))
+            self._send(200, standin.dip_html(form).encode('utf-8'), 'text/html; charset=utf-8')
+        else:
+            self._send(404, b'Not found', 'text/plain')
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class StandIn:
+    """
+    A local stand-in for gesetze-im-internet.de, archive.org,
+    api.offenegesetze.de and dipbt.bundestag.de serving a synthetic
+    corpus.
+
+    Every law has `n_versions` versions of which the latest is served
+    by gii; all of them are listed in the internet archive. Use
+    `redirect` to point librelaws at the stand-in.
+
+    Parameters
+    ----------
+    seed: synthetic.SeedLaw
+        Generator of the law versions
+    n_laws: int
+        Number of laws in the TOC
+    n_versions: int
+        Number of versions of each law
+    latency: float
+        Seconds to wait before answering each request
+    error_rate: float
+        Fraction of requests answered with `503`
+    """
+    def __init__(self, seed, n_laws=100, n_versions=3, latency=0, error_rate=0, rng_seed=0):
+        self.seed = seed
+        self.versions = {'law{:05d}'.format(i): n_versions - 1 for i in range(n_laws)}
+        self.latency = latency
+        self.error_rate = error_rate
+        self._rng = random.Random(rng_seed)
+        self._lock = threading.Lock()
+        self._zips = {}
+        self.last_modified = formatdate(usegmt=True)
+        self.server = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server.server_address[:2])
+
+    def service_url(self, name):
+        """Root of the stand-in for the service `name` of `online_lookups.SERVICE_ROOTS`"""
+        return '{}{}/'.format(self.url, name)
+
+    def should_fail(self):
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def bump(self, abbrev):
+        """Publish a new version of `abbrev`"""
+        self.versions[abbrev] += 1
+
+    def add_law(self, abbrev):
+        """Add a new law to the TOC"""
+        self.versions[abbrev] = 0
+        self.last_modified = formatdate(usegmt=True)
+
+    def etag(self, abbrev, version):
+        return hashlib.sha1('{}/{}'.format(abbrev, version).encode('utf-8')).hexdigest()
+
+    def law_zip(self, abbrev, version):
+        key = (abbrev, version)
+        if key not in self._zips:
+            self._zips[key] = self.seed.law_zip(abbrev, version)
+        return self._zips[key]
+
+    def toc_xml(self):
+        items = ''.join(
+            '<item><title>Gesetz {0}</title><link>{1}{0}/xml.zip</link></item>'.format(abbrev, self.service_url('gii'))
+            for abbrev in sorted(self.versions)
+        )
+        return '<?xml version="1.0" encoding="utf-8"?><items>{}</items>'.format(items).encode('utf-8')
+
+    def _snapshot_ts(self, abbrev, version):
+        cit_date, _ = self.seed.citation(abbrev, version)
+        return (datetime(cit_date.year, cit_date.month, cit_date.day) + timedelta(days=7)).strftime('%Y%m%d%H%M%S')
+
+    def cdx(self, url):
+        abbrev = url.rstrip('/').split('/')[-2]
+        lines = []
+        for v in range(self.versions.get(abbrev, -1) + 1):
+            digest = self.etag(abbrev, v).upper()[:32]
+            lines.append('de,gesetze-im-internet)/{}/xml.zip {} {} application/zip 200 {} 1000'.format(
+                abbrev, self._snapshot_ts(abbrev, v), url, digest
+            ))
+        return '\n'.join(lines) + '\n'
+
+    def archive_version(self, abbrev, ts):
+        for v in range(self.versions.get(abbrev, -1) + 1):
+            if self._snapshot_ts(abbrev, v) == ts:
+                return v
+        return None
+
+    def gazette_issues(self, year):
+        """
+        The BGBl I issues of `year`. Every issue spans 60 pages and
+        issues appear weekly.
+
+        Return
+        ------
+        list of dict: Entries as returned by api.offenegesetze.de
+        """
+        issues = []
+        day = datetime(year, 1, 2)
+        for number in range(1, 53):
+            issues.append({
+                'id': 'bgbl1-{}-{}'.format(year, number),
+                'kind': 'bgbl1',
+                'year': year,
+                'number': number,
+                'date': day.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'page': 1 + 60 * (number - 1),
+                'num_pages': 60,
+            })
+            day += timedelta(days=7)
+        return issues
+
+    def veroeffentlichungen(self, query):
+        year = int(query['year'][0])
+        issues = self.gazette_issues(year)
+        if 'page' in query:
+            page = int(query['page'][0])
+            issues = [i for i in issues if i['page'] <= page < i['page'] + i['num_pages']]
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['20'])[0])
+        nxt = None
+        if offset + limit < len(issues):
+            nxt = '{}v1/veroeffentlichung/?year={}&kind=bgbl1&limit={}&offset={}'.format(
+                self.service_url('offenegesetze'), year, limit, offset + limit
+            )
+        return {'count': len(issues), 'next': nxt, 'previous': None, 'results': issues[offset:offset + limit]}
+
+    def dip_html(self, form):
+        year = form.get('jahrgang', [''])[0]
+        page = form.get('seite', [''])[0]
+        return (
+            '<html><body><form><fieldset><fieldset>'
+            '<fieldset><h1>Gesetzgebung</h1><dl><dt>Vorgang</dt>'
+            '<dd><a href="/dip21.web/searchProcedures/simple_search_detail_vp.do?vorgangId={0}{1}">'
+            'Verfahren zu BGBl I {0} S. {1}</a></dd></dl></fieldset>'
+            '<fieldset><h1>Beratungsstand</h1><dl><dt>Stand</dt><dd>Verkündet</dd></dl></fieldset>'
+            '</fieldset></fieldset></form></body></html>'
+        ).format(year, page)
+
+    def start(self):
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.standin = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @contextmanager
+    def redirect(self):
+        """Point all service roots of `online_lookups` at this stand-in"""
+        names = {'LIBRELAWS_{}_ROOT'.format(name.upper()): name for name in online_lookups.SERVICE_ROOTS}
+        old = {k: os.environ.get(k) for k in names}
+        os.environ.update({k: self.service_url(name) for (k, name) in names.items()})
+        try:
+            yield self
+        finally:
+            for (k, v) in old.items():
+                if v is None:
+                    del os.environ[k]
+                else:
+                    os.environ[k] = v
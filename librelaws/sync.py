@@ -0,0 +1,149 @@
+import concurrent.futures
+import logging
+import threading
+import time
+from os.path import dirname, basename
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from librelaws import online_lookups
+
+
+class GiiWatcher:
+    """
+    Keep `download-dir` in sync with gesetze-im-internet.de.
+
+    The TOC, its validators, the ETags of the local versions and the
+    HTTP connections are kept in memory between polls. Each poll
+    fetches the TOC conditionally and downloads new links right away.
+    Known links are swept with conditional GETs (answered by `304` if
+    unchanged) every `sweep_interval` seconds, since the TOC does not
+    change if only the content of a law does.
+
+    Parameters
+    ----------
+    dl_dir: string
+        Download directory where the local files are stored
+    sweep_interval: float
+        Seconds between two conditional sweeps over all known links
+    max_workers: int
+        Number of concurrent downloads (and kept alive connections)
+    on_update: callable
+        Called with the list of paths of new files after each poll
+        which downloaded anything. If it fails, the files are handed
+        to it again after the next poll.
+    """
+    def __init__(self, dl_dir, sweep_interval=3600, max_workers=8, on_update=None):
+        self.dl_dir = dl_dir
+        self.sweep_interval = sweep_interval
+        self.on_update = on_update
+        self.etags = online_lookups.get_dict_folder_etag(dl_dir)
+        self.links = []
+        self.toc_etag = None
+        self.toc_last_modified = None
+        self.last_sweep = None
+        # New files which `on_update` did not process yet
+        self.pending = []
+        self._local = threading.local()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.toc_session = self._new_session(1)
+
+    @staticmethod
+    def _new_session(pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _session(self):
+        """One warm session per worker thread"""
+        if not hasattr(self._local, 'session'):
+            self._local.session = self._new_session(1)
+        return self._local.session
+
+    def _download(self, link):
+        etag = self.etags.get(basename(dirname(link)), None)
+        return online_lookups.download_gii_if_non_existing(
+            self.dl_dir, link, etag=etag, session=self._session()
+        )
+
+    def links_to_check(self, now):
+        """
+        Refresh the TOC and decide which links need a (conditional) GET
+
+        Return
+        ------
+        list: Links which were added to the TOC, or all links if a sweep is due
+        """
+        links, self.toc_etag, self.toc_last_modified = online_lookups.fetch_toc_gii(
+            session=self.toc_session, etag=self.toc_etag, last_modified=self.toc_last_modified
+        )
+        if links is None:
+            new_links = []
+        else:
+            known = set(self.links)
+            new_links = [l for l in links if l not in known]
+            self.links = links
+        if self.last_sweep is None or now - self.last_sweep >= self.sweep_interval:
+            self.last_sweep = now
+            return list(self.links)
+        return new_links
+
+    def poll(self):
+        """
+        Run one polling cycle
+
+        Return
+        ------
+        list: Paths of the newly downloaded files
+        """
+        links = self.links_to_check(time.monotonic())
+        updates = []
+        for (link, future) in [(l, self.executor.submit(self._download, l)) for l in links]:
+            try:
+                f = future.result()
+            except requests.exceptions.RequestException as e:
+                logging.warning("Failed to fetch {}: {}".format(link, e))
+                continue
+            except Exception:
+                logging.exception("Failed to save {}".format(link))
+                continue
+            if f is not None:
+                updates.append(f)
+                self.etags[basename(dirname(f))] = basename(f)[:-4]
+        logging.info("Checked {} links; {} new files".format(len(links), len(updates)))
+        if self.on_update is not None:
+            self.pending.extend(updates)
+            if self.pending:
+                try:
+                    self.on_update(list(self.pending))
+                except Exception:
+                    logging.exception("Processing {} new files failed; retrying after the next poll".format(
+                        len(self.pending)))
+                else:
+                    self.pending = []
+        return updates
+
+    def run(self, interval=300, max_polls=None):
+        """
+        Poll every `interval` seconds until interrupted or `max_polls`
+        cycles are done
+        """
+        n = 0
+        try:
+            while max_polls is None or n < max_polls:
+                start = time.monotonic()
+                try:
+                    self.poll()
+                except requests.exceptions.RequestException as e:
+                    logging.warning("Polling the TOC failed: {}".format(e))
+                except Exception:
+                    # Keep the daemon alive; the next cycle starts over
+                    logging.exception("Polling failed")
+                n += 1
+                if max_polls is None or n < max_polls:
+                    time.sleep(max(0, interval - (time.monotonic() - start)))
+        finally:
+            self.executor.shutdown()
@@ -0,0 +1,228 @@
+import concurrent.futures
+import copy
+import hashlib
+import io
+import os
+import random
+import zipfile
+from datetime import date, timedelta
+from os import path
+
+from lxml import etree
+
+
+class SeedLaw:
+    """
+    Building blocks for synthetic laws taken from a real xml file of
+    `gesetze-im-internet.de` (eg. `test_files/StGB_pretty.xml`).
+
+    Synthetic laws consist of the header norm of the seed and a window of
+    its norms. All randomness is derived from `rng_seed`, the
+    abbreviation, the norm and the version, so a given law version is
+    identical no matter when or in which process it is generated.
+
+    Parameters
+    ----------
+    fname: str
+        Path to the seed xml file
+    n_norms: int
+        Number of norms per synthetic law
+    change_rate: float
+        Probability of a norm to be amended in a given version
+    rng_seed: int
+        Seed of the generated corpus
+    """
+    def __init__(self, fname, n_norms=20, change_rate=0.2, rng_seed=0):
+        parser = etree.XMLParser(remove_blank_text=True, load_dtd=False, no_network=True)
+        tree = etree.parse(fname, parser)
+        norms = tree.getroot().findall('norm')
+        self.header = norms[0]
+        self.norms = [n for n in norms[1:] if n.find('textdaten/text') is not None]
+        self.n_norms = min(n_norms, len(self.norms))
+        self.change_rate = change_rate
+        self.rng_seed = rng_seed
+
+    def _rng(self, *key):
+        return random.Random(':'.join(str(k) for k in (self.rng_seed, ) + key))
+
+    def last_change(self, abbrev, norm, version):
+        """The latest version (<= `version`) which amended `norm`; 0 if never amended"""
+        for v in range(version, 0, -1):
+            if self._rng(abbrev, norm, v).random() < self.change_rate:
+                return v
+        return 0
+
+    def citation(self, abbrev, version):
+        """
+        Publication date and BGBl I page of the law amending `abbrev` to `version`
+
+        Return
+        ------
+        tuple: (date, page)
+        """
+        rng = self._rng(abbrev, 'citation')
+        day = date(1990, 1, 1) + timedelta(days=rng.randrange(3650))
+        for v in range(version):
+            day += timedelta(days=30 + self._rng(abbrev, 'citation', v).randrange(700))
+        return day, 1 + self._rng(abbrev, 'page', version).randrange(3000)
+
+    def law_xml(self, abbrev, version, citation=None, builddate='20190101000000'):
+        """
+        The xml of version `version` of the synthetic law `abbrev`
+
+        Parameters
+        ----------
+        citation: tuple
+            (date, page) of the amending law; defaults to `citation(abbrev, version)`
+        builddate: str
+            Value of the `builddate` attributes
+
+        Return
+        ------
+        bytes: The serialized xml document
+        """
+        cit_date, page = citation or self.citation(abbrev, version)
+        root = etree.Element('dokumente', builddate=builddate, doknr=abbrev.upper())
+        header = copy.deepcopy(self.header)
+        meta = header.find('metadaten')
+        for tag in ['jurabk', 'amtabk']:
+            node = meta.find(tag)
+            if node is not None:
+                node.text = abbrev.upper()
+        meta.find('langue').text = 'Synthetisches Gesetz {}'.format(abbrev)
+        for node in meta.findall('standangabe'):
+            meta.remove(node)
+        stand = etree.SubElement(meta, 'standangabe', checked='ja')
+        etree.SubElement(stand, 'standtyp').text = 'Stand'
+        etree.SubElement(stand, 'standkommentar').text = 'Zuletzt geändert durch Art. 1 G v. {}.{}.{} I {}'.format(
+            cit_date.day, cit_date.month, cit_date.year, page
+        )
+        root.append(header)
+        offset = self._rng(abbrev, 'offset').randrange(len(self.norms))
+        for i in range(self.n_norms):
+            norm = copy.deepcopy(self.norms[(offset + i) % len(self.norms)])
+            norm.find('metadaten/jurabk').text = abbrev.upper()
+            changed_in = self.last_change(abbrev, i, version)
+            if changed_in:
+                content = norm.find('textdaten/text/Content')
+                if content is None:
+                    content = etree.SubElement(norm.find('textdaten/text'), 'Content')
+                etree.SubElement(content, 'P').text = 'Fassung der Änderung {} von {}.'.format(changed_in, abbrev)
+            root.append(norm)
+        for node in root.iter('dokumente', 'norm'):
+            node.set('builddate', builddate)
+        return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+    def law_zip(self, abbrev, version, **kwargs):
+        """The zipped `law_xml` as it is served by `gesetze-im-internet.de`"""
+        buf = io.BytesIO()
+        # A fixed timestamp keeps the zip, and thereby its file name, reproducible
+        info = zipfile.ZipInfo('{}.xml'.format(abbrev.upper()), date_time=(2019, 1, 1, 0, 0, 0))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with zipfile.ZipFile(buf, 'w') as zf:
+            zf.writestr(info, self.law_xml(abbrev, version, **kwargs))
+        return buf.getvalue()
+
+
+# Seed of the worker processes of `generate_corpus`
+_worker_seed = None
+
+
+def _init_worker(seed_args):
+    global _worker_seed
+    _worker_seed = SeedLaw(*seed_args)
+
+
+def _write_file(dl_dir, day, abbrev, content):
+    folder = path.join(dl_dir, day.isoformat(), abbrev)
+    os.makedirs(folder, exist_ok=True)
+    fname = path.join(folder, hashlib.sha1(content).hexdigest() + '.zip')
+    with open(fname, 'wb') as f:
+        f.write(content)
+    return fname
+
+
+def _write_law(dl_dir, abbrev, acts, churn_rate):
+    """
+    Write all versions of `abbrev`, each amended by one of the (date, page) `acts`
+
+    Return
+    ------
+    tuple: (number of versions, number of builddate-only copies)
+    """
+    seed = _worker_seed
+    rng = seed._rng(abbrev, 'corpus')
+    copies = 0
+    for (version, (act_date, page)) in enumerate(acts):
+        # The new version shows up online a few days after the publication
+        day = act_date + timedelta(days=rng.randrange(1, 30))
+        next_day = acts[version + 1][0] if version + 1 < len(acts) else day + timedelta(days=365)
+        builddate = day.strftime('%Y%m%d') + '000000'
+        _write_file(dl_dir, day, abbrev, seed.law_zip(abbrev, version, citation=(act_date, page), builddate=builddate))
+        # Rebuilds of the same content, which only differ in their `builddate`
+        while rng.random() < churn_rate and (next_day - day).days > 1:
+            day += timedelta(days=rng.randrange(1, (next_day - day).days))
+            builddate = day.strftime('%Y%m%d') + '000000'
+            _write_file(
+                dl_dir, day, abbrev, seed.law_zip(abbrev, version, citation=(act_date, page), builddate=builddate)
+            )
+            copies += 1
+    return len(acts), copies
+
+
+def generate_corpus(dl_dir, seed_file, n_laws=1000, versions=24, n_norms=20, change_rate=0.2,
+                    churn_rate=0.3, laws_per_act=4, start=date(1990, 1, 1), end=date(2019, 1, 1),
+                    rng_seed=0, max_workers=None):
+    """
+    Generate a synthetic `download-dir` in the `date/abbrev/etag.zip` layout.
+
+    Laws are amended by a shared pool of amending acts (Artikelgesetze),
+    each of which changes `laws_per_act` laws on average, so versions of
+    different laws share their citations. Every version may be followed
+    by copies which only differ in their `builddate`, just like repeated
+    downloads from gesetze-im-internet.de.
+
+    Parameters
+    ----------
+    dl_dir: str
+        Directory to write the corpus to
+    seed_file: str
+        Xml file of `gesetze-im-internet.de` the laws are derived from
+    n_laws: int
+        Number of laws
+    versions: int
+        Average number of versions per law
+    n_norms, change_rate:
+        Number of norms per law and probability of each norm to change
+        in a new version; see `SeedLaw`
+    churn_rate: float
+        Probability of a version to be followed by another builddate-only copy
+    laws_per_act: float
+        Average number of laws amended by the same act
+    start, end: date
+        Period in which the amending acts are published
+
+    Return
+    ------
+    dict: With the numbers of 'laws', 'versions' and 'duplicates' written
+    """
+    rng = random.Random('{}:acts'.format(rng_seed))
+    n_acts = max(1, int(n_laws * versions / laws_per_act))
+    days = (end - start).days
+    acts = sorted(
+        (start + timedelta(days=rng.randrange(days)), 1 + rng.randrange(3000)) for _ in range(n_acts)
+    )
+    jobs = []
+    for i in range(n_laws):
+        n_versions = rng.randint(max(1, versions // 2), max(1, versions + versions // 2))
+        jobs.append(('law{:05d}'.format(i), sorted(rng.sample(acts, min(n_versions, n_acts)))))
+    stats = {'laws': n_laws, 'versions': 0, 'duplicates': 0}
+    seed_args = (seed_file, n_norms, change_rate, rng_seed)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker, initargs=(seed_args, )) as executor:
+        futures = [executor.submit(_write_law, dl_dir, abbrev, law_acts, churn_rate) for (abbrev, law_acts) in jobs]
+        for future in futures:
+            n_versions, copies = future.result()
+            stats['versions'] += n_versions
+            stats['duplicates'] += copies
+    return stats
@@ -0,0 +1,166 @@
+import concurrent.futures
+import functools
+import logging
+import os
+import zipfile
+import zlib
+from datetime import datetime
+from os import path
+
+from lxml import etree
+
+from . import index, metrics
+from .fs_operations import all_local_files
+
+
+DTD_FILE = path.join(path.dirname(path.abspath(__file__)), 'assets', 'gii-norm.dtd')
+
+# Hidden, so that the quarantined files are not seen as local versions
+QUARANTINE_DIR = '.quarantine'
+
+
+@functools.lru_cache(maxsize=None)
+def gii_dtd():
+    """The DTD of gesetze-im-internet.de, compiled once per process"""
+    return etree.DTD(DTD_FILE)
+
+
+def verify_file(f):
+    """
+    Check the zip file `f`: the CRCs of all its members, that it holds
+    well formed xml and that the xml is valid according to the DTD of
+    gesetze-im-internet.de. Every member is decompressed only once.
+    This function is run in worker processes.
+
+    Return
+    ------
+    str or None: Description of the first problem found; None if `f` is fine
+    """
+    xml = None
+    try:
+        with zipfile.ZipFile(f) as zf:
+            for info in zf.infolist():
+                # Reading a member to its end checks its CRC
+                data = zf.read(info)
+                if xml is None and '.xml' in info.filename:
+                    xml = data
+    except (zipfile.BadZipFile, zlib.error, EOFError, OSError) as exc:
+        return 'Corrupt zip: {}'.format(exc)
+    if xml is None:
+        return 'No xml file in zip'
+    try:
+        xml = etree.fromstring(xml)
+    except etree.XMLSyntaxError as exc:
+        return 'Malformed xml: {}'.format(exc)
+    dtd = gii_dtd()
+    if not dtd.validate(xml):
+        errors = dtd.error_log.filter_from_errors()
+        # The log may hold only warnings
+        return 'Invalid xml: {}'.format(errors[0] if errors else 'does not match the DTD')
+    return None
+
+
+def _stamp(f):
+    st = os.stat(f)
+    return st.st_size, st.st_mtime_ns
+
+
+def verify_files(files, max_workers=None):
+    """
+    Verify `files` in worker processes
+
+    Return
+    ------
+    dict: {filepath: problem} of the files which failed
+    """
+    files = list(files)
+    bad = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(functools.partial(metrics.collecting, verify_file), files, chunksize=8)
+        for (f, (problem, snapshot)) in zip(files, results):
+            metrics.merge(snapshot)
+            metrics.inc('librelaws_verified_files_total', result='ok' if problem is None else 'bad')
+            if problem is not None:
+                bad[f] = problem
+    return bad
+
+
+def quarantine(dl_dir, files):
+    """
+    Move `files` to the hidden quarantine folder of `dl_dir`, keeping
+    their `date/abbrev/name.zip` layout. A file which was quarantined
+    before gets a timestamp added to its name, so earlier copies are
+    kept.
+
+    Return
+    ------
+    list: New paths of the files
+    """
+    dl_dir = path.expanduser(dl_dir)
+    moved = []
+    for f in files:
+        target = path.join(dl_dir, QUARANTINE_DIR, path.relpath(f, dl_dir))
+        if path.exists(target):
+            root, ext = path.splitext(target)
+            target = '{}.{}{}'.format(root, datetime.now().strftime('%Y%m%dT%H%M%S%f'), ext)
+        os.makedirs(path.dirname(target), exist_ok=True)
+        os.replace(f, target)
+        try:
+            # abbrev and date folders, if now empty
+            os.rmdir(path.dirname(f))
+            os.rmdir(path.dirname(path.dirname(f)))
+        except OSError:
+            # Folder was not empty
+            pass
+        moved.append(target)
+    return moved
+
+
+def verify(dl_dir, files=None, move=True, max_workers=None):
+    """
+    Verify the files of `dl_dir` (or only `files`) and quarantine the
+    bad ones. If `dl_dir` has a version index, the size and mtime of
+    every file that passed are recorded there and files that did not
+    change since are skipped; quarantined files are dropped from it.
+
+    Parameters
+    ----------
+    files: list
+        Paths inside of `dl_dir`, eg. those of a download; defaults to all local files
+    move: bool
+        Move bad files to the quarantine; otherwise only report them
+
+    Return
+    ------
+    tuple: ({filepath: problem} of the bad files, number of verified files)
+    """
+    dl_dir = path.expanduser(dl_dir)
+    files = all_local_files(dl_dir) if files is None else list(files)
+    conn = index.open_index(dl_dir) if index.index_exists(dl_dir) else None
+    try:
+        if conn is not None:
+            rows = conn.execute('SELECT path, size, mtime FROM verified')
+            verified = {rp: (size, mtime) for (rp, size, mtime) in rows}
+            todo = [f for f in files if verified.get(path.relpath(f, dl_dir)) != _stamp(f)]
+            metrics.inc('librelaws_cache_requests_total', len(files) - len(todo), cache='verified', result='hit')
+            metrics.inc('librelaws_cache_requests_total', len(todo), cache='verified', result='miss')
+        else:
+            todo = files
+        bad = verify_files(todo, max_workers=max_workers)
+        for (f, problem) in sorted(bad.items()):
+            logging.warning("%s is bad: %s", f, problem)
+        if move:
+            quarantine(dl_dir, sorted(bad))
+        if conn is not None:
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO verified (path, size, mtime) VALUES (?, ?, ?)',
+                    [(path.relpath(f, dl_dir), ) + _stamp(f) for f in todo if f not in bad]
+                )
+                conn.executemany('DELETE FROM verified WHERE path = ?', [(path.relpath(f, dl_dir), ) for f in bad])
+            if move:
+                index.drop_versions(conn, [path.relpath(f, dl_dir) for f in bad])
+    finally:
+        if conn is not None:
+            conn.close()
+    return bad, len(todo)
@@ -6,7 +6,10 @@ import logging
 
 from lxml import etree
 
+from librelaws import metrics
 
+
+@metrics.timed('zip_to_xml')
 def zip_to_xml(file):
     """
     Parse the first xml file found in a zip `file` downloaded from
@@ -25,6 +28,36 @@ def extract_long_name(xml):
     return xml.find("//langue").text
 
 
+def extract_norms(xml):
+    """
+    Extract the plain text of every norm which has a text body.
+
+    The label of a norm is its `enbez` (eg. `§ 1`), falling back to
+    the `gliederungsbez` of structural nodes. Whitespace in the text
+    is normalized to single spaces.
+
+    Return
+    ------
+    list of tuple: [(label, text)]
+    """
+    norms = []
+    for norm in xml.iter('norm'):
+        text_node = norm.find('textdaten/text')
+        if text_node is None:
+            continue
+        text = ' '.join(' '.join(text_node.itertext()).split())
+        if not text:
+            continue
+        label = (
+            norm.findtext('metadaten/enbez')
+            or norm.findtext('metadaten/gliederungseinheit/gliederungsbez')
+            or ''
+        )
+        norms.append((label.strip(), text))
+    return norms
+
+
+@metrics.timed('transform_gii_xml_to_html')
 def transform_gii_xml_to_html(xml):
     """
     Transfom the xml format of `gesetze-im-internet.de`
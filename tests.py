@@ -1,18 +1,54 @@
+import concurrent.futures
 from datetime import datetime
+import json
 import os
+import sqlite3
+import subprocess
+import sys
 from os import path
 from unittest import TestCase, skip
 import tempfile
+import tracemalloc
+import zipfile
 from datetime import date
 
 from lxml import etree
 import pygit2
 import pytest
+import requests
 import pypandoc
 
 from librelaws import (
-    online_lookups, xml_operations, fs_operations, cli, git, conversion
+    online_lookups, xml_operations, fs_operations, cli, git, conversion, index, sync, metrics
 )
+from librelaws.standin import StandIn
+from librelaws import synthetic, external_sort, distributed, clean, cabinets, gazette, bgbl, verify, feed
+from librelaws.synthetic import SeedLaw
+
+STGB_XML = path.join(path.dirname(path.abspath(__file__)), 'test_files', 'StGB_pretty.xml')
+
+
+def write_law_zip(dl_dir, day, abbrev, name, replacements=()):
+    """Store a (modified) copy of the StGB test file in the `date/abbrev/name.zip` layout"""
+    with open(STGB_XML, encoding='utf-8') as f:
+        content = f.read()
+    for (old, new) in replacements:
+        content = content.replace(old, new)
+    folder = path.join(str(dl_dir), day, abbrev)
+    os.makedirs(folder, exist_ok=True)
+    fname = path.join(folder, name + '.zip')
+    with zipfile.ZipFile(fname, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('BJNR001270871.xml', content)
+    return fname
+
+
+@pytest.fixture
+def standin():
+    """A local stand-in for all remote services serving five synthetic laws"""
+    server = StandIn(SeedLaw(STGB_XML), n_laws=5, n_versions=3).start()
+    with server.redirect():
+        yield server
+    server.stop()
 
 
 @pytest.fixture(scope='session')
@@ -126,6 +162,14 @@ class TestCli(TestCase):
                 [tmpdir, 'download', '--source', 'not-a-source']
             )
 
+    def test_show_norm_has_no_format(self):
+        parser = cli.create_parser()
+        self.assertRaises(
+            SystemExit,
+            parser.parse_args,
+            ['dl', 'show', 'stgb', '--norm', '§ 1', '--format', 'xml']
+        )
+
     @skip
     def test_dl_gii(self):
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -162,6 +206,36 @@ class TestGit(TestCase):
         git.cabinet_sig(date(day=17, month=12, year=2013))
         git.cabinet_sig(datetime(day=17, month=12, year=2013))
 
+    def test_cabinet_table(self):
+        table = cabinets.default_table()
+        self.assertEqual(table.lookup(date(2013, 12, 16))[0], 'Merkel cabinet II')
+        self.assertEqual(table.lookup(datetime(2013, 12, 17, 12))[0], 'Merkel cabinet III')
+        with self.assertRaises(ValueError):
+            table.lookup(date(1949, 9, 19))
+        sig = git.cabinet_sig(date(1998, 10, 27))
+        self.assertEqual((sig.name, sig.email), ('Schröder cabinet I', 'Schröder@bundesregierung.de'))
+        # Pre-1970 timestamps are clamped
+        self.assertEqual(git.cabinet_sig(date(1960, 1, 1)).time, 0)
+        dates = [date(2019, 1, 1), date(1950, 1, 1), date(2019, 1, 1), date(1983, 3, 30)]
+        self.assertEqual(
+            [(s.name, s.time) for s in table.signatures(dates)],
+            [(table.signature(d).name, table.signature(d).time) for d in dates]
+        )
+
+    def test_extra_cabinets(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = path.join(tmpdir, 'laender.csv')
+            with open(fname, 'w', encoding='utf-8') as f:
+                f.write('jurisdiction,name,email,start,end,parties\n'
+                        'by,Söder cabinet I,Soeder@bayern.de,2018-03-21,2018-11-12,CSU\n')
+            table = cabinets.CabinetTable.from_csv(cabinets.CABINETS_FILE, fname)
+        self.assertEqual(table.lookup(date(2018, 5, 1), 'by')[0], 'Söder cabinet I')
+        self.assertEqual(table.lookup(date(2018, 5, 1))[0], 'Merkel cabinet IV')
+        with self.assertRaises(ValueError):
+            table.signatures([date(2018, 5, 1), date(2019, 1, 1)], 'by')
+        with self.assertRaisesRegex(ValueError, "Unknown jurisdiction 'be'. Known jurisdictions: bund, by"):
+            table.lookup(date(2018, 5, 1), 'be')
+
 
 def test_augmentation(local_dir):
     # Only five links to speed things up
@@ -182,3 +256,599 @@ def test_git_commit():
         for (f, cit, aug) in augmented_files:
             msg = git.prepare_commit_message(f, aug)
             git.commit_update(f, cit, msg, repo)
+
+
+def test_index_search_as_of(tmpdir):
+    write_law_zip(tmpdir, '2019-01-02', 'stgb', 'a')
+    # The second version is cited on 2019-06-01 and rewords § 212
+    write_law_zip(tmpdir, '2019-06-10', 'stgb', 'b', replacements=[
+        ('v. 13.11.1998 I 3322', 'v. 1.6.2019 I 100'),
+        ('als Totschläger', 'als Totschlägerin oder Totschläger'),
+    ])
+    added, removed = index.update_index(str(tmpdir))
+    assert (added, removed) == (2, 0)
+    # Nothing changes on the second run
+    assert index.update_index(str(tmpdir)) == (0, 0)
+
+    conn = index.open_index(str(tmpdir))
+    hits = index.search(conn, 'als Totschläger mit', as_of=date(2019, 3, 1))
+    assert [(h[0], h[1], h[3], h[4]) for h in hits] == [('stgb', '§ 212', '1998-11-13', '2019-06-01')]
+    assert index.search(conn, 'als Totschläger mit', as_of=date(2019, 6, 1)) == []
+    assert len(index.search(conn, 'Totschlägerin', as_of=date(2019, 6, 1))) == 1
+    assert index.search(conn, 'Totschlägerin', as_of=date(2018, 1, 1)) == []
+    # Unchanged norms are only stored once
+    n_texts = conn.execute('SELECT count(*) FROM text_digests').fetchone()[0]
+    n_first = conn.execute('SELECT count(DISTINCT text_id) FROM norms WHERE version_id = 1').fetchone()[0]
+    assert n_texts == n_first + 1
+
+
+def test_version_lookup(tmpdir):
+    write_law_zip(tmpdir, '2019-01-02', 'stgb', 'a')
+    write_law_zip(tmpdir, '2019-06-10', 'stgb', 'b', replacements=[
+        ('v. 13.11.1998 I 3322', 'v. 1.6.2019 I 100'),
+        ('als Totschläger', 'als Totschlägerin oder Totschläger'),
+    ])
+    index.update_index(str(tmpdir))
+    lookup = index.VersionLookup(str(tmpdir))
+    assert lookup.version_at('stgb', date(2019, 5, 31))[1].endswith('a.zip')
+    assert lookup.version_at('stgb', date(2019, 6, 1))[1].endswith('b.zip')
+    assert 'Totschlägerin' not in lookup.norm_at('stgb', date(2000, 1, 1), '§212')
+    assert 'Totschlägerin' in lookup.norm_at('stgb', date(2020, 1, 1), '§ 212')
+    xml = lookup.xml_at('stgb', date(2020, 1, 1))
+    assert xml_operations.extract_long_name(xml) == 'Strafgesetzbuch'
+    with pytest.raises(ValueError):
+        lookup.version_at('stgb', date(1990, 1, 1))
+    with pytest.raises(ValueError):
+        lookup.version_at('bgb', date(2020, 1, 1))
+    lookup.close()
+
+
+def test_watch_conditional_polls(standin):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        watcher = sync.GiiWatcher(tmpdirname, sweep_interval=3600)
+        links = watcher.links_to_check(0)
+        assert len(links) == 5
+        # The TOC did not change and no sweep is due; nothing to check
+        assert watcher.links_to_check(1) == []
+        # Sweeps include all known links
+        assert watcher.links_to_check(3601) == links
+
+        watcher.last_sweep = None
+        assert len(watcher.poll()) == 5
+        standin.bump('law00002')
+        standin.add_law('law99999')
+        # The new law is fetched right away, the changed one with the next sweep
+        assert [path.basename(path.dirname(f)) for f in watcher.poll()] == ['law99999']
+        watcher.last_sweep = None
+        assert [path.basename(path.dirname(f)) for f in watcher.poll()] == ['law00002']
+        watcher.executor.shutdown()
+
+
+def test_watch_retries_failed_updates(standin):
+    seen = []
+
+    def on_update(files):
+        seen.append(len(files))
+        if len(seen) == 1:
+            raise ValueError("No index")
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        watcher = sync.GiiWatcher(tmpdirname, on_update=on_update)
+        # The failing callback does not stop the watcher...
+        watcher.run(interval=0, max_polls=2)
+        # ...and the files are handed to it again after the next poll
+        assert seen == [5, 5]
+        assert watcher.pending == []
+
+
+class TestMetrics(TestCase):
+    def test_render_and_merge(self):
+        registry = metrics.Registry()
+        registry.inc('librelaws_http_requests_total', host='gii', status='304')
+        registry.observe('librelaws_stage_duration_seconds', 0.02, stage='zip_to_xml')
+        worker = metrics.Registry()
+        worker.inc('librelaws_http_requests_total', 2, host='gii', status='304')
+        worker.observe('librelaws_stage_duration_seconds', 100, stage='zip_to_xml')
+        registry.merge(worker.snapshot())
+        text = registry.render()
+        self.assertIn('librelaws_http_requests_total{host="gii",status="304"} 3', text)
+        self.assertIn('librelaws_stage_duration_seconds_bucket{stage="zip_to_xml",le="0.025"} 1', text)
+        self.assertIn('librelaws_stage_duration_seconds_bucket{stage="zip_to_xml",le="+Inf"} 2', text)
+        self.assertIn('librelaws_stage_duration_seconds_count{stage="zip_to_xml"} 2', text)
+
+    def test_collected_in_workers(self):
+        metrics.REGISTRY.reset()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_law_zip(tmpdir, '2019-01-02', 'stgb', 'a')
+            index.update_index(tmpdir, max_workers=1)
+        summary = metrics.REGISTRY.summary()
+        self.assertEqual(summary['histograms']['librelaws_stage_duration_seconds{stage=zip_to_xml}']['count'], 1)
+        self.assertEqual(summary['counters']['librelaws_cache_requests_total{cache=version_index}{result=miss}'], 1)
+
+
+def test_profile_flag(tmpdir, capsys):
+    dl_dir = tmpdir.mkdir('dl')
+    write_law_zip(dl_dir, '2019-01-02', 'stgb', 'a')
+    write_law_zip(dl_dir, '2019-01-03', 'stgb', 'a')
+    profile_dir = str(tmpdir.join('profiles'))
+    args = cli.create_parser().parse_args(['--profile', '--profile-dir', profile_dir, str(dl_dir), 'clean'])
+    cli.run(args)
+    out = capsys.readouterr().out
+    assert 'hash_without_builddate' in out
+    assert 'zip_to_xml' in out
+    assert len([f for f in os.listdir(profile_dir) if f.startswith('clean-')]) == 2
+
+
+def test_download_from_standin(standin, tmpdir, capsys):
+    args = cli.create_parser().parse_args([str(tmpdir), 'download', '--source', 'gii', '--quiet'])
+    metrics.REGISTRY.reset()
+    args.func(args)
+    assert len(fs_operations.all_local_files(str(tmpdir))) == 5
+    # All laws are answered with `304` the second time
+    args.func(args)
+    assert len(fs_operations.all_local_files(str(tmpdir))) == 5
+    summary = metrics.REGISTRY.summary()['counters']
+    assert summary['librelaws_cache_requests_total{cache=http}{result=hit}'] == 5
+    assert "0 new files were downloaded" in capsys.readouterr().out
+
+
+def test_standin_error_injection(standin):
+    standin.error_rate = 1
+    with pytest.raises(requests.exceptions.HTTPError):
+        online_lookups.get_links_gii()
+
+
+def test_metrics_of_failed_workers(standin):
+    standin.error_rate = 1
+    metrics.REGISTRY.reset()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(metrics.collecting, online_lookups.get_links_gii)
+        with pytest.raises(requests.exceptions.HTTPError) as exc:
+            future.result()
+    metrics.merge_failed(exc.value)
+    counters = metrics.REGISTRY.summary()['counters']
+    assert any(k.startswith('librelaws_http_requests_total') and '503' in k for k in counters)
+
+
+def test_generate_corpus(tmpdir):
+    args = cli.create_parser().parse_args([
+        str(tmpdir), 'generate', STGB_XML, '--laws', '10', '--versions', '4', '--churn-rate', '0.5'
+    ])
+    args.func(args)
+    stats = synthetic.generate_corpus(
+        str(tmpdir.join('again')), STGB_XML, n_laws=10, versions=4, churn_rate=0.5, max_workers=2
+    )
+    files = fs_operations.all_local_files(str(tmpdir.join('again')))
+    assert len(files) == stats['versions'] + stats['duplicates']
+    # The corpus is reproducible
+    assert [path.relpath(f, str(tmpdir)) for f in fs_operations.all_local_files(str(tmpdir)) if 'again' not in f] \
+        == [path.relpath(f, str(tmpdir.join('again'))) for f in files]
+    # Exactly the builddate-only copies are duplicates
+    assert len(fs_operations.find_duplicates(files)) == stats['duplicates']
+    # Amending acts are shared between laws
+    citations = [xml_operations.Citation.from_xml(xml_operations.zip_to_xml(f)) for f in files]
+    assert len({(c.date(), c.page) for c in citations}) < stats['versions']
+
+
+class TestExternalSort(TestCase):
+    def test_spills_and_merges(self):
+        records = [[i * 7919 % 1000, str(i)] for i in range(1000)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out = list(external_sort.sorted_records(iter(records), key=lambda r: r[0], chunk_size=30, fan_in=4,
+                                                    tmp_dir=tmpdir))
+            # All runs are cleaned up
+            self.assertEqual(os.listdir(tmpdir), [])
+        self.assertEqual(out, sorted(records))
+
+    def test_in_memory(self):
+        out = list(external_sort.sorted_records([(2, 'b'), (1, 'a')], key=lambda r: r[0]))
+        self.assertEqual(out, [[1, 'a'], [2, 'b']])
+
+
+def _peak_memory_of_sorted_versions(dl_dir):
+    tracemalloc.start()
+    try:
+        n = 0
+        for _ in git.iter_sorted_versions(fs_operations.iter_local_files(dl_dir), chunk_size=60, window=4,
+                                          max_workers=1, fan_in=2):
+            n += 1
+        return n, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_sorted_versions_memory_is_flat(tmpdir):
+    small, large = str(tmpdir.join('small')), str(tmpdir.join('large'))
+    synthetic.generate_corpus(small, STGB_XML, n_laws=40, versions=6, n_norms=3, churn_rate=0)
+    synthetic.generate_corpus(large, STGB_XML, n_laws=240, versions=6, n_norms=3, churn_rate=0)
+    n_small, peak_small = _peak_memory_of_sorted_versions(small)
+    n_large, peak_large = _peak_memory_of_sorted_versions(large)
+    assert n_large > 5 * n_small
+    assert peak_large < 1.25 * peak_small
+
+    dates = [cit.date() for (_, cit) in git.iter_sorted_versions(fs_operations.iter_local_files(large), chunk_size=20)]
+    assert dates == sorted(dates)
+
+
+def test_streaming_history(standin, tmpdir):
+    dl_dir, git_dir = str(tmpdir.join('dl')), str(tmpdir.join('git'))
+    stats = synthetic.generate_corpus(dl_dir, STGB_XML, n_laws=4, versions=3, n_norms=3, churn_rate=0)
+    n = git.build_history_streaming(fs_operations.iter_local_files(dl_dir), git_dir, chunk_size=3, window=2)
+    assert n == stats['versions']
+    repo = pygit2.Repository(git_dir)
+    times = [c.commit_time for c in repo.walk(repo.head.target)]
+    assert len(times) == n
+    assert times == sorted(times, reverse=True)
+
+
+def test_sharded_history(standin, tmpdir):
+    dl_dir = str(tmpdir.join('dl'))
+    stats = synthetic.generate_corpus(dl_dir, STGB_XML, n_laws=4, versions=3, n_norms=3, churn_rate=0)
+    serial, sharded = str(tmpdir.join('serial')), str(tmpdir.join('sharded'))
+    git.build_history_streaming(fs_operations.iter_local_files(dl_dir), serial)
+    n = git.build_history_sharded(fs_operations.iter_local_files(dl_dir), sharded, max_workers=2)
+    assert n == stats['versions']
+    assert sorted(os.listdir(git.default_shard_dir(sharded))) == ['law00000', 'law00001', 'law00002', 'law00003']
+    repo, expected = pygit2.Repository(sharded), pygit2.Repository(serial)
+    times = [c.commit_time for c in repo.walk(repo.head.target)]
+    assert len(times) == n
+    assert times == sorted(times, reverse=True)
+    # Same final state and the same messages as the serial build
+    assert repo[repo.head.target].tree.id == expected[expected.head.target].tree.id
+    assert (sorted(c.message for c in repo.walk(repo.head.target))
+            == sorted(c.message for c in expected.walk(expected.head.target)))
+    # The working directory is checked out, so the history can be extended
+    assert sorted(f for f in os.listdir(sharded) if f.endswith('.md')) == [
+        'law00000.md', 'law00001.md', 'law00002.md', 'law00003.md'
+    ]
+    assert not repo.status()
+    # Building again replaces the merged history instead of stacking a copy on top
+    assert git.build_history_sharded(fs_operations.iter_local_files(dl_dir), sharded, max_workers=2) == n
+    repo = pygit2.Repository(sharded)
+    assert len(list(repo.walk(repo.head.target))) == n
+    assert repo[repo.head.target].tree.id == expected[expected.head.target].tree.id
+
+
+class TestWorkQueue(TestCase):
+    def test_lease_ack_and_retry(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queue = distributed.WorkQueue(path.join(tmpdir, 'queue.sqlite'), lease_seconds=60, max_attempts=2)
+            queue.put('fingerprint', [{'path': 'a'}, {'path': 'b'}])
+            a = queue.lease('w1')
+            b = queue.lease('w2')
+            self.assertEqual((a.payload, b.payload), ({'path': 'a'}, {'path': 'b'}))
+            self.assertIsNone(queue.lease('w3'))
+            self.assertTrue(queue.ack(a, 'w1', 'digest-a'))
+            # Failed tasks are retried until they run out of attempts
+            queue.fail(b, 'w2', 'boom')
+            b = queue.lease('w3')
+            self.assertEqual(b.attempts, 2)
+            queue.fail(b, 'w3', 'boom')
+            self.assertIsNone(queue.lease('w1'))
+            self.assertEqual(queue.counts(), {'done': 1, 'failed': 1})
+            self.assertEqual(queue.results('fingerprint'), [({'path': 'a'}, 'digest-a')])
+            self.assertEqual(queue.errors(), [({'path': 'b'}, 'boom')])
+            queue.close()
+
+    def test_expired_lease(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queue = distributed.WorkQueue(path.join(tmpdir, 'queue.sqlite'), lease_seconds=-1)
+            queue.put('augment', [{'path': 'a'}])
+            task = queue.lease('dead')
+            # The lease expired, so another worker takes over and the late ack is rejected
+            self.assertEqual(queue.lease('alive').id, task.id)
+            self.assertFalse(queue.ack(task, 'dead', None))
+            queue.close()
+
+    def test_workers_use_the_coordinators_settings(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = path.join(tmpdir, 'queue.sqlite')
+            coordinator = distributed.WorkQueue(fname, lease_seconds=-1, max_attempts=2)
+            coordinator.reset()
+            worker = distributed.WorkQueue(fname)
+            self.assertEqual((worker.lease_seconds, worker.max_attempts), (-1, 2))
+            # A task whose worker dies in every attempt fails instead of being leased forever
+            coordinator.put('render', [{'abbrev': 'a'}])
+            self.assertEqual(worker.lease('crash1').attempts, 1)
+            self.assertEqual(worker.lease('crash2').attempts, 2)
+            self.assertIsNone(worker.lease('w3'))
+            self.assertEqual(coordinator.counts(), {'failed': 1})
+            self.assertEqual(coordinator.errors(), [({'abbrev': 'a'}, 'Lease of crash2 expired in the last attempt')])
+            coordinator.wait('render', poll_interval=0)
+            worker.close()
+            coordinator.close()
+
+
+def test_distributed_rebuild(standin, tmpdir):
+    dl_dir, git_dir = str(tmpdir.join('dl')), str(tmpdir.join('git'))
+    synthetic.generate_corpus(dl_dir, STGB_XML, n_laws=3, versions=3, n_norms=3, churn_rate=0.5)
+    summary = distributed.coordinate(
+        str(tmpdir.join('queue.sqlite')), dl_dir, git_dir, local_workers=2, poll_interval=0.05
+    )
+    assert summary == {'download': 0, 'fingerprint': 0, 'augment': 0, 'render': 0, 'commits': summary['commits']}
+    files = fs_operations.all_local_files(dl_dir)
+    unique = len(files) - len(fs_operations.find_duplicates(files))
+    repo = pygit2.Repository(git_dir)
+    assert summary['commits'] == unique == len(list(repo.walk(repo.head.target)))
+    assert sorted(e.name for e in repo[repo.head.target].tree) == ['law{:05d}.md'.format(i) for i in range(5)]
+    # The proceedings were looked up by the workers
+    assert all('Verfahren zu BGBl I' in c.message for c in repo.walk(repo.head.target))
+
+
+HEAVY_MODULES = ['requests', 'pygit2', 'pypandoc', 'lxml.etree', 'tqdm']
+
+
+def _import_times(statement):
+    """Cumulative import time in microseconds of each module imported by `statement` in a fresh interpreter"""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement], stderr=subprocess.PIPE, universal_newlines=True,
+        cwd=path.dirname(path.abspath(__file__)), check=True
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_import_time():
+    times = _import_times('import librelaws.cli')
+    assert not set(HEAVY_MODULES) & set(times)
+    heavy = _import_times('import ' + ', '.join(HEAVY_MODULES))
+    assert times['librelaws.cli'] < 0.5 * sum(heavy[m] for m in HEAVY_MODULES)
+    # History building does not pay for pygit2 and pandoc until it commits
+    assert not {'pygit2', 'pypandoc', 'requests'} & set(_import_times('import librelaws.git'))
+    assert cli.STAGES == distributed.STAGES
+
+
+def test_clean_without_index(tmpdir):
+    dl_dir = str(tmpdir)
+    synthetic.generate_corpus(dl_dir, STGB_XML, n_laws=4, versions=3, n_norms=3, churn_rate=0.5)
+    files = fs_operations.all_local_files(dl_dir)
+    expected = fs_operations.find_duplicates(files)
+    assert expected
+    plan, freed = clean.clean(dl_dir, dry_run=True, max_workers=2)
+    assert sorted(dup for (dup, _) in plan) == sorted(expected)
+    assert freed == sum(os.path.getsize(f) for f in expected)
+    assert fs_operations.all_local_files(dl_dir) == files
+    clean.clean(dl_dir, max_workers=2)
+    assert fs_operations.all_local_files(dl_dir) == sorted(set(files) - set(expected))
+
+
+def test_clean_with_index_and_hardlinks(tmpdir):
+    dl_dir = str(tmpdir)
+    write_law_zip(dl_dir, '2019-01-02', 'stgb', 'a')
+    write_law_zip(dl_dir, '2019-01-03', 'stgb', 'b', [('builddate="201812282120', 'builddate="201901031200')])
+    index.update_index(dl_dir, max_workers=1)
+    plan, _ = clean.clean(dl_dir, strategy='hardlink', max_workers=1)
+    original = path.join(dl_dir, '2019-01-02', 'stgb', 'a.zip')
+    assert plan == [(path.join(dl_dir, '2019-01-03', 'stgb', 'b.zip'), original)]
+    # The duplicate is still indexed and readable at its path
+    assert os.path.samefile(plan[0][0], original)
+    assert index.update_index(dl_dir) == (0, 0)
+    # Only versions added since the last clean are considered
+    assert clean.clean(dl_dir, strategy='hardlink', max_workers=1) == ([], 0)
+    new = write_law_zip(dl_dir, '2019-01-04', 'stgb', 'c', [('builddate="201812282120', 'builddate="201901041200')])
+    write_law_zip(dl_dir, '2019-01-04', 'stgb', 'd', [('Strafgesetzbuch', 'Strafgesetzbuch (neu)')])
+    plan, freed = clean.clean(dl_dir, strategy='delete', max_workers=1)
+    assert plan == [(new, original)]
+    assert not path.exists(new)
+    conn = index.open_index(dl_dir)
+    assert conn.execute('SELECT count(*) FROM versions WHERE cleaned = 0').fetchone()[0] == 0
+    assert conn.execute('SELECT count(*) FROM versions').fetchone()[0] == 3
+    assert conn.execute('SELECT path, original FROM links').fetchall() == [
+        (path.join('2019-01-03', 'stgb', 'b.zip'), path.join('2019-01-02', 'stgb', 'a.zip'))
+    ]
+    conn.close()
+
+
+def test_clean_counts_reflinks_once(tmpdir):
+    dl_dir = str(tmpdir)
+    original = write_law_zip(dl_dir, '2019-01-02', 'stgb', 'a')
+    dup = write_law_zip(dl_dir, '2019-01-03', 'stgb', 'b', [('builddate="201812282120', 'builddate="201901031200')])
+    probe = str(tmpdir.join('probe'))
+    try:
+        fs_operations._reflink(original, probe)
+    except OSError:
+        pytest.skip('The file system does not support reflinks')
+    finally:
+        if path.exists(probe):
+            os.remove(probe)
+    index.update_index(dl_dir, max_workers=1)
+    plan, freed = clean.clean(dl_dir, strategy='reflink', max_workers=1)
+    assert plan == [(dup, original)]
+    assert freed == path.getsize(dup)
+    # A new copy brings the version back into the plan, but not its reflink, which takes no space
+    new = write_law_zip(dl_dir, '2019-01-04', 'stgb', 'c', [('builddate="201812282120', 'builddate="201901041200')])
+    assert clean.clean(dl_dir, strategy='reflink', dry_run=True, max_workers=1) == (
+        [(new, original)], path.getsize(new)
+    )
+
+
+def _http_requests():
+    counters = metrics.REGISTRY.snapshot()['counters']
+    return sum(v for ((name, _), v) in counters.items() if name == 'librelaws_http_requests_total')
+
+
+def test_gazette_index(standin):
+    gazettes = gazette.GazetteIndex()
+    citations = [xml_operations.Citation('BGBl I', year, page=page) for year in (2018, 2019) for page in range(1, 3121)]
+    citations.append(xml_operations.Citation('BGBl I', 2019, page=5000))
+    before = _http_requests()
+    assert gazettes.resolve(citations) == 2 * 3120
+    # One paginated index per year
+    assert _http_requests() - before == 2
+    assert citations[0].date() == date(2018, 1, 2)
+    assert citations[60].date() == date(2018, 1, 9)
+    assert citations[3120 + 59].date() == date(2019, 1, 2)
+    assert citations[-1].month is None
+    issues = online_lookups.fetch_bgbl_issues(1, 2019, limit=20)
+    assert [i['number'] for i in issues] == list(range(1, 53))
+
+
+def test_fundstelle_citations_enter_history(standin, tmpdir):
+    dl_dir = tmpdir.mkdir('dl')
+    fundstelle_only = [
+        ('<standkommentar>', '<kommentar>'), ('</standkommentar>', '</kommentar>'),
+        ('<periodikum>RGBl</periodikum>', '<periodikum>BGBl I</periodikum>'),
+        ('<zitstelle>1871, 127</zitstelle>', '<zitstelle>2019, 61</zitstelle>'),
+    ]
+    f = write_law_zip(dl_dir, '2019-02-01', 'stgb', 'a', fundstelle_only)
+    assert git.file_citation(f) is None
+    [(_, cit, _)] = git.augment_and_filter_files([f])
+    assert cit.date() == date(2019, 1, 9)
+    [(_, cit)] = list(git.iter_sorted_versions([f], max_workers=1))
+    assert cit.date() == date(2019, 1, 9)
+    # The sharded and distributed builds complete the citation the same way
+    assert git.build_history_sharded([f], str(tmpdir.join('git')), augment=False, max_workers=1) == 1
+    assert distributed._augment(str(dl_dir), {'path': path.relpath(f, str(dl_dir))}) is not None
+
+
+def test_bgbl_index(standin, tmpdir):
+    dl_dir = tmpdir.mkdir('dl')
+    f = write_law_zip(dl_dir, '2019-02-01', 'stgb', 'a', [
+        ('<standkommentar>', '<kommentar>'), ('</standkommentar>', '</kommentar>'),
+        ('<periodikum>RGBl</periodikum>', '<periodikum>BGBl I</periodikum>'),
+        ('<zitstelle>1871, 127</zitstelle>', '<zitstelle>2019, 61</zitstelle>'),
+    ])
+    assert bgbl.local_citations(str(dl_dir), max_workers=1) == {(1, 2019, 61)}
+    # Failed lookups are skipped and tried again by the next build
+    standin.error_rate = 1
+    assert bgbl.build_index(str(dl_dir), [2018, 2019], parts=[1], citations=[(1, 2019, 61)]) == (0, 0)
+    standin.error_rate = 0
+    assert bgbl.build_index(str(dl_dir), [2018, 2019], parts=[1], citations=[(1, 2019, 61)]) == (2, 1)
+    index = bgbl.load_index(str(dl_dir))
+    assert index.covers(1, 2019) and not index.covers(2, 2019)
+    assert index.date(1, 2019, 61) == date(2019, 1, 9)
+    with pytest.raises(ValueError):
+        index.date(1, 2019, 5000)
+    assert index.proceedings_id(1, 2019, 61) > 0
+    assert index.proceedings_id(1, 2019, 62) is None
+    # Nothing but the current year is fetched again
+    assert bgbl.build_index(str(dl_dir), [2018, 2019], parts=[1], citations=[(1, 2019, 61)]) == (0, 0)
+    before = _http_requests()
+    gazettes = gazette.GazetteIndex(local=index)
+    cit = xml_operations.Citation('BGBl I', 2019, page=61)
+    assert gazettes.resolve([cit]) == 1 and cit.date() == date(2019, 1, 9)
+    [(_, cit, html)] = git.augment_and_filter_files([f], bgbl_index=index)
+    assert html == index.proceedings(1, 2019, 61)
+    assert git.build_history_sharded([f], str(tmpdir.join('git')), max_workers=1, bgbl_index=index) == 1
+    assert _http_requests() == before
+
+
+def test_verify_quarantines_bad_files(tmpdir):
+    dl_dir = str(tmpdir)
+    good = write_law_zip(dl_dir, '2019-01-02', 'stgb', 'a')
+    invalid = write_law_zip(dl_dir, '2019-01-02', 'bgb', 'a', [('<jurabk>StGB</jurabk>', '')])
+    malformed = write_law_zip(dl_dir, '2019-01-03', 'stgb', 'b', [('</dokumente>', '')])
+    truncated = write_law_zip(dl_dir, '2019-01-04', 'stgb', 'c')
+    with open(truncated, 'r+b') as f:
+        f.truncate(os.path.getsize(truncated) // 2)
+    crc = path.join(dl_dir, '2019-01-05', 'stgb', 'd.zip')
+    os.makedirs(path.dirname(crc))
+    with zipfile.ZipFile(crc, 'w', compression=zipfile.ZIP_STORED) as zf:
+        zf.write(STGB_XML, 'BJNR001270871.xml')
+    with open(crc, 'rb') as f:
+        content = f.read()
+    with open(crc, 'wb') as f:
+        f.write(content.replace(b'Strafgesetzbuch', b'Strafgesetzbucx', 1))
+    assert verify.verify_file(good) is None
+    assert verify.verify_file(invalid).startswith('Invalid xml')
+    assert verify.verify_file(malformed).startswith('Malformed xml')
+    assert verify.verify_file(truncated).startswith('Corrupt zip')
+    assert verify.verify_file(crc).startswith('Corrupt zip')
+
+    conn = index.open_index(dl_dir)
+    index.add_versions(conn, dl_dir, [good, invalid], max_workers=1)
+    conn.close()
+    bad, n = verify.verify(dl_dir, max_workers=1)
+    assert n == 5 and sorted(bad) == sorted([invalid, malformed, truncated, crc])
+    # Bad files are hidden in the quarantine and dropped from the index
+    assert fs_operations.all_local_files(dl_dir) == [good]
+    assert list(fs_operations.iter_local_files(dl_dir)) == [good]
+    assert path.exists(path.join(dl_dir, verify.QUARANTINE_DIR, '2019-01-02', 'bgb', 'a.zip'))
+    assert not path.exists(path.join(dl_dir, '2019-01-03'))
+    conn = index.open_index(dl_dir)
+    assert conn.execute('SELECT path FROM versions').fetchall() == [(path.relpath(good, dl_dir), )]
+    conn.close()
+    # Unchanged files are not verified again
+    assert verify.verify(dl_dir, max_workers=1) == ({}, 0)
+    os.utime(good, ns=(0, 0))
+    assert verify.verify(dl_dir, max_workers=1) == ({}, 1)
+    # A second bad copy at the same path does not replace the quarantined one
+    write_law_zip(dl_dir, '2019-01-02', 'bgb', 'a', [('<jurabk>StGB</jurabk>', '')])
+    [moved] = verify.quarantine(dl_dir, [invalid])
+    assert path.basename(moved).startswith('a.') and moved.endswith('.zip')
+    assert len(os.listdir(path.join(dl_dir, verify.QUARANTINE_DIR, '2019-01-02', 'bgb'))) == 2
+
+
+def test_change_feed(standin, tmpdir):
+    dl_dir, feed_dir = str(tmpdir.join('dl')), str(tmpdir.join('feed'))
+    write_law_zip(dl_dir, '2019-01-02', 'stgb', 'a')
+    index.update_index(dl_dir, max_workers=1)
+    # The BIP is not searched for the versions a full first run adds
+    before = _http_requests()
+    assert feed.update_feed(dl_dir, feed_dir, max_workers=1, full=True) == 1
+    assert _http_requests() == before
+    # Only the versions indexed since the last run are added
+    assert feed.update_feed(dl_dir, feed_dir, max_workers=1) == 0
+    write_law_zip(dl_dir, '2019-01-03', 'stgb', 'b', [('Eine Tat kann nur', 'Eine Tat darf nur')])
+    write_law_zip(dl_dir, '2019-01-03', 'bgb', 'a')
+    index.update_index(dl_dir, max_workers=1)
+    assert feed.update_feed(dl_dir, feed_dir, max_entries=2, max_workers=1) == 2
+    with open(path.join(feed_dir, feed.JSONL_FILE), encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert [r['path'] for r in records] == ['2019-01-02/stgb/a.zip', '2019-01-03/bgb/a.zip', '2019-01-03/stgb/b.zip']
+    assert records[-1]['changed_norms'] == ['§ 1']
+    assert len(records[1]['changed_norms']) > 500
+    assert records[-1]['long_name'] == 'Strafgesetzbuch'
+    assert records[-1]['citation'] == {'gazette': 'BGBl I', 'year': 1998, 'page': 3322, 'date': '1998-11-13'}
+    assert records[-1]['proceedings'].endswith('vorgangId=19983322')
+    atom = etree.parse(path.join(feed_dir, feed.ATOM_FILE))
+    entries = atom.findall('{http://www.w3.org/2005/Atom}entry')
+    # Newest first, trimmed to `max_entries`
+    assert [json.loads(e.findtext('{http://www.w3.org/2005/Atom}content'))['path'] for e in entries] == [
+        '2019-01-03/stgb/b.zip', '2019-01-03/bgb/a.zip'
+    ]
+    assert {e.find('{http://www.w3.org/2005/Atom}content').get('type') for e in entries} == {'text'}
+    assert atom.findtext('{http://www.w3.org/2005/Atom}author/{http://www.w3.org/2005/Atom}name') == 'librelaws'
+    assert atom.find('{http://www.w3.org/2005/Atom}link').get('rel') == 'alternate'
+    assert records[0]['proceedings'] is None
+    assert not [f for f in os.listdir(feed_dir) if f.endswith('.tmp')]
+    # The id of a removed version is not given to the next one
+    os.remove(path.join(dl_dir, '2019-01-03', 'stgb', 'b.zip'))
+    write_law_zip(dl_dir, '2019-01-04', 'stgb', 'c')
+    assert index.update_index(dl_dir, max_workers=1) == (1, 1)
+    assert feed.update_feed(dl_dir, feed_dir, max_workers=1) == 1
+
+
+def test_change_feed_starts_at_first_run(tmpdir):
+    dl_dir, feed_dir = str(tmpdir.join('dl')), str(tmpdir.join('feed'))
+    write_law_zip(dl_dir, '2019-01-02', 'stgb', 'a')
+    index.update_index(dl_dir, max_workers=1)
+    assert feed.update_feed(dl_dir, feed_dir, lookup=False, max_workers=1) == 0
+    assert os.listdir(feed_dir) == []
+    write_law_zip(dl_dir, '2019-01-03', 'bgb', 'a')
+    index.update_index(dl_dir, max_workers=1)
+    assert feed.update_feed(dl_dir, feed_dir, lookup=False, max_workers=1) == 1
+
+
+def test_index_migrates_to_autoincrement(tmpdir):
+    dl_dir = str(tmpdir)
+    f = write_law_zip(dl_dir, '2019-01-02', 'stgb', 'a')
+    # An index created before the ids were AUTOINCREMENT
+    conn = sqlite3.connect(index.index_path(dl_dir))
+    conn.executescript(index.SCHEMA.replace(' AUTOINCREMENT', ''))
+    index.add_versions(conn, dl_dir, [f], max_workers=1)
+    n_norms = conn.execute('SELECT count(*) FROM norms').fetchone()[0]
+    conn.close()
+    conn = index.open_index(dl_dir)
+    assert 'AUTOINCREMENT' in conn.execute("SELECT sql FROM sqlite_master WHERE name = 'versions'").fetchone()[0]
+    assert conn.execute('SELECT id, path FROM versions').fetchall() == [(1, path.join('2019-01-02', 'stgb', 'a.zip'))]
+    assert conn.execute('SELECT count(*) FROM norms').fetchone()[0] == n_norms > 0
+    index.drop_versions(conn, [path.join('2019-01-02', 'stgb', 'a.zip')])
+    assert conn.execute('SELECT count(*) FROM norms').fetchone()[0] == 0
+    assert index.add_versions(conn, dl_dir, [f], max_workers=1) == 1
+    assert conn.execute('SELECT id FROM versions').fetchall() == [(2, )]
+    conn.close()